@@ -1 +1,52 @@
-__all__ = ["khetEngine", "tiu", "narmer", "menes"]
\ No newline at end of file
+"""The engines, each in a module of its own.
+
+Importing the package loads none of them.  ENGINES maps each engine's name to its class,
+importing the engine's module (and whatever it needs) only when that class is asked for,
+so a program that runs one engine doesn't pay to load the rest."""
+
+# For each engine's name, its module in this package and its class there.
+ENGINE_CLASSES = {
+    'tiu': ('tiu', 'TiuEngine'),
+    'narmer': ('narmer', 'NarmerEngine'),
+    'menes': ('menes', 'MenesEngine'),
+    'raneb': ('raneb', 'RanebEngine'),
+    'khufu': ('khufu', 'KhufuEngine'),
+    }
+
+
+class EngineRegistry:
+    """A read-only dictionary of engine classes by name, importing each engine's module on first use."""
+    def __init__(self, classes):
+        self.classes = classes
+
+    def __getitem__(self, name):
+        (moduleName, className) = self.classes[name]
+        module = __import__('engines.' + moduleName, globals(), locals(), [className])
+        return getattr(module, className)
+
+    def __contains__(self, name):
+        return name in self.classes
+
+    def __iter__(self):
+        return iter(self.classes)
+
+    def __len__(self):
+        return len(self.classes)
+
+    def keys(self):
+        return self.classes.keys()
+
+    def get(self, name, default = None):
+        if name in self.classes:
+            return self[name]
+        return default
+
+
+ENGINES = EngineRegistry(ENGINE_CLASSES)
+
+def CreateEngine(name, *args):
+    """Returns a new engine of the named kind, constructed with the given arguments."""
+    return ENGINES[name](*args)
+
+
+__all__ = ["ENGINES", "CreateEngine"]
@@ -0,0 +1,117 @@
+import Queue
+import shlex
+import subprocess
+import threading
+
+from khetEngine import *
+from khetProtocol import MoveText, FormatPosition, FormatGo, ParseInfo, ReadLines
+
+class ExternalEngine(KhetEngine):
+    """Drives an engine running in a separate process, through the protocol described in khetProtocol.
+
+    Like Raneb, it keeps analyzing on the opponent's time: each move starts a fresh search of the new position."""
+
+    # Longest to wait for the engine to identify itself when starting, in seconds.
+    STARTUP_TIMEOUT = 30
+
+    # Longest ContinueAnalysis waits for output before returning, in seconds.
+    POLL_TIME = 0.05
+
+    def __init__(self, command, depth = None, moveTime = None, nodes = None):
+        """Starts the engine process with the given command line; the limits are sent with each search."""
+        KhetEngine.__init__(self)
+        self.name = 'External engine'
+        self.limits = (depth, moveTime, nodes)
+        self.process = subprocess.Popen(shlex.split(command), stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                        universal_newlines = True)
+        self.lines = Queue.Queue()
+        reader = threading.Thread(target = ReadLines, args = (self.process.stdout, self.lines, None))
+        reader.setDaemon(True)
+        reader.start()
+
+        self.mainGame = None
+        self.moveList = []
+        self.pendingSearches = 0  # Searches started whose bestmove hasn't come back yet.
+        self.bestMove = None
+        self.stats = KhetEngine.GetStats(self)
+
+        self.Send("khet")
+        while True:
+            line = self.lines.get(timeout = ExternalEngine.STARTUP_TIMEOUT)
+            if line == None:
+                raise IOError("external engine exited during startup: %s" % command)
+            if line.startswith("id name "):
+                self.name = line[len("id name "):]
+            elif line == "khetok":
+                break
+
+    def Send(self, line):
+        self.process.stdin.write(line + "\n")
+        self.process.stdin.flush()
+
+    def Close(self):
+        """Tells the engine process to exit, and waits for it."""
+        if self.process.poll() == None:
+            self.Send("quit")
+            self.process.wait()
+
+    def StartAnalysis(self, game):
+        self.mainGame = game
+        self.moveList = [MoveText(m) for m in game.moveStack]
+        self.StartSearch()
+
+    def StartSearch(self):
+        if self.pendingSearches:
+            self.Send("stop")
+        self.Send(FormatPosition(self.moveList))
+        self.Send(FormatGo(*self.limits))
+        self.pendingSearches += 1
+        self.bestMove = None
+        self.stats = KhetEngine.GetStats(self)
+
+    def ContinueAnalysis(self, onOwnTime):
+        self.ProcessOutput()
+        return self.pendingSearches > 0
+
+    def ProcessOutput(self):
+        """Handles whatever the engine has sent, waiting briefly for the first line."""
+        timeout = ExternalEngine.POLL_TIME
+        while True:
+            try:
+                line = self.lines.get(timeout = timeout)
+            except Queue.Empty:
+                return
+            timeout = 0.001
+
+            if line == None:
+                raise IOError("external engine exited unexpectedly")
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == 'bestmove':
+                self.pendingSearches -= 1
+                if self.pendingSearches == 0 and words[1] != 'none':
+                    # It's the answer to the latest search; earlier ones were for positions we've left.
+                    self.bestMove = words[1]
+            elif words[0] == 'info' and self.pendingSearches == 1 and words[1:2] != ['string']:
+                self.stats = ParseInfo(words[1:])
+            elif self.verbose:
+                print "External engine:", line
+
+    def TakeNextMove(self, move):
+        self.moveList.append(MoveText(move))
+        self.StartSearch()
+
+    def GetMove(self):
+        if self.bestMove:
+            moveText = self.bestMove
+        elif self.stats['pv']:
+            moveText = self.stats['pv'][0]  # Still thinking; this is the best so far.
+        else:
+            return None
+        result = Move.FromString(moveText, self.mainGame.board)
+        result.oValue = self.stats['score']
+        return result
+
+    def GetStats(self):
+        return self.stats
@@ -1,16 +1,31 @@
 from khetGame import *
+import khetBook
+import khetCheckpoint
+import khetMoveStats
 import random
 import time
 
 class KhetEngine:
     """An engine to analyze Khet game positions and come up with move suggestions."""
+
+    # Names of the counters and timings saved in a checkpoint, along with the search tree.
+    CHECKPOINT_FIELDS = []
+
     def __init__(self):
         self.name = 'Unnamed engine'
+        self.verbose = True  # Print analysis progress to the console.
+        self.book = khetBook.DefaultBook()  # Set to None to always search.
+        self.bookMove = None
+        self.moveStats = khetMoveStats.DefaultMoveStats()  # Orders moves in the opening; set to None to ignore.
+        self.checkpoint = None  # The khetCheckpoint.Checkpoint the analysis was resumed from, if any.
+        self.checkpointFile = None  # If set, the analysis is saved here every checkpointInterval seconds.
+        self.checkpointInterval = 60
+        self.lastCheckpointTime = time.time()
 
     def Analyze(self, game):
         """Analyzes the given game position entirely."""
         self.StartAnalysis(game)
-        while (self.ContinueAnalysis(true)):
+        while (self.ContinueAnalysis(True)):
             pass
 
     def StartAnalysis(self, game):
@@ -31,6 +46,32 @@ class KhetEngine:
         onOwnTime is false if the other player is currently thinking - it's not on the engine's clock."""
         return False
 
+    def SaveCheckpoint(self, filename):
+        """Saves the analysis so far to the given file, for ResumeAnalysis."""
+        khetCheckpoint.Write(filename, self)
+        self.lastCheckpointTime = time.time()
+
+    def ResumeAnalysis(self, filename, game = None):
+        """Like StartAnalysis, but carries on from the analysis saved in the given checkpoint file.
+
+        If game is None, analyzes the checkpoint's own position.  Returns the game being analyzed.
+        Raises khetCheckpoint.CheckpointError if the file is for a different position or engine."""
+        checkpoint = khetCheckpoint.Checkpoint(filename)
+        if game == None:
+            game = checkpoint.RootGame()
+        self.StartAnalysis(game)
+        checkpoint.Restore(self)
+        self.checkpoint = checkpoint
+        self.bookMove = self.FindBookMove(self.game, self.moves)
+        if self.bookMove:
+            self.moves = [self.bookMove]
+        return game
+
+    def MaybeSaveCheckpoint(self):
+        """Saves the analysis to checkpointFile, if it's set and it's been checkpointInterval seconds since the last save."""
+        if self.checkpointFile != None and time.time() - self.lastCheckpointTime >= self.checkpointInterval:
+            self.SaveCheckpoint(self.checkpointFile)
+
     def TakeNextMove(self, move):
         """The given move has been added to the previously-analyzed game.  Prepare for the next round of analysis."""
         pass
@@ -55,15 +96,92 @@ class KhetEngine:
         Returns None if, for some reason, no move could be generated."""
         return None
 
+    def GetStats(self):
+        """Returns a dictionary describing the progress of the current analysis.
+
+        Always includes 'depth' (plies fully searched), 'score' (of the best move; positive favors Silver),
+        'nodes' (positions evaluated), 'time' (seconds spent analyzing), and 'pv' (the expected line of play,
+        as a list of move strings).  Engines may add their own entries."""
+        return {'depth': 0, 'score': 0, 'nodes': 0, 'time': 0, 'pv': []}
+
+    def AnalyzeWithLimits(self, game, depth = None, moveTime = None, nodes = None,
+                          shouldStop = None, onInfo = None, infoInterval = 0.5):
+        """Analyzes the given game until the engine is satisfied or one of the given limits is reached.
+
+        moveTime is in seconds.  If any limit is given, it replaces the engine's own time limit.
+        shouldStop is polled between batches of analysis; analysis stops if it returns True.
+        onInfo is called with GetStats() every infoInterval seconds, and once at the end.
+        Returns the best move, as from GetMove()."""
+        # Swap in the given limits for the engine's own, for the duration.
+        savedLimits = dict([(name, getattr(self, name)) for name in ('maxDepth', 'maxTime') if hasattr(self, name)])
+        if depth != None and hasattr(self, 'maxDepth'):
+            self.maxDepth = depth
+        if depth != None or moveTime != None or nodes != None:
+            if hasattr(self, 'maxTime'):
+                self.maxTime = moveTime
+
+        try:
+            startTime = time.time()
+            lastInfo = startTime
+            self.StartApparentTime()
+            self.StartAnalysis(game)
+            while self.ContinueAnalysis(True):
+                stats = self.GetStats()
+                now = time.time()
+                if onInfo and now - lastInfo >= infoInterval:
+                    onInfo(stats)
+                    lastInfo = now
+                if (depth != None and stats['depth'] >= depth) \
+                   or (moveTime != None and now - startTime >= moveTime) \
+                   or (nodes != None and stats['nodes'] >= nodes) \
+                   or (shouldStop and shouldStop()):
+                    break
+            if onInfo:
+                onInfo(self.GetStats())
+            return self.GetMove()
+        finally:
+            for name, value in savedLimits.items():
+                setattr(self, name, value)
+
     # Functions for use by derived classes.
 
+    def FindBookMove(self, game, moves):
+        """Looks for the game's position in the opening book.
+
+        If it's there, returns the book's choice from moves (the legal moves in the position),
+        with its oValue and exploredDepth set from the book.  Otherwise returns None."""
+        if self.book == None:
+            return None
+        bookMove = self.book.ChooseMove(game)
+        if bookMove == None:
+            return None
+        for move in moves:
+            if move.Matches(bookMove) and getattr(move, 'unstackObelisk', False) == bookMove.unstackObelisk:
+                move.oValue = bookMove.oValue
+                move.exploredDepth = bookMove.exploredDepth
+                if self.verbose:
+                    print "Book move:", move, move.oValue
+                return move
+        return None
+
+    def EnumerateNextMoves(self, game, move):
+        """Returns the replies to move, which has just been made on game (and the turn passed).
+
+        They come from the checkpoint being resumed, with their analysis, if it has them; otherwise from EnumerateMoves."""
+        if getattr(move, 'checkpointIndex', None) != None and self.checkpoint != None:
+            result = self.checkpoint.RestoreMoves(self, game, move.checkpointIndex)
+            del move.checkpointIndex
+            if result != None:
+                return result
+        return self.EnumerateMoves(game)
+
     def EnumerateMoves(self, game):
         """Returns a list of KhetMoves, including all legal moves for the current player.
 
-        Returns an empty list if there are no legal moves."""
-        result = []
-        for piece in allPieces(game.board):
-            if piece.color == game.activePlayer:
-                result.extend(piece.EnumerateMoves(game.board))
+        Returns an empty list if there are no legal moves.
+        Moves often played from the position in the games behind moveStats come first; the rest are shuffled."""
+        result = game.EnumerateMoves()
         random.shuffle(result)
+        if self.moveStats != None:
+            self.moveStats.Order(game, result)
         return result
@@ -0,0 +1,240 @@
+import copy
+import math
+import time
+from tiu import *
+
+class KhufuEngine(TiuEngine):
+    """A Monte Carlo tree search engine: no evaluation function, just the results of random playouts.
+
+    Each iteration walks down the tree choosing moves by UCT (upper confidence bound applied to trees),
+    adds one new move to the tree, plays the game out randomly from there, and credits the result
+    to every move on the way.  Like Menes, the tree hangs off the moves, in nextMoves, and is kept
+    for the branch actually played.
+
+    Each move in the tree carries visits (playouts through it) and wins (of those, how many the
+    player who made the move won, counting a draw as half)."""
+
+    # Weight of exploring little-visited moves against exploiting the best ones.
+    EXPLORATION = 1.4
+
+    # Think for this many seconds per move.
+    MAX_ANALYSIS_TIME = 4
+
+    # Analyze for only this many seconds before taking a break.
+    MAX_ANALYSIS_BATCH_TIME = 0.2
+
+    # Stop thinking on the opponent's time after this many playouts, to bound the size of the tree.
+    MAX_PONDER_PLAYOUTS = 200000
+
+    # A playout that goes this many plies without a Pharaoh being hit is scored as a draw.
+    PLAYOUT_PLIES = 80
+
+    CHECKPOINT_FIELDS = ['rootVisits', 'playouts', 'playoutPlies', 'elapsedTime']
+
+    def __init__(self, exploration = None):
+        TiuEngine.__init__(self)
+        self.name = 'Khufu engine (Monte Carlo)'
+        if exploration == None:
+            exploration = KhufuEngine.EXPLORATION
+        self.exploration = exploration
+        self.maxTime = KhufuEngine.MAX_ANALYSIS_TIME  # None to think until stopped.
+        self.maxPlayoutPlies = KhufuEngine.PLAYOUT_PLIES
+
+    def EnumerateMoves(self, game):
+        result = TiuEngine.EnumerateMoves(self, game)
+        for move in result:
+            move.visits = 0
+            move.wins = 0.0
+        return result
+
+    def StartAnalysis(self, game):
+        # Search on a copy, like Menes.
+        self.mainGame = game
+        TiuEngine.StartAnalysis(self, copy.deepcopy(game))
+        self.rootVisits = 0
+        self.StartMove()
+
+    def StartMove(self):
+        self.playouts = 0
+        self.playoutPlies = 0  # Total, over all the playouts.
+        self.elapsedTime = 0
+
+    def TakeNextMove(self, move):
+        move = self.FindMoveInList(move)
+        move.TakeCompleteTurn(self.game)
+        # Keep the part of the tree under the move that was played.
+        if hasattr(move, 'nextMoves'):
+            self.moves = move.nextMoves
+            self.rootVisits = move.visits
+        else:
+            self.moves = self.EnumerateNextMoves(self.game, move)
+            self.rootVisits = sum([m.visits for m in self.moves])
+        self.bookMove = self.FindBookMove(self.game, self.moves)
+        if self.bookMove:
+            self.moves = [self.bookMove]
+        self.StartMove()
+
+    def FindMoveInList(self, mainMove):
+        """Returns the move in our list matching the given one from the main game, or a copy on our board."""
+        for move in self.moves:
+            if move.Matches(mainMove) and getattr(move, 'unstackObelisk', False) == getattr(mainMove, 'unstackObelisk', False):
+                return move
+        return mainMove.TransferToBoard(self.game.board)
+
+    def FinishedAnalyzing(self, onOwnTime):
+        if self.bookMove != None or len(self.moves) <= 1 or self.game.IsOver():
+            return True
+        if onOwnTime:
+            return self.maxTime != None and time.clock() - self.moveStart >= self.maxTime
+        else:
+            return self.playouts >= KhufuEngine.MAX_PONDER_PLAYOUTS
+
+    def ContinueAnalysis(self, onOwnTime):
+        if self.FinishedAnalyzing(onOwnTime):
+            return False
+
+        batchStartTime = time.clock()
+        while time.clock() - batchStartTime < KhufuEngine.MAX_ANALYSIS_BATCH_TIME:
+            self.Iterate()
+        self.elapsedTime += time.clock() - batchStartTime
+        self.MaybeSaveCheckpoint()
+
+        if self.FinishedAnalyzing(onOwnTime):
+            if self.verbose:
+                print "Final move list:"
+                for move in self.SortedMoves():
+                    print move, move.visits, move.wins
+                print "%d playouts in %f seconds." % (self.playouts, self.elapsedTime)
+            return False
+        else:
+            return True
+
+    def Iterate(self):
+        """Does one round of selection, expansion, playout, and backing up the result."""
+        game = self.game
+        path = []
+        moves = self.moves
+        parentVisits = self.rootVisits
+        while True:
+            move = self.SelectMove(moves, parentVisits)
+            move.TakeCompleteTurn(game)
+            path.append(move)
+            if game.IsOver() or move.visits == 0:
+                break
+            if not hasattr(move, 'nextMoves'):
+                move.nextMoves = self.EnumerateNextMoves(game, move)
+            parentVisits = move.visits
+            moves = move.nextMoves
+
+        silverScore = self.Playout(game)
+
+        for move in reversed(path):
+            game.UndoAndPopLastMove()
+            game.PassToNextPlayer()
+            move.visits += 1
+            if move.piece.color == PLAYER_SILVER:
+                move.wins += silverScore
+            else:
+                move.wins += 1 - silverScore
+        self.rootVisits += 1
+
+    def SelectMove(self, moves, parentVisits):
+        """Returns the move to follow by UCT: any move not yet tried, or else the one with the best upper bound."""
+        bestMove = None
+        bestBound = -1
+        logVisits = math.log(max(parentVisits, 1))
+        for move in moves:
+            if move.visits == 0:
+                return move  # The list is already shuffled.
+            bound = move.wins / move.visits + self.exploration * math.sqrt(logVisits / move.visits)
+            if bound > bestBound:
+                bestMove = move
+                bestBound = bound
+        return bestMove
+
+    def Playout(self, game):
+        """Plays random moves from the current position until the game ends or the ply limit, then takes them back.
+
+        For speed, each move is chosen by picking one of the player's pieces at random, then one of its moves.
+        Returns the result for Silver: 1 for a win, 0 for a loss, 0.5 for a draw."""
+        self.playouts += 1
+        pieces = [[], []]
+        for piece in allPieces(game.board):
+            pieces[piece.color].append(piece)
+
+        plies = 0
+        while not game.IsOver() and plies < self.maxPlayoutPlies:
+            move = self.RandomMove(game, pieces[game.activePlayer])
+            if move == None:
+                break
+            move.TakeCompleteTurn(game)
+            plies += 1
+        self.playoutPlies += plies
+
+        if game.Pharaoh(PLAYER_RED).square == None:
+            result = 1
+        elif game.Pharaoh(PLAYER_SILVER).square == None:
+            result = 0
+        else:
+            result = 0.5
+
+        for i in range(plies):
+            game.UndoAndPopLastMove()
+            game.PassToNextPlayer()
+        return result
+
+    def RandomMove(self, game, pieces):
+        """Returns a random move by a random one of the given pieces still on the board; None if none turns up."""
+        for attempt in range(2 * len(pieces)):
+            piece = random.choice(pieces)
+            if piece.square:
+                moves = game.EnumeratePieceMoves(piece)
+                if moves:
+                    return random.choice(moves)
+        return None
+
+    def SortedMoves(self):
+        """Returns the root moves, most-visited first."""
+        return sorted(self.moves, key = lambda m: m.visits, reverse = True)
+
+    def GetMove(self):
+        if not self.moves:
+            return None
+        result = self.SortedMoves()[0]
+        realResult = result.TransferToBoard(self.mainGame.board)
+        realResult.oValue = self.MoveScore(result)
+        return realResult
+
+    def MoveScore(self, move):
+        """Returns the move's win rate as a score in the engines' usual sense, from -100 to 100; positive favors Silver."""
+        if move.visits == 0:
+            return getattr(move, 'oValue', 0)
+        score = 200 * move.wins / move.visits - 100
+        if move.piece.color == PLAYER_RED:
+            score = -score
+        return score
+
+    def PrincipalVariation(self):
+        """Returns the most-visited line of play."""
+        result = []
+        moves = self.moves
+        while moves:
+            move = max(moves, key = lambda m: m.visits)
+            if move.visits == 0:
+                break
+            result.append(move)
+            moves = getattr(move, 'nextMoves', None)
+        return result
+
+    def GetStats(self):
+        result = TiuEngine.GetStats(self)
+        if self.moves:
+            pv = self.PrincipalVariation()
+            result['depth'] = len(pv)
+            if pv:
+                result['score'] = self.MoveScore(pv[0])
+            result['nodes'] = self.playouts
+            result['time'] = self.elapsedTime
+            result['pv'] = [str(m).split()[0] for m in pv]
+            result['playoutPlies'] = self.playoutPlies
+        return result
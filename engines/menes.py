@@ -1,10 +1,22 @@
+import gc
 import time
 from narmer import *
+import khetTablebase
+
+INFINITY = float('inf')
 
 class MenesEngine(NarmerEngine):
     """Adds traversal of the game tree (lookahead), to a fixed number of plies that are exhaustively searched.
 
-    Also supports incremental analysis with StartAnalysis/ContinueAnalysis/TakeNextMove."""
+    Also supports incremental analysis with StartAnalysis/ContinueAnalysis/TakeNextMove.
+
+    With alphaBeta set, searches below the root with alpha-beta pruning instead (see SearchMove), keeping
+    no tree there: replies come from Game.GenerateMoves, best first if the last search found one, and most
+    of them are never generated, because an earlier one already shows the move is worse than another.
+
+    With pauseGC set, cyclic garbage collection is kept off during each batch of analysis, and run in full
+    between moves instead.  The search tree has no reference cycles, so nothing in it waits for a collection,
+    and a tree of millions of moves is expensive for the collector to look over every so often mid-search."""
 
     # Does a full tree evaluation to this many levels, counting the current player's next move.
     MAX_DEPTH = 2
@@ -12,15 +24,49 @@ class MenesEngine(NarmerEngine):
     # Analyze for only this many seconds before taking a break.
     MAX_ANALYSIS_BATCH_TIME = 0.2
 
-    def __init__(self):
-        NarmerEngine.__init__(self)
+    # The position cache is emptied when it reaches this many entries; so is the table of best replies.
+    MAX_CACHE_ENTRIES = 500000
+
+    CHECKPOINT_FIELDS = ['moveCount', 'cacheHits', 'elapsedTime']
+
+    # Moves kept in the pool's free list, at most.
+    MAX_FREE_MOVES = 1000
+
+    def __init__(self, weights = None):
+        NarmerEngine.__init__(self, weights)
         self.name = 'Menes engine, %d-ply' % MenesEngine.MAX_DEPTH
+        self.maxDepth = MenesEngine.MAX_DEPTH
+        self.tablebases = khetTablebase.DefaultTablebases()  # None if there aren't any.
+
+        # Results of searching each position, kept from move to move and shared by all branches of the tree:
+        # maps the position key just after a move (before passing the turn) to (oValue, exploredDepth).
+        # With foldMirrorImages, a position and its mirror image share an entry, under Game.CanonicalKey;
+        # that's only sound while the evaluation of one is the negation of the other (see khetBench symmetry).
+        self.cache = {}
+        self.foldMirrorImages = True
+
+        # Alpha-beta search: maps the position key where a reply was chosen to the best reply's move code, to try first next time.
+        self.alphaBeta = True
+        self.bestReplies = {}
+        self.movePool = MovePool()  # Recycles the replies searched; None to make new ones each time.
+
+        # Garbage collection: the time spent collecting between moves, and the objects it found.
+        self.pauseGC = True
+        self.gcTime = 0
+        self.gcObjects = 0
+
+        # Pondering: the opponent's move we last searched on his time, and how often we guessed right.
+        self.ponderMove = None
+        self.ponders = 0
+        self.ponderHits = 0
 
     def EnumerateMoves(self, game):
         result = TiuEngine.EnumerateMoves(self, game)
         for move in result:
             move.exploredDepth = 0
             move.oValue = 0
+            move.solved = False  # True if the tablebases know how the game ends from here.
+            move.bounded = False  # True if oValue is only a bound, from an alpha-beta search.
         return result
     
     def StartAnalysis(self, game):
@@ -30,48 +76,149 @@ class MenesEngine(NarmerEngine):
         game = copy.deepcopy(self.mainGame)
 
         self.StartMove()
+        self.ponderMove = None
         TiuEngine.StartAnalysis(self, game)  # Finds initial move list.
 
     def StartMove(self):
         self.moveCount = 0
+        self.cacheHits = 0
         self.elapsedTime = 0
+        self.CollectGarbage()
+
+    def CollectGarbage(self):
+        """With pauseGC, runs a full garbage collection, timing it; e.g. between moves, when the last tree has just been let go."""
+        if not self.pauseGC:
+            return
+        start = time.clock()
+        self.gcObjects += gc.collect()
+        self.gcTime += time.clock() - start
 
     def ContinueAnalysis(self, onOwnTime):
+        """Runs a batch of analysis with AnalyzeBatch, keeping garbage collection off for it if pauseGC is set."""
+        if not self.pauseGC or not gc.isenabled():
+            return self.AnalyzeBatch(onOwnTime)
+        gc.disable()
+        try:
+            return self.AnalyzeBatch(onOwnTime)
+        finally:
+            gc.enable()
+
+    def AnalyzeBatch(self, onOwnTime):
+        """Does the work of ContinueAnalysis."""
         if self.FinishedAnalyzing(onOwnTime):
             return False
         
         self.batchStartTime = time.clock()
-        for move in self.moves:
-            self.EvaluateObjective(self.game, move)
+        if self.alphaBeta:
+            self.ContinueSearch()
+        elif self.MinExploredDepth(self.moves) < self.maxDepth:
+            for move in self.moves:
+                self.EvaluateObjective(self.game, move)
+        else:
+            # Pondering: search the opponent's expected move a ply deeper,
+            # so the tree under it is already full depth if he makes it.
+            self.ponderMove = self.moves[0]
+            self.EvaluateObjective(self.game, self.ponderMove, self.maxDepth + 1)
                 
         self.SortForActivePlayer(self.game, self.moves)
 
         self.elapsedTime += (time.clock() - self.batchStartTime)
+        self.MaybeSaveCheckpoint()
 
         if self.FinishedAnalyzing(onOwnTime):
-            print "Final move list:"
-            for move in self.moves:
-                print move, move.oValue
-            print "Analyzed %d moves to a depth of %d in %f seconds." % (self.moveCount, self.MinExploredDepth(self.moves), self.elapsedTime)
+            if self.verbose:
+                print "Final move list:"
+                for move in self.moves:
+                    print move, move.oValue
+                print "Analyzed %d moves to a depth of %d in %f seconds." % (self.moveCount, self.MinExploredDepth(self.moves), self.elapsedTime)
             return False
         else:
             return True  # Need more time.
 
+    def ContinueSearch(self):
+        """Carries on the alpha-beta search of the root moves, a ply deeper each pass, until maxDepth, then ponders.
+
+        Moves are searched in the order the last pass sorted them into, each against the best found so far,
+        so any but the best may get only a bound on its value, and is marked as bounded."""
+        minDepth = self.MinExploredDepth(self.moves)
+        if minDepth >= self.maxDepth:
+            self.ponderMove = self.moves[0]
+            if self.ponderMove.exploredDepth <= self.maxDepth:
+                self.SearchRootMove(self.ponderMove, self.maxDepth + 1, -INFINITY, INFINITY)
+            return
+
+        depth = minDepth + 1
+        silver = self.game.activePlayer == PLAYER_SILVER
+        (alpha, beta) = (-INFINITY, INFINITY)
+        for move in self.moves:
+            if move.exploredDepth >= depth and not getattr(move, 'bounded', False):
+                if silver:
+                    alpha = max(alpha, move.oValue)
+                else:
+                    beta = min(beta, move.oValue)
+        for move in self.moves:
+            if move.exploredDepth >= depth:
+                continue
+            if not self.SearchRootMove(move, depth, alpha, beta):
+                break
+            if move.bounded:
+                continue
+            if silver:
+                alpha = max(alpha, move.oValue)
+            else:
+                beta = min(beta, move.oValue)
+
+    def SearchRootMove(self, move, depth, alpha, beta):
+        """Searches one root move, setting its oValue, exploredDepth and bounded.  Returns false if it was interrupted."""
+        value = self.SearchMove(self.game, move, depth, alpha, beta)
+        if value == None:
+            return False
+        move.oValue = value
+        move.exploredDepth = depth
+        move.bounded = value <= alpha or value >= beta
+        return True
+
+    def SortForActivePlayer(self, game, moves):
+        NarmerEngine.SortForActivePlayer(self, game, moves)
+        # A bound can equal the best value without the move being as good, so put a move known to be that good first.
+        for (i, move) in enumerate(moves):
+            if move.oValue != moves[0].oValue:
+                break
+            if not getattr(move, 'bounded', False):
+                moves.insert(0, moves.pop(i))
+                break
+
     def TakeNextMove(self, move):
         move = self.FindMoveInList(move)
-        print "Passing move to engine: ", move
+        if self.verbose:
+            print "Passing move to engine: ", move
+        if self.ponderMove != None:
+            self.ponders += 1
+            if move is self.ponderMove:
+                self.ponderHits += 1
+            if self.verbose:
+                print "Ponder hits: %d of %d." % (self.ponderHits, self.ponders)
+            self.ponderMove = None
         move.TakeCompleteTurn(self.game)
         # Now follow down that branch of the analysis tree.
         del self.moves[:]  # Makes it clearer to garbage collection that these are going away.
         if hasattr(move, 'nextMoves'):
             self.moves = move.nextMoves
         else:
-            self.moves = self.EnumerateMoves(self.game)
+            self.moves = self.EnumerateNextMoves(self.game, move)
+        self.bookMove = self.FindBookMove(self.game, self.moves)
+        if self.bookMove:
+            self.moves = [self.bookMove]
         # And restart the timing.
         self.StartMove()
 
     def FinishedAnalyzing(self, onOwnTime):
-        return self.MinExploredDepth(self.moves) == MenesEngine.MAX_DEPTH
+        if self.bookMove != None:
+            return True
+        if self.MinExploredDepth(self.moves) < self.maxDepth:
+            return False
+        # On the opponent's time, keep going until his expected move has been pondered.
+        return onOwnTime or self.moves[0].exploredDepth > self.maxDepth
 
     def GetMove(self):
         result = NarmerEngine.GetMove(self)
@@ -80,6 +227,33 @@ class MenesEngine(NarmerEngine):
         realResult.oValue = result.oValue
         return realResult
 
+    def GetStats(self):
+        result = NarmerEngine.GetStats(self)
+        if self.moves:
+            result['depth'] = self.MinExploredDepth(self.moves)
+            result['nodes'] = self.moveCount
+            result['time'] = self.elapsedTime
+            result['pv'] = [str(m).split()[0] for m in self.PrincipalVariation()]
+        result['cacheHits'] = self.cacheHits
+        result['cacheEntries'] = len(self.cache)
+        result['ponders'] = self.ponders
+        result['ponderHits'] = self.ponderHits
+        if self.movePool != None:
+            result['movesAllocated'] = self.movePool.allocated
+            result['movesReused'] = self.movePool.reused
+        result['gcTime'] = self.gcTime
+        result['gcObjects'] = self.gcObjects
+        return result
+
+    def PrincipalVariation(self):
+        """Returns the expected line of play, following the best move at each level of the tree."""
+        result = []
+        moves = self.moves
+        while moves:
+            result.append(moves[0])
+            moves = getattr(moves[0], 'nextMoves', None)
+        return result
+
     def MinExploredDepth(self, moveList):
         """Returns the smallest exploredDepth of any move in moveList."""
         return min(map(lambda x: x.exploredDepth, moveList))
@@ -103,7 +277,7 @@ class MenesEngine(NarmerEngine):
     
     def EvaluateObjective(self, game, move, depth = 0):
         if depth == 0:
-            depth = MenesEngine.MAX_DEPTH
+            depth = self.maxDepth
 
         # Exit quickly (and don't count the move) if we've already fully explored this move.
         if move.exploredDepth >= depth:
@@ -117,21 +291,33 @@ class MenesEngine(NarmerEngine):
         self.moveCount += 1
 
         # Report some intermediate status to the console.
-        if self.moveCount % 4000 == 0:
+        if self.verbose and self.moveCount % 4000 == 0:
             print self.moveCount, "...",
             
         game.MakeAndPushMove(move)
         try:
             game.FireLaser(move)
 
+            repeats = self.RepeatsForTie(game)
+            if repeats:
+                # Whoever is worse off will claim the tie, so that's what it's worth.
+                move.oValue = 0
+                move.exploredDepth = max(move.exploredDepth, depth)
+
+            elif move.exploredDepth < depth and self.LookUpCache(game, move):
+                pass  # Carry on below if it wasn't searched as deep as we want.
+            
             # Always evaluate the current move position first.
-            if move.exploredDepth == 0:
-                move.oValue = self.EvaluatePosition(game)
+            elif move.exploredDepth == 0:
+                move.oValue = self.ProbeTablebases(game)
+                move.solved = move.oValue != None
+                if not move.solved:
+                    move.oValue = self.EvaluatePosition(game)
                 move.exploredDepth = 1
 
             if move.exploredDepth >= depth:
                 pass
-            elif game.IsOver():
+            elif game.IsOver() or move.solved:
                 # Can't go any deeper; just say we've gone to the desired depth.
                 move.exploredDepth = depth
             else:
@@ -139,7 +325,7 @@ class MenesEngine(NarmerEngine):
                 game.PassToNextPlayer()
                 try:
                     if not hasattr(move, 'nextMoves'):
-                        move.nextMoves = self.EnumerateMoves(game)
+                        move.nextMoves = self.EnumerateNextMoves(game, move)
 
                     self.BeforeEvaluateMoves(move)  # Hook
                     
@@ -155,11 +341,138 @@ class MenesEngine(NarmerEngine):
                 finally:
                     # Revert to the last player.
                     game.PassToNextPlayer()
+
+            if not repeats:
+                # A tie by repetition depends on how we got here, so it's not a property of the position.
+                self.StoreInCache(game, move)
             
             #print move, move.oValue
         finally:
             game.UndoAndPopLastMove()
 
+    def SearchMove(self, game, move, depth, alpha, beta):
+        """Returns the value of making move on game, searched depth plies deep with alpha-beta pruning, or None if it's break time.
+
+        A value at or below alpha is only a bound, with the true value at most that, and one at or above beta
+        is at least that; either way, it's enough to know the move won't be chosen.  Exact values go in the
+        cache, and the best reply found at each position in bestReplies."""
+        if self.IsBreakTime():
+            return None
+        self.moveCount += 1
+        game.MakeAndPushMove(move)
+        try:
+            game.FireLaser(move)
+            if self.RepeatsForTie(game):
+                return 0
+
+            (key, sign) = self.CacheKey(game)
+            cached = self.cache.get(key)
+            if cached != None and cached[1] >= depth:
+                self.cacheHits += 1
+                return cached[0] * sign
+            value = self.ProbeTablebases(game)
+            if value != None:
+                return value
+            if depth <= 1 or game.IsOver():
+                self.laserPyramids = [0, 0]
+                self.hasGuard = [0, 0]
+                return self.EvaluatePosition(game)
+
+            game.PassToNextPlayer()
+            try:
+                value = self.SearchReplies(game, depth - 1, alpha, beta)
+            finally:
+                game.PassToNextPlayer()
+            if value != None and alpha < value < beta:
+                move.oValue = value
+                move.exploredDepth = depth
+                self.StoreInCache(game, move)
+            return value
+        finally:
+            game.UndoAndPopLastMove()
+
+    def SearchReplies(self, game, depth, alpha, beta):
+        """Returns the value of the best of the active player's moves on game, searched depth plies deep, as for SearchMove."""
+        silver = game.activePlayer == PLAYER_SILVER
+        best = None
+        bestCode = None
+        for reply in game.GenerateMoves(self.bestReplies.get(game.positionKey), self.movePool):
+            value = self.SearchMove(game, reply, depth, alpha, beta)
+            if value != None and (best == None or (silver and value > best) or (not silver and value < best)):
+                best = value
+                bestCode = reply.Encode()
+                if silver:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+            # Nothing refers to the reply any more, so it can be handed out again.
+            if self.movePool != None and len(self.movePool.free) < MenesEngine.MAX_FREE_MOVES:
+                self.movePool.Release(reply)
+            if value == None:
+                return None
+            if alpha >= beta:
+                break
+        if best == None:
+            return 0  # No moves at all; call it a draw.
+        if len(self.bestReplies) >= MenesEngine.MAX_CACHE_ENTRIES:
+            self.bestReplies.clear()
+        self.bestReplies[game.positionKey] = bestCode
+        return best
+
+    def LookUpCache(self, game, move):
+        """Takes the move's value from the cache, for the position it just led to on game, if the cache has searched it deeper.
+
+        Returns true if it did."""
+        (key, sign) = self.CacheKey(game)
+        cached = self.cache.get(key)
+        if cached == None or cached[1] <= move.exploredDepth:
+            return False
+        move.oValue = cached[0] * sign
+        move.exploredDepth = cached[1]
+        self.cacheHits += 1
+        return True
+
+    def StoreInCache(self, game, move):
+        """Records the move's value for the position it just led to on game, unless the cache already has a deeper one.
+
+        A single ply is cheap to evaluate again, so isn't kept."""
+        if move.exploredDepth < 2:
+            return
+        (key, sign) = self.CacheKey(game)
+        cached = self.cache.get(key)
+        if cached == None or cached[1] <= move.exploredDepth:
+            if cached == None and len(self.cache) >= MenesEngine.MAX_CACHE_ENTRIES:
+                self.cache.clear()
+            self.cache[key] = (move.oValue * sign, move.exploredDepth)
+
+    def CacheKey(self, game):
+        """Returns (key, sign) for the game's position in the cache: its canonical key, or its own key if foldMirrorImages is off."""
+        if self.foldMirrorImages:
+            return game.CanonicalKey()
+        return (game.positionKey, 1)
+
+    def RepeatsForTie(self, game):
+        """Returns true if the move just made and fired on game brings a position up to the count for claiming a tie."""
+        return not game.IsOver() and game.TimesSeen(game.positionKey ^ zobristRedToMove) + 1 >= TIE_REPETITIONS
+
+    def ProbeTablebases(self, game):
+        """Returns the exact value of the position the move just made and fired on game leads to, or None if it's not in the tablebases.
+
+        A win is worth a Pharaoh, less a little for each ply it takes."""
+        if self.tablebases == None:
+            return None
+        found = self.tablebases.Probe(game, 1 - game.activePlayer)
+        if found == None:
+            return None
+        (result, distance) = found
+        if result == khetTablebase.WIN:
+            winner = 1 - game.activePlayer
+        elif result == khetTablebase.LOSS:
+            winner = game.activePlayer
+        else:
+            return 0
+        return self.GetColorFactor(winner) * (self.weights.pharaoh - distance)
+
     def BeforeEvaluateMoves(self, move):
         """Hook called during EvaluateObjective(), before evaluating the given move's nextMoves.
 
@@ -178,8 +491,8 @@ class MenesEngine(NarmerEngine):
             result += self.EvaluatePiece(game, piece)
                     
         # Give a bonus for having laser-guiding pyramids (up to 2).
-        result += min((self.laserPyramids[PLAYER_SILVER], 2)) * 3
-        result -= min((self.laserPyramids[PLAYER_RED], 2)) * 3
+        result += min((self.laserPyramids[PLAYER_SILVER], 2)) * self.weights.laserPyramid
+        result -= min((self.laserPyramids[PLAYER_RED], 2)) * self.weights.laserPyramid
         return result
 
     def EvaluatePiece(self, game, piece):
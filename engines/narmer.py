@@ -1,10 +1,72 @@
 from tiu import *
 
+class EvaluationWeights:
+    """The coefficients used by NarmerEngine's objective function (and those of the engines derived from it).
+
+    The defaults are the original hand-tuned guesses; khetTuner.py breeds better ones."""
+
+    # Coefficient names, in a fixed order so a set of weights can be handled as a plain list.
+    NAMES = ['laserPyramid', 'guard', 'pharaohFriend', 'hitFactor', 'hitCap',
+             'stackedObelisk', 'obelisk', 'pyramid', 'pharaoh', 'diagonal']
+
+    DEFAULTS = {
+        'laserPyramid': 3,      # Per laser-guiding pyramid, up to 2.
+        'guard': 4,             # For having a guard piece.
+        'pharaohFriend': 3,     # Per friendly piece next to the Pharaoh.
+        'hitFactor': 0.45,      # Fraction of an opponent's piece's value earned by threatening it.
+        'hitCap': 1.5,          # Most a threat to an opponent's piece can be worth.
+        'stackedObelisk': 4,
+        'obelisk': 2,
+        'pyramid': 4,
+        'pharaoh': 1000,
+        'diagonal': 0.33,       # Weight of a diagonal neighbor of the Pharaoh, relative to an orthogonal one.
+        }
+
+    def __init__(self, values = None):
+        """Creates a set of weights from a list in NAMES order, or the defaults if values is None."""
+        if values is None:
+            values = [EvaluationWeights.DEFAULTS[name] for name in EvaluationWeights.NAMES]
+        for name, value in zip(EvaluationWeights.NAMES, values):
+            setattr(self, name, value)
+
+    def AsList(self):
+        return [getattr(self, name) for name in EvaluationWeights.NAMES]
+
+    def Save(self, filename):
+        """Writes the weights to a text file, one "name value" pair per line."""
+        f = open(filename, 'w')
+        try:
+            for name in EvaluationWeights.NAMES:
+                f.write("%s %r\n" % (name, getattr(self, name)))
+        finally:
+            f.close()
+
+    @staticmethod
+    def Load(filename):
+        """Reads weights written by Save.  Any that are missing keep their defaults."""
+        result = EvaluationWeights()
+        f = open(filename, 'r')
+        try:
+            for line in f:
+                words = line.split()
+                if len(words) == 2 and words[0] in EvaluationWeights.DEFAULTS:
+                    setattr(result, words[0], float(words[1]))
+        finally:
+            f.close()
+        return result
+
+    def __str__(self):
+        return ", ".join(["%s=%g" % (name, getattr(self, name)) for name in EvaluationWeights.NAMES])
+
+
 class NarmerEngine(TiuEngine):
     """An engine that uses a simple objective function to choose from the avialable moves, with no lookahead."""
-    def __init__(self):
+    def __init__(self, weights = None):
         TiuEngine.__init__(self)
         self.name = 'Narmer engine'
+        if weights is None:
+            weights = EvaluationWeights()
+        self.weights = weights
 
     def StartAnalysis(self, game):
         TiuEngine.StartAnalysis(self, game)
@@ -18,9 +80,10 @@ class NarmerEngine(TiuEngine):
             
         self.SortForActivePlayer(game, self.moves)
         
-        print "Final move list:"
-        for move in self.moves:
-            print move, move.oValue
+        if self.verbose:
+            print "Final move list:"
+            for move in self.moves:
+                print move, move.oValue
 
     def SortForActivePlayer(self, game, moves):
         moves.sort(key=lambda m: m.oValue, reverse=(game.activePlayer == PLAYER_SILVER))
@@ -35,28 +98,30 @@ class NarmerEngine(TiuEngine):
         try:
             game.FireLaser(move)
             move.oValue = self.EvaluatePosition(game)
-            print move, move.oValue
+            if self.verbose:
+                print move, move.oValue
         finally:
             game.UndoAndPopLastMove()
 
     def EvaluatePosition(self, game):
+        w = self.weights
         result = 0
         # Run through all the pieces.
         for piece in allPieces(game.board):
             result += self.EvaluatePiece(game, piece)
                     
         # Give a bonus for having laser-guiding pyramids (up to 2).
-        result += min((self.laserPyramids[PLAYER_SILVER], 2)) * 3
-        result -= min((self.laserPyramids[PLAYER_RED], 2)) * 3
+        result += min((self.laserPyramids[PLAYER_SILVER], 2)) * w.laserPyramid
+        result -= min((self.laserPyramids[PLAYER_RED], 2)) * w.laserPyramid
 
         # Give a bonus for having a guard piece.
         # (Particularly useful for keeping the "guard pyramid" in place, but tolerates other pieces playing that role.)
-        result += self.hasGuard[PLAYER_SILVER] * 4
-        result -= self.hasGuard[PLAYER_RED] * 4
+        result += self.hasGuard[PLAYER_SILVER] * w.guard
+        result -= self.hasGuard[PLAYER_RED] * w.guard
 
         # Give a bonus for pieces around the Pharaoh of own color, negative for opponent's.
-        result += self.PharaohAdjacentFriends(game, PLAYER_SILVER) * 3
-        result -= self.PharaohAdjacentFriends(game, PLAYER_RED) * 3
+        result += self.PharaohAdjacentFriends(game, PLAYER_SILVER) * w.pharaohFriend
+        result -= self.PharaohAdjacentFriends(game, PLAYER_RED) * w.pharaohFriend
                 
         # See if the opponent's laser will immediately hit anything.
         hitPiece = game.FindLaserPathEnd(game.FindLaserPath(1 - game.activePlayer))
@@ -65,11 +130,12 @@ class NarmerEngine(TiuEngine):
             if hitPiece.color != game.activePlayer:
                 # Lost one of theirs - it's annoying, so that's good, but not worth full value,
                 # because they'll probably avoid it.
-                hitValue *= 0.45
+                hitValue *= w.hitFactor
                 # Capping the total value seems to make sense in practice - it's not worth hundreds of points
                 # to force the opponent to avoid hitting their own Pharaoh, even if it will win a game
-                # against a novice.
-                hitValue = min(hitValue, 1.5)
+                # against a novice.  The cap is on the size, whichever color is to move, so a position and its
+                # mirror image are worth the same to each side.
+                hitValue = max(-w.hitCap, min(hitValue, w.hitCap))
             result -= hitValue
         return result
 
@@ -108,19 +174,26 @@ class NarmerEngine(TiuEngine):
     def PharaohAdjacentFriends(self, game, color):
         """Returns the count of friendly pieces adjacent to this one; enemies are negative friends.
 
-        For this purpose, diagonals only count 1/3,
+        For this purpose, diagonals only count 1/3 (by default),
         and friendlies only count if they're oriented away from the opponent's laser row."""
-        result = 0
+        (orthogonal, diagonal) = self.PharaohNeighborCounts(game, color)
+        return orthogonal + diagonal * self.weights.diagonal
+
+    def PharaohNeighborCounts(self, game, color):
+        """Returns the net friendly pieces next to the Pharaoh, as a tuple of (orthogonal, diagonal) counts.
+
+        See PharaohAdjacentFriends for what counts as a friend."""
+        counts = [0, 0]
         phar = game.Pharaoh(color)
         if phar and phar.square:
             pSquare = phar.square
             for square in pSquare.GetNeighbors(game.board):
                 if square.piece:
                     if square.row == pSquare.row or square.col == pSquare.col:
-                        weight = 1
+                        which = 0
                     else:
                         # Diagonal.
-                        weight = 0.33
+                        which = 1
                         
                     if square.piece.color == color:
                         # Friendly piece.
@@ -130,28 +203,83 @@ class NarmerEngine(TiuEngine):
                             deflection = [180]
                         if isinstance(square.piece, Djed):
                             deflection.append((deflection[0] + 180) % 360)
-                        if square.piece.rotation == deflection:
-                            result += weight
-                            #print "+", weight
+                        if square.piece.rotation in deflection:
+                            counts[which] += 1
                     else:
                         # Enemy piece.
-                        result -= weight
-                        #print "-", weight
-        return result
+                        counts[which] -= 1
+        return tuple(counts)
         
     def EvaluateMaterial(self, piece):
         """Return the value of this piece to its owner."""
+        kind = self.MaterialKind(piece)
+        if kind:
+            return getattr(self.weights, kind)
+        else:
+            return 0
+
+    def MaterialKind(self, piece):
+        """Returns the name of the weight giving this piece's material value, or None if it has none."""
         if isinstance(piece, Obelisk):
             if piece.stacked:
-                return 4
+                return 'stackedObelisk'
             else:
-                return 2
+                return 'obelisk'
         elif isinstance(piece, Pyramid):
-            return 4
+            return 'pyramid'
         elif isinstance(piece, Pharaoh):
-            return 1000
+            return 'pharaoh'
         else:
-            return 0
+            return None
+
+    # Names of the terms returned by EvaluationFeatures.
+    MATERIAL_KINDS = ['stackedObelisk', 'obelisk', 'pyramid', 'pharaoh']
+    FEATURE_NAMES = MATERIAL_KINDS + ['laserPyramid', 'guard', 'pharaohOrthogonal', 'pharaohDiagonal'] \
+        + ['hit_' + kind for kind in MATERIAL_KINDS] + ['hitOpponent']
+
+    def EvaluationFeatures(self, game):
+        """Returns the raw terms EvaluatePosition combines, as a list in FEATURE_NAMES order.
+
+        All are Silver minus Red, except the hit terms: hit_* is the color factor of the piece the
+        opponent's laser would hit (if of that kind), and hitOpponent is 1 if that piece is the opponent's own.
+        Used for tuning the weights against a dataset, so it must stay in step with EvaluatePosition."""
+        self.laserPyramids = [0, 0]
+        self.hasGuard = [0, 0]
+        material = dict.fromkeys(NarmerEngine.MATERIAL_KINDS, 0)
+        for piece in allPieces(game.board):
+            self.EvaluatePiece(game, piece)
+            kind = self.MaterialKind(piece)
+            if kind:
+                material[kind] += self.GetColorFactor(piece.color)
+        result = [material[kind] for kind in NarmerEngine.MATERIAL_KINDS]
+
+        result.append(min((self.laserPyramids[PLAYER_SILVER], 2)) - min((self.laserPyramids[PLAYER_RED], 2)))
+        result.append(self.hasGuard[PLAYER_SILVER] - self.hasGuard[PLAYER_RED])
+        silverNeighbors = self.PharaohNeighborCounts(game, PLAYER_SILVER)
+        redNeighbors = self.PharaohNeighborCounts(game, PLAYER_RED)
+        result.append(silverNeighbors[0] - redNeighbors[0])
+        result.append(silverNeighbors[1] - redNeighbors[1])
+
+        hits = dict.fromkeys(NarmerEngine.MATERIAL_KINDS, 0)
+        hitOpponent = 0
+        hitPiece = game.FindLaserPathEnd(game.FindLaserPath(1 - game.activePlayer))
+        if hitPiece:
+            kind = self.MaterialKind(hitPiece)
+            if kind:
+                hits[kind] = self.GetColorFactor(hitPiece.color)
+            hitOpponent = int(hitPiece.color != game.activePlayer)
+        result.extend([hits[kind] for kind in NarmerEngine.MATERIAL_KINDS])
+        result.append(hitOpponent)
+        return result
 
     def GetMove(self):
         return self.moves[0]
+
+    def GetStats(self):
+        result = TiuEngine.GetStats(self)
+        if self.moves:
+            result['depth'] = 1
+            result['score'] = self.moves[0].oValue
+            result['nodes'] = len(self.moves)
+            result['pv'] = [str(self.moves[0]).split()[0]]
+        return result
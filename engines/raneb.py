@@ -8,20 +8,34 @@ class RanebEngine(MenesEngine):
     # Think for at most this many seconds after the opponent finishes his laser phase.
     MAX_ANALYSIS_BATCH_TIME = 4
 
-    # Evaluating this many moves in one session results in a very large hunk of allocated memory.
-    # That then slows things down... it's best to put an overall cap on it.
-    MAX_MOVES_EVALUATED = 100000
+    # Keep the search tree and position cache to about this many bytes, unless told otherwise.
+    MEMORY_BUDGET = 256 * 1024 * 1024
+
+    # Rough bytes held by each move in the tree (the Move, its attributes, and its slot in a list),
+    # and by each entry in the position cache.
+    BYTES_PER_MOVE = 1200
+    BYTES_PER_CACHE_ENTRY = 200
+
+    # On going over budget, prune back to this fraction of it, so we don't prune again straight away.
+    PRUNE_TARGET = 0.75
 
     # When we're "deepening" the tree, only examine this fraction of the moves at any given level.
     DEEP_TREE_SLOPE = 0.3
 
-    def __init__(self):
-        MenesEngine.__init__(self)
+    def __init__(self, weights = None):
+        MenesEngine.__init__(self, weights)
         self.name = 'Raneb engine (in development)'
         self.deepening = False
+        self.alphaBeta = False  # Grows its own tree instead.
+        self.maxTime = RanebEngine.MAX_ANALYSIS_BATCH_TIME  # None to think until stopped.
+        self.memoryBudget = RanebEngine.MEMORY_BUDGET  # In bytes; None for no limit.
+        self.treeMoves = 0  # Moves in the tree, kept up to date as it grows.
+        self.prunedMoves = 0
+        self.budgetApplies = False
 
     def StartAnalysis(self, game):
         MenesEngine.StartAnalysis(self, game)
+        self.treeMoves = len(self.moves)
         self.hintMove = None
         self.hintSquare = None
 
@@ -30,13 +44,16 @@ class RanebEngine(MenesEngine):
         for move in result:
             # Add our default properties.
             move.maxExploredDepth = 0
+            move.treeSize = 0  # Moves in the tree under this one.
+        self.treeMoves += len(result)
         return result
 
-    def ContinueAnalysis(self, onOwnTime):
+    def AnalyzeBatch(self, onOwnTime):
         if self.FinishedAnalyzing(onOwnTime):
             return False  # silently
         
         self.batchStartTime = time.clock()
+        self.KeepWithinBudget()
 
         # Don't start deepening until we've examined at least 2 plies out.
         # Otherwise we commit suicide fairly often.
@@ -48,6 +65,8 @@ class RanebEngine(MenesEngine):
         if len(self.moves) > 0:
             if self.hintMove:
                 # Just explore the hinted move.
+                if not onOwnTime:
+                    self.ponderMove = self.hintMove
                 self.EvaluateObjective(self.game, self.hintMove, self.hintMove.exploredDepth + 1)
             elif self.hintSquare:
                 # Just explore the moves originating from the hint square.
@@ -55,6 +74,13 @@ class RanebEngine(MenesEngine):
                 for move in self.moves:
                     if move.fromSquare == self.hintSquare and not self.IsBreakTime():
                         self.EvaluateObjective(self.game, move, minDepth + 1)
+            elif not onOwnTime and self.MinExploredDepth(self.moves) >= 2:
+                # Pondering: explore the opponent's expected move, alternately deepening and widening.
+                self.ponderMove = self.moves[0]
+                if self.deepening:
+                    self.EvaluateObjective(self.game, self.ponderMove, self.ponderMove.maxExploredDepth + 1)
+                else:
+                    self.EvaluateObjective(self.game, self.ponderMove, self.ponderMove.exploredDepth + 1)
             elif self.deepening:
                 # Explore the best move more deeply.
                 self.EvaluateObjective(self.game, self.moves[0], self.moves[0].maxExploredDepth + 1)
@@ -68,13 +94,15 @@ class RanebEngine(MenesEngine):
         self.SortForActivePlayer(self.game, self.moves)
 
         self.elapsedTime += (time.clock() - self.batchStartTime)
+        self.MaybeSaveCheckpoint()
 
         if self.FinishedAnalyzing(onOwnTime):
-            print "Final move list:"
-            for move in self.moves:
-                print move, move.oValue
-            print "Analyzed %d moves to a depth of %d in %f seconds." % (self.moveCount, self.MinExploredDepth(self.moves), self.elapsedTime)
-            print "Deepest analysis: %d plies." % (self.MaxExploredDepth(self.moves))
+            if self.verbose:
+                print "Final move list:"
+                for move in self.moves:
+                    print move, move.oValue
+                print "Analyzed %d moves to a depth of %d in %f seconds." % (self.moveCount, self.MinExploredDepth(self.moves), self.elapsedTime)
+                print "Deepest analysis: %d plies." % (self.MaxExploredDepth(self.moves))
             return False
         else:
             return True  # Need more time.
@@ -93,15 +121,115 @@ class RanebEngine(MenesEngine):
             self.hintMove = self.FindMoveInList(move)
 
     def FinishedAnalyzing(self, onOwnTime):
-        return onOwnTime and ( \
-            (time.clock() - self.moveStart) >= RanebEngine.MAX_ANALYSIS_BATCH_TIME and self.MinExploredDepth(self.moves) >= 2 \
-            ) or self.moveCount > RanebEngine.MAX_MOVES_EVALUATED
+        return self.bookMove != None or onOwnTime and self.maxTime != None and ( \
+            (time.clock() - self.moveStart) >= self.maxTime and self.MinExploredDepth(self.moves) >= 2 \
+            )
+
+    def ResumeAnalysis(self, filename, game = None):
+        game = MenesEngine.ResumeAnalysis(self, filename, game)
+        self.treeMoves = len(self.moves)
+        return game
 
     def TakeNextMove(self, move):
         MenesEngine.TakeNextMove(self, move)
+        self.treeMoves = self.TreeSize(self.moves)
         self.hintMove = None
         self.hintSquare = None
 
+    def GetStats(self):
+        result = MenesEngine.GetStats(self)
+        if self.moves:
+            result['maxDepth'] = self.MaxExploredDepth(self.moves)
+        result['memory'] = self.MemoryUsed()
+        result['memoryBudget'] = self.memoryBudget
+        result['treeMoves'] = self.treeMoves
+        result['prunedMoves'] = self.prunedMoves
+        return result
+
+    # Memory
+
+    def MemoryUsed(self):
+        """Returns the approximate number of bytes held in the search tree and position cache."""
+        return self.treeMoves * RanebEngine.BYTES_PER_MOVE + len(self.cache) * RanebEngine.BYTES_PER_CACHE_ENTRY
+
+    def TreeSize(self, moveList):
+        """Returns the number of moves in moveList and the trees under them."""
+        return len(moveList) + sum([move.treeSize for move in moveList])
+
+    def IsBreakTime(self):
+        # Also stop growing the tree when it's over budget, so it can be pruned between batches.
+        return MenesEngine.IsBreakTime(self) \
+               or (self.budgetApplies and self.MemoryUsed() > self.memoryBudget)
+
+    def KeepWithinBudget(self):
+        """If the tree and cache are over the memory budget, prunes them back below it."""
+        # Always allow the 2 plies we need to avoid blunders, whatever the budget.
+        self.budgetApplies = self.memoryBudget != None and self.MinExploredDepth(self.moves) >= 2
+        if not self.budgetApplies or self.MemoryUsed() <= self.memoryBudget:
+            return
+        target = self.memoryBudget * RanebEngine.PRUNE_TARGET
+        # Cache entries are cheaper to lose than subtrees, so give the cache at most a quarter of the room.
+        self.PruneCache(target / 4)
+        self.PruneTree(target - len(self.cache) * RanebEngine.BYTES_PER_CACHE_ENTRY)
+        if self.verbose:
+            print "Pruned to %d moves and %d cache entries." % (self.treeMoves, len(self.cache))
+
+    def PruneCache(self, maxBytes):
+        """Drops the shallowest entries from the position cache until it fits in maxBytes."""
+        while self.cache and len(self.cache) * RanebEngine.BYTES_PER_CACHE_ENTRY > maxBytes:
+            shallowest = min([depth for (value, depth) in self.cache.itervalues()])
+            self.cache = dict([(key, entry) for (key, entry) in self.cache.iteritems() if entry[1] > shallowest])
+
+    def PruneTree(self, maxBytes):
+        """Throws away the least valuable subtrees until the tree fits in maxBytes.
+
+        The candidates are the moves off the principal variation at each level along it, which between
+        them hold the rest of the tree.  The most shallowly explored go first, and of those, the worst.
+        If that's not enough, the principal variation itself is cut short, from the far end.
+        A pruned move keeps its score and explored depth."""
+        candidates = []
+        pv = self.PrincipalVariation()
+        for moveList in [self.moves] + [move.nextMoves for move in pv if hasattr(move, 'nextMoves')]:
+            for (rank, move) in enumerate(moveList[1:]):
+                if move.treeSize:
+                    candidates.append((move.exploredDepth, -rank, move))
+        candidates.sort(key = lambda c: c[:2])
+
+        for (depth, rank, move) in candidates:
+            if self.treeMoves * RanebEngine.BYTES_PER_MOVE <= maxBytes:
+                break
+            self.treeMoves -= move.treeSize
+            self.PruneMove(move, move.treeSize)
+        self.UpdatePrincipalVariationSizes(pv)
+
+        removed = 0  # From the part of the principal variation already cut, so still counted in the sizes above it.
+        for move in reversed(pv):
+            if self.treeMoves * RanebEngine.BYTES_PER_MOVE <= maxBytes:
+                break
+            if hasattr(move, 'nextMoves'):
+                size = move.treeSize - removed
+                self.treeMoves -= size
+                removed += size
+                self.PruneMove(move, size)
+        self.UpdatePrincipalVariationSizes(pv)
+
+    def PruneMove(self, move, size):
+        """Drops the tree under move, which holds size moves."""
+        self.prunedMoves += size
+        del move.nextMoves
+        move.treeSize = 0
+        move.maxExploredDepth = move.exploredDepth
+
+    def UpdatePrincipalVariationSizes(self, pv):
+        """Brings treeSize and maxExploredDepth up to date along pv after pruning below it, and recounts the tree."""
+        for move in reversed(pv):
+            if hasattr(move, 'nextMoves'):
+                move.treeSize = self.TreeSize(move.nextMoves)
+                move.maxExploredDepth = max(move.exploredDepth, 1 + self.MaxExploredDepth(move.nextMoves))
+            else:
+                move.maxExploredDepth = move.exploredDepth
+        self.treeMoves = self.TreeSize(self.moves)
+
     def MaxExploredDepth(self, moveList):
         """Returns the largest maxExploredDepth of any move in moveList."""
         return max(map(lambda x: x.maxExploredDepth, moveList))
@@ -133,5 +261,6 @@ class RanebEngine(MenesEngine):
         
         if hasattr(move, 'nextMoves'):
             move.maxExploredDepth = max(move.maxExploredDepth, 1 + self.MaxExploredDepth(move.nextMoves))
+            move.treeSize = self.TreeSize(move.nextMoves)
         else:
             move.maxExploredDepth = max(move.maxExploredDepth, move.exploredDepth)
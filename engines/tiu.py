@@ -9,9 +9,15 @@ class TiuEngine(KhetEngine):
     def StartAnalysis(self, game):
         self.game = game
         self.moves = self.EnumerateMoves(game)
+        self.bookMove = self.FindBookMove(game, self.moves)
+        if self.bookMove:
+            self.moves = [self.bookMove]
 
     def TakeNextMove(self, move):
         self.StartAnalysis(self.game)
 
     def GetMove(self):
-        return random.choice(self.moves)
+        if self.moves:
+            return random.choice(self.moves)
+        else:
+            return None
@@ -0,0 +1,423 @@
+"""khetAnalysisServer
+
+Serves position analysis to several clients at once - review tools, bots, and so on - over a local socket.
+
+Jobs are dispatched to a fixed pool of engine worker processes, and progress is streamed back to
+the client each time a search gets deeper.  Finished results are cached by position key, so repeated
+requests for the same position are answered immediately, if the cached search went as far as they ask.
+A load generator is built in, for measuring throughput and latency.
+
+Usage:
+    python khetAnalysisServer.py serve [--port N] [--workers N] [--engine NAME]
+    python khetAnalysisServer.py loadtest [--connect HOST:PORT] [--clients N] [--jobs N]
+
+Commands, one per line, sent to the server:
+    analyze <job> [depth <plies>] [movetime <ms>] [nodes <count>] [moves <move> ...]
+                                Analyze the Classic setup followed by the given moves, within the limits.
+    cancel <job>                Abandon a job, whether it's running or still waiting for a worker.
+
+Replies:
+    info <job> depth <plies> score <score> nodes <count> nps <count> time <ms> pv <move> ...
+    result <job> bestmove <move> score <score> depth <plies> nodes <count> cached <0|1>
+    cancelled <job>
+    error <job> <message>
+
+Job names are chosen by the client, and only need to be unique among its outstanding jobs.
+Moves and info fields are as in khetProtocol."""
+
+import collections
+import multiprocessing
+import optparse
+import Queue
+import random
+import socket
+import SocketServer
+import threading
+import time
+
+from khetGame import *
+from khetMatch import LegalMoves
+from khetProtocol import ENGINES, DEFAULT_ENGINE, MoveText, ParseGo, FormatInfo
+
+DEFAULT_PORT = 7467
+
+# Most results kept in the cache; the least recently used are dropped first.
+CACHE_SIZE = 100000
+
+
+def WorkerMain(conn, engineName, cancelEvent):
+    """The body of a worker process: analyzes jobs received on conn, sending progress and results back.
+
+    Jobs arrive as (serial, moves, depth, moveTime, nodes); None means exit.
+    Setting cancelEvent stops the current job early."""
+    engine = ENGINES[engineName]()
+    engine.verbose = False
+    engine.book = None  # Jobs ask for a search within their limits, not a book move.
+    engine.moveStats = None  # Keeps results the same whether or not there's a khet.stats, so they can be cached.
+    while True:
+        job = conn.recv()
+        if job == None:
+            break
+        (serial, moves, depth, moveTime, nodes) = job
+
+        game = Game()
+        game.TakeTurns(moves)
+        if game.IsOver():
+            conn.send(('result', serial, None, {'depth': 0, 'score': 0, 'nodes': 0, 'time': 0, 'pv': []}))
+            continue
+
+        deepest = [-1]
+        def OnInfo(stats):
+            if stats['depth'] > deepest[0]:
+                deepest[0] = stats['depth']
+                conn.send(('info', serial, stats))
+
+        move = engine.AnalyzeWithLimits(game, depth, moveTime, nodes, cancelEvent.is_set, OnInfo, 0.1)
+        if cancelEvent.is_set():
+            conn.send(('cancelled', serial))
+        else:
+            conn.send(('result', serial, move and MoveText(move), engine.GetStats()))
+
+
+class AnalysisJob:
+    def __init__(self, client, name, moves, key, depth, moveTime, nodes):
+        self.client = client
+        self.name = name
+        self.moves = moves
+        self.key = key
+        self.depth = depth
+        self.moveTime = moveTime
+        self.nodes = nodes
+        self.cancelled = False
+
+
+class WorkerSlot:
+    """One engine worker process, plus the thread that feeds it jobs and relays its replies."""
+    def __init__(self, server, engineName):
+        self.server = server
+        self.conn, childConn = multiprocessing.Pipe()
+        self.cancelEvent = multiprocessing.Event()
+        self.process = multiprocessing.Process(target = WorkerMain, args = (childConn, engineName, self.cancelEvent))
+        self.process.daemon = True
+        self.process.start()
+        self.currentJob = None
+        self.serial = 0
+
+        self.thread = threading.Thread(target = self.Run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def Run(self):
+        while True:
+            job = self.server.jobs.get()
+            if job == None:
+                self.conn.send(None)
+                break
+
+            # Claim the job before checking for cancellation; see Cancel.
+            self.currentJob = job
+            self.cancelEvent.clear()
+            if job.cancelled:
+                self.currentJob = None
+                job.client.Send("cancelled %s" % job.name)
+                job.client.JobFinished(job)
+                continue
+            # An identical job may have finished while this one was waiting.
+            cached = self.server.CacheLookup(job)
+            if cached:
+                self.currentJob = None
+                self.server.SendResult(job, cached[0], cached[1], True)
+                continue
+
+            self.serial += 1
+            self.conn.send((self.serial, job.moves, job.depth, job.moveTime, job.nodes))
+            while True:
+                message = self.conn.recv()
+                if message[0] == 'info':
+                    job.client.Send("info %s %s" % (job.name, FormatInfo(message[2])[len("info "):]))
+                else:
+                    break
+            self.currentJob = None
+
+            if message[0] == 'result':
+                self.server.CacheStore(job, message[2], message[3])
+                self.server.SendResult(job, message[2], message[3], False)
+            else:
+                job.client.Send("cancelled %s" % job.name)
+                job.client.JobFinished(job)
+
+    def Cancel(self, job):
+        """Stops the given job if this worker is running it."""
+        if self.currentJob is job:
+            self.cancelEvent.set()
+
+
+class ClientHandler(SocketServer.StreamRequestHandler):
+    """Handles one client connection: reads its commands, and sends replies from any thread."""
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.sendLock = threading.Lock()
+        self.jobs = {}
+
+    def Send(self, line):
+        self.sendLock.acquire()
+        try:
+            try:
+                self.wfile.write(line + "\n")
+                self.wfile.flush()
+            except socket.error:
+                pass  # The client's gone; its jobs will be cancelled.
+        finally:
+            self.sendLock.release()
+
+    def JobFinished(self, job):
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+
+    def handle(self):
+        try:
+            for line in iter(self.rfile.readline, ''):
+                words = line.split()
+                if len(words) < 2:
+                    continue
+                (command, name) = words[:2]
+                if command == 'analyze':
+                    self.Analyze(name, words[2:])
+                elif command == 'cancel':
+                    if name in self.jobs:
+                        self.server.Cancel(self.jobs[name])
+                else:
+                    self.Send("error %s unknown command %s" % (name, command))
+        except socket.error:
+            pass
+        for job in self.jobs.values():
+            self.server.Cancel(job)
+
+    def Analyze(self, name, words):
+        if 'moves' in words:
+            limitWords = words[:words.index('moves')]
+            moves = words[words.index('moves') + 1:]
+        else:
+            limitWords = words
+            moves = []
+        try:
+            (depth, moveTime, nodes) = ParseGo(limitWords)
+            game = Game()
+            game.TakeTurns(moves)
+        except Exception, e:
+            self.Send("error %s bad request: %s" % (name, e))
+            return
+
+        job = AnalysisJob(self, name, moves, game.positionKey, depth, moveTime, nodes)
+        self.jobs[name] = job
+        self.server.Submit(job)
+
+
+class AnalysisServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Accepts analysis jobs from any number of clients, and runs them on a pool of worker processes."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers = None, engineName = DEFAULT_ENGINE):
+        SocketServer.TCPServer.__init__(self, address, ClientHandler)
+        self.jobs = Queue.Queue()
+        self.cache = collections.OrderedDict()
+        self.cacheLock = threading.Lock()
+        self.cacheHits = 0
+        self.jobsSubmitted = 0
+        if workers == None:
+            workers = multiprocessing.cpu_count()
+        self.workers = [WorkerSlot(self, engineName) for i in range(workers)]
+
+    def Submit(self, job):
+        self.jobsSubmitted += 1
+        cached = self.CacheLookup(job)
+        if cached:
+            self.SendResult(job, cached[0], cached[1], True)
+        else:
+            self.jobs.put(job)
+
+    def Cancel(self, job):
+        # Mark it first, so a worker that's just picking it up will see it.
+        job.cancelled = True
+        for worker in self.workers:
+            worker.Cancel(job)
+
+    def SendResult(self, job, bestMove, stats, cached):
+        if cached:
+            self.cacheHits += 1
+        job.client.Send("result %s bestmove %s score %g depth %d nodes %d cached %d" %
+                        (job.name, bestMove or "none", stats['score'], stats['depth'], stats['nodes'], int(cached)))
+        job.client.JobFinished(job)
+
+    def CacheLookup(self, job):
+        """Returns a cached (bestMove, stats) that satisfies the job, or None.
+
+        A result satisfies a job if it went as far as any of the job's limits - the depth, the time, or the nodes -
+        since the job would have stopped there; or if it came from a job with the same limits."""
+        self.cacheLock.acquire()
+        try:
+            entry = self.cache.get(job.key)
+            if entry == None:
+                return None
+            (bestMove, stats, limits) = entry
+            if limits != (job.depth, job.moveTime, job.nodes) \
+               and not (job.depth != None and stats['depth'] >= job.depth) \
+               and not (job.moveTime != None and stats['time'] >= job.moveTime) \
+               and not (job.nodes != None and stats['nodes'] >= job.nodes):
+                return None
+            # Move it to the most-recently-used end.
+            del self.cache[job.key]
+            self.cache[job.key] = entry
+            return (bestMove, stats)
+        finally:
+            self.cacheLock.release()
+
+    def CacheStore(self, job, bestMove, stats):
+        """Caches a job's result, along with the limits it was searched under."""
+        self.cacheLock.acquire()
+        try:
+            old = self.cache.pop(job.key, None)
+            if old and old[1]['depth'] > stats['depth']:
+                self.cache[job.key] = old  # Keep the deeper result.
+            else:
+                self.cache[job.key] = (bestMove, stats, (job.depth, job.moveTime, job.nodes))
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last = False)
+        finally:
+            self.cacheLock.release()
+
+    def Close(self):
+        """Stops accepting connections and shuts down the workers."""
+        self.shutdown()
+        self.server_close()
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.thread.join()
+            worker.process.join()
+
+
+# Load generation
+
+def RandomPositions(count, maxPlies, rng):
+    """Returns count move lists, each reaching a position a random number of random moves into a game."""
+    result = []
+    for i in range(count):
+        game = Game()
+        for ply in range(rng.randint(0, maxPlies)):
+            if game.IsOver():
+                break
+            move = rng.choice(LegalMoves(game))
+            move.TakeCompleteTurn(game)
+        result.append([MoveText(m) for m in game.moveStack])
+    return result
+
+def Percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+def RunLoadTest(address, clients = 8, jobsPerClient = 20, positions = 40, limits = "depth 2", seed = 0):
+    """Has several clients submit jobs at once, each waiting for one result before sending the next.
+
+    Positions are drawn from a limited pool, so some requests repeat.
+    Returns a dictionary of throughput and latency (in seconds) figures."""
+    rng = random.Random(seed)
+    pool = RandomPositions(positions, 8, rng)
+    latencies = []
+    cachedCount = [0]
+    lock = threading.Lock()
+
+    def Client(index):
+        clientRng = random.Random(seed * 1000 + index)
+        sock = socket.create_connection(address)
+        f = sock.makefile('rw', 0)
+        try:
+            for n in range(jobsPerClient):
+                moves = clientRng.choice(pool)
+                name = "c%dj%d" % (index, n)
+                request = "analyze %s %s" % (name, limits)
+                if moves:
+                    request += " moves " + " ".join(moves)
+                start = time.time()
+                f.write(request + "\n")
+                while True:
+                    words = f.readline().split()
+                    if not words or (words[0] != 'info' and words[1] == name):
+                        break
+                elapsed = time.time() - start
+                lock.acquire()
+                latencies.append(elapsed)
+                if words and words[-2:] == ['cached', '1']:
+                    cachedCount[0] += 1
+                lock.release()
+        finally:
+            f.close()
+            sock.close()
+
+    start = time.time()
+    threads = [threading.Thread(target = Client, args = (i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        'jobs': len(latencies),
+        'seconds': elapsed,
+        'jobsPerSecond': len(latencies) / elapsed,
+        'cachedFraction': float(cachedCount[0]) / max(1, len(latencies)),
+        'p50': Percentile(latencies, 0.5),
+        'p95': Percentile(latencies, 0.95),
+        'p99': Percentile(latencies, 0.99),
+        'max': latencies[-1],
+        }
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog serve|loadtest [options]")
+    parser.add_option("-p", "--port", type = "int", default = DEFAULT_PORT, help = "port to serve on (default %default)")
+    parser.add_option("-w", "--workers", type = "int", default = None, help = "engine processes (default: one per core)")
+    parser.add_option("-e", "--engine", default = DEFAULT_ENGINE, help = "engine to analyze with (default %default)")
+    parser.add_option("--connect", help = "loadtest: HOST:PORT of a running server (default: start one)")
+    parser.add_option("--clients", type = "int", default = 8, help = "loadtest: concurrent clients (default %default)")
+    parser.add_option("--jobs", type = "int", default = 20, help = "loadtest: jobs per client (default %default)")
+    parser.add_option("--limits", default = "depth 2", help = "loadtest: limits for each job (default \"%default\")")
+    (options, args) = parser.parse_args()
+    if not args or args[0] not in ('serve', 'loadtest'):
+        parser.error("missing or unknown command")
+    if options.engine not in ENGINES:
+        parser.error("unknown engine %s" % options.engine)
+
+    if args[0] == 'serve':
+        server = AnalysisServer(('localhost', options.port), options.workers, options.engine)
+        print "Serving analysis on port %d with %d workers." % (options.port, len(server.workers))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    else:
+        server = None
+        if options.connect:
+            host, port = options.connect.split(':')
+            address = (host, int(port))
+        else:
+            server = AnalysisServer(('localhost', 0), options.workers, options.engine)
+            address = server.server_address
+            thread = threading.Thread(target = server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            results = RunLoadTest(address, options.clients, options.jobs, limits = options.limits)
+        finally:
+            if server:
+                server.Close()
+        print "%(jobs)d jobs in %(seconds).2f s: %(jobsPerSecond).2f jobs/s, %(cachedFraction).0f%% cached" % \
+            dict(results, cachedFraction = results['cachedFraction'] * 100)
+        print "Latency: p50 %(p50).3f s, p95 %(p95).3f s, p99 %(p99).3f s, max %(max).3f s" % results
+
+
+if __name__ == '__main__':
+    main()
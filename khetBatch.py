@@ -0,0 +1,354 @@
+"""khetBatch
+
+Random playouts of thousands of games at once, with NumPy.
+
+Each board is a row of 80 cells, one byte per square in row-major order (see FromGame for the coding),
+so a batch of games is an array of shape (games, 80).  Every step works on the whole batch: legal
+moves are found as a (games, 80, ACTIONS) mask, one is picked uniformly at random for each game,
+the moves are made, the lasers are traced square by square in lockstep, and hits are resolved.
+Games that have ended are retired from the arrays in bulk after each step.
+
+The rules here are a second implementation of the ones in khetGame, so "check" compares the two
+on positions from random games: the legal moves, and the board after each move and laser.
+
+Usage:
+    python khetBatch.py run -n 4096
+    python khetBatch.py check -n 2000"""
+
+import optparse
+import random
+import time
+
+import numpy
+
+from khetGame import *
+
+
+# Cell coding: 0 for an empty square, or the piece's kind in the low 3 bits, then its color,
+# its rotation / 90 (2 bits), and whether it's a stacked Obelisk.
+KIND_MASK = 7
+COLOR_SHIFT = 3
+ROTATION_SHIFT = 4
+ROTATION_MASK = 3 << ROTATION_SHIFT
+STACKED = 1 << 6
+numCodes = 1 << 7
+
+PHARAOH = 1
+OBELISK = 2
+PYRAMID = 3
+DJED = 4
+kindCodes = {'P': PHARAOH, 'O': OBELISK, 'p': PYRAMID, 'D': DJED}
+pieceClasses = {PHARAOH: Pharaoh, OBELISK: Obelisk, PYRAMID: Pyramid, DJED: Djed}
+
+numSquares = numRows * numCols
+OFF_BOARD = numSquares  # Index of the extra, always-empty column used for neighbors off the edge.
+
+# Actions for each square: a lateral move in each of 8 directions, rotating left or right,
+# and an unstacking move in each direction.
+DIRECTIONS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]  # (row, col) deltas
+ROTATE_LEFT = 8
+ROTATE_RIGHT = 9
+UNSTACK = 10
+ACTIONS = UNSTACK + len(DIRECTIONS)
+
+# Laser directions, as (row, col) deltas.
+LASER_DIRECTIONS = [(-1, 0), (0, 1), (1, 0), (0, -1)]
+laserStarts = {PLAYER_SILVER: (numRows, numCols - 1, 0), PLAYER_RED: (-1, 0, 2)}  # row, col, direction
+
+
+def MakeTables():
+    """Builds the lookup tables the vectorized rules use, from khetGame's own classes where possible."""
+    global neighbors, allowedSquares, reflections, laserRowDeltas, laserColDeltas
+
+    # neighbors[square, direction] is the neighboring square, or OFF_BOARD.
+    neighbors = numpy.empty((numSquares, len(DIRECTIONS)), numpy.intp)
+    for row in allRows:
+        for col in allCols:
+            for (d, (rowDelta, colDelta)) in enumerate(DIRECTIONS):
+                if IsLegalSquare(row + rowDelta, col + colDelta):
+                    neighbors[row * numCols + col, d] = (row + rowDelta) * numCols + col + colDelta
+                else:
+                    neighbors[row * numCols + col, d] = OFF_BOARD
+
+    # allowedSquares[color, square] says whether that color's pieces may stand there.
+    board = Game().board
+    allowedSquares = numpy.zeros((2, numSquares + 1), bool)
+    for square in allSquares(board):
+        for color in players:
+            allowedSquares[color, square.row * numCols + square.col] = square.color in (PLAYER_NONE, color)
+
+    # reflections[cell code, laser direction] is the new direction, or -1 if the piece is hit.
+    reflections = numpy.empty((numCodes, len(LASER_DIRECTIONS)), numpy.int8)
+    for code in range(numCodes):
+        for (d, (rowDelta, colDelta)) in enumerate(LASER_DIRECTIONS):
+            if code == 0 or code & KIND_MASK not in pieceClasses:
+                reflections[code, d] = d
+                continue
+            piece = PieceFromCode(code)
+            (colOut, rowOut) = piece.Reflects((colDelta, rowDelta))
+            if (colOut, rowOut) == (0, 0):
+                reflections[code, d] = -1
+            else:
+                reflections[code, d] = LASER_DIRECTIONS.index((rowOut, colOut))
+
+    laserRowDeltas = numpy.array([rowDelta for (rowDelta, colDelta) in LASER_DIRECTIONS])
+    laserColDeltas = numpy.array([colDelta for (rowDelta, colDelta) in LASER_DIRECTIONS])
+
+
+# Converting to and from khetGame
+
+def PieceCode(piece):
+    result = kindCodes[piece.letterCode] | piece.color << COLOR_SHIFT | (piece.rotation / 90) << ROTATION_SHIFT
+    if getattr(piece, 'stacked', False):
+        result |= STACKED
+    return result
+
+def PieceFromCode(code):
+    kind = code & KIND_MASK
+    color = (code >> COLOR_SHIFT) & 1
+    if kind == OBELISK:
+        piece = Obelisk(color, bool(code & STACKED))
+        piece.rotation = ((code & ROTATION_MASK) >> ROTATION_SHIFT) * 90
+    else:
+        piece = pieceClasses[kind](color, ((code & ROTATION_MASK) >> ROTATION_SHIFT) * 90)
+    return piece
+
+def FromGame(game):
+    """Returns the game's board as a row of cells."""
+    result = numpy.zeros(numSquares, numpy.uint8)
+    for piece in allPieces(game.board):
+        result[piece.square.row * numCols + piece.square.col] = PieceCode(piece)
+    return result
+
+def MoveAction(move):
+    """Returns (square, action) for a khetGame Move."""
+    square = move.fromSquare.row * numCols + move.fromSquare.col
+    if move.rotateDir == -1:
+        return (square, ROTATE_LEFT)
+    elif move.rotateDir == 1:
+        return (square, ROTATE_RIGHT)
+    d = DIRECTIONS.index((move.toSquare.row - move.fromSquare.row, move.toSquare.col - move.fromSquare.col))
+    if getattr(move, 'unstackObelisk', False):
+        return (square, UNSTACK + d)
+    return (square, d)
+
+
+# The vectorized rules
+
+def LegalMoveMask(cells, active):
+    """Returns a (games, squares, ACTIONS) boolean array of the legal moves for the player to move in each game."""
+    kind = cells & KIND_MASK
+    color = (cells >> COLOR_SHIFT) & 1
+    stacked = (cells & STACKED) != 0
+    own = (cells != 0) & (color == active[:, None])
+
+    padded = numpy.concatenate([cells, numpy.zeros((len(cells), 1), numpy.uint8)], axis = 1)
+    target = padded[:, neighbors]  # (games, squares, directions)
+    targetKind = target & KIND_MASK
+    targetColor = (target >> COLOR_SHIFT) & 1
+    targetEmpty = target == 0
+    onBoard = (neighbors != OFF_BOARD)[None, :, :]
+    allowed = allowedSquares[color[:, :, None], neighbors[None, :, :]] & onBoard
+
+    djed = (kind == DJED)[:, :, None]
+    singleObelisk = ((kind == OBELISK) & ~stacked)[:, :, None]
+    lateral = targetEmpty \
+              | (djed & ((targetKind == OBELISK) | (targetKind == PYRAMID))) \
+              | (singleObelisk & (targetKind == OBELISK) & (targetColor == color[:, :, None]) & ((target & STACKED) == 0))
+    lateral &= own[:, :, None] & allowed
+    unstack = (own & (kind == OBELISK) & stacked)[:, :, None] & allowed & targetEmpty
+    rotateLeft = own & (kind == PYRAMID)
+    rotateRight = own & ((kind == PYRAMID) | (kind == DJED))
+    return numpy.concatenate([lateral, rotateLeft[:, :, None], rotateRight[:, :, None], unstack], axis = 2)
+
+def ChooseRandomMoves(mask, rng):
+    """Picks one legal move uniformly at random for each game.
+
+    Returns (squares, actions, hasMove); games with no legal moves get square 0, action 0, and hasMove False."""
+    flat = mask.reshape((len(mask), -1))
+    counts = flat.sum(axis = 1)
+    picks = (rng.random_sample(len(mask)) * counts).astype(numpy.intp)
+    choices = numpy.argmax(flat.cumsum(axis = 1, dtype = numpy.int16) > picks[:, None], axis = 1)
+    return (choices / ACTIONS, choices % ACTIONS, counts > 0)
+
+def MakeMoves(cells, squares, actions):
+    """Makes one move in each game, in place; doesn't fire the lasers."""
+    games = numpy.arange(len(cells))
+    pieces = cells[games, squares]
+
+    rotating = (actions == ROTATE_LEFT) | (actions == ROTATE_RIGHT)
+    if rotating.any():
+        g = games[rotating]
+        p = pieces[rotating]
+        delta = numpy.where(actions[rotating] == ROTATE_RIGHT, 1, 3)
+        rotation = (((p & ROTATION_MASK) >> ROTATION_SHIFT) + delta) & 3
+        cells[g, squares[rotating]] = (p & ~ROTATION_MASK) | (rotation << ROTATION_SHIFT)
+
+    lateral = ~rotating
+    if lateral.any():
+        g = games[lateral]
+        s = squares[lateral]
+        a = actions[lateral]
+        p = pieces[lateral]
+        unstacking = a >= UNSTACK
+        t = neighbors[s, numpy.where(unstacking, a - UNSTACK, a)]
+        q = cells[g, t]
+        isDjed = (p & KIND_MASK) == DJED
+
+        # Moving to an empty square leaves it empty, except when unstacking, which leaves a new single
+        # Obelisk (turned like the stack); a Djed swaps with what it moves onto, and an Obelisk stacks onto one.
+        newFrom = numpy.where(unstacking, p & (KIND_MASK | 1 << COLOR_SHIFT | ROTATION_MASK),
+                              numpy.where((q != 0) & isDjed, q, 0))
+        newTo = numpy.where(unstacking, p & ~STACKED,
+                            numpy.where((q != 0) & ~isDjed, p | STACKED, p))
+        cells[g, s] = newFrom
+        cells[g, t] = newTo
+
+def FireLasers(cells, active):
+    """Fires the laser of the player to move in each game, and resolves any hit, in place.
+
+    Returns the winner of each game (-1 if no Pharaoh was hit)."""
+    count = len(cells)
+    games = numpy.arange(count)
+    row = numpy.where(active == PLAYER_SILVER, laserStarts[PLAYER_SILVER][0], laserStarts[PLAYER_RED][0])
+    col = numpy.where(active == PLAYER_SILVER, laserStarts[PLAYER_SILVER][1], laserStarts[PLAYER_RED][1])
+    direction = numpy.where(active == PLAYER_SILVER, laserStarts[PLAYER_SILVER][2], laserStarts[PLAYER_RED][2])
+    hitSquares = numpy.full(count, -1, numpy.intp)
+    live = numpy.ones(count, bool)
+
+    # No path can be longer than visiting every square from every direction.
+    for step in range(numSquares * len(LASER_DIRECTIONS)):
+        row = row + laserRowDeltas[direction]
+        col = col + laserColDeltas[direction]
+        live &= (row >= 0) & (row < numRows) & (col >= 0) & (col < numCols)
+        if not live.any():
+            break
+        square = numpy.where(live, row * numCols + col, 0)
+        newDirection = reflections[cells[games, square], direction]
+        hit = live & (newDirection < 0)
+        hitSquares[hit] = square[hit]
+        live &= ~hit
+        direction = numpy.where(live, newDirection, direction)
+
+    winners = numpy.full(count, -1, numpy.int8)
+    hit = hitSquares >= 0
+    if hit.any():
+        g = games[hit]
+        s = hitSquares[hit]
+        p = cells[g, s]
+        cells[g, s] = numpy.where((p & STACKED) != 0, p & ~STACKED, 0)
+        pharaoh = (p & KIND_MASK) == PHARAOH
+        winners[g[pharaoh]] = 1 - ((p[pharaoh] >> COLOR_SHIFT) & 1)
+    return winners
+
+def Simulate(games, maxPlies = 200, seed = None, start = None):
+    """Plays the given number of random games to the end (or maxPlies), all at once.
+
+    Starts from the given Game's position, or Classic.  Returns (winners, plies) as arrays,
+    with winner -1 for a game that hit maxPlies or ran out of moves."""
+    rng = numpy.random.RandomState(seed)
+    if start == None:
+        start = Game()
+    cells = numpy.tile(FromGame(start), (games, 1))
+    active = numpy.full(games, start.activePlayer, numpy.uint8)
+    ids = numpy.arange(games)
+    winners = numpy.full(games, -1, numpy.int8)
+    plies = numpy.zeros(games, numpy.int32)
+
+    ply = 0
+    while len(ids):
+        (squares, actions, hasMove) = ChooseRandomMoves(LegalMoveMask(cells, active), rng)
+        MakeMoves(cells, squares, actions)
+        stepWinners = FireLasers(cells, active)
+        active ^= 1
+        ply += 1
+
+        # Retire the finished games.
+        done = (stepWinners >= 0) | ~hasMove | (ply >= maxPlies)
+        if done.any():
+            winners[ids[done]] = numpy.where(hasMove[done], stepWinners[done], -1)
+            plies[ids[done]] = ply
+            keep = ~done
+            cells = cells[keep]
+            active = active[keep]
+            ids = ids[keep]
+    return (winners, plies)
+
+
+def ScalarWinner(game):
+    """Returns the color that's hit the other's Pharaoh in a khetGame, or -1."""
+    for color in players:
+        if game.Pharaoh(color).square == None:
+            return 1 - color
+    return -1
+
+def Check(samples, seed = None):
+    """Compares the vectorized rules with khetGame's on positions from random games.
+
+    Returns a list of descriptions of any differences."""
+    rng = random.Random(seed)
+    problems = []
+    game = Game()
+    for i in range(samples):
+        if game.IsOver() or len(game.moveStack) > 150:
+            game = Game()
+        cells = FromGame(game)[None, :]
+        active = numpy.array([game.activePlayer], numpy.uint8)
+
+        mask = LegalMoveMask(cells, active)[0]
+        scalarMoves = []
+        for piece in allPieces(game.board):
+            if piece.color == game.activePlayer:
+                scalarMoves.extend(piece.EnumerateMoves(game.board))
+        expected = set([MoveAction(move) for move in scalarMoves])
+        actual = set(zip(*numpy.nonzero(mask)))
+        if expected != actual:
+            problems.append("%s: moves differ: %s" % ([str(m) for m in game.moveStack],
+                                                       sorted(expected.symmetric_difference(actual))))
+
+        move = rng.choice(scalarMoves)
+        (square, action) = MoveAction(move)
+        MakeMoves(cells, numpy.array([square]), numpy.array([action]))
+        winners = FireLasers(cells, active)
+        move.TakeCompleteTurn(game)
+        if (cells[0] != FromGame(game)).any():
+            problems.append("%s: boards differ after %s" % ([str(m) for m in game.moveStack[:-1]], move))
+            game = Game()
+        elif winners[0] != ScalarWinner(game):
+            problems.append("%s: winners differ after %s" % ([str(m) for m in game.moveStack[:-1]], move))
+    return problems
+
+
+MakeTables()
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog run|check [options]")
+    parser.add_option("-n", "--games", type = "int", default = 4096, help = "games to play (run) or positions to compare (check) (default %default)")
+    parser.add_option("--max-plies", type = "int", default = 200, dest = "maxPlies", help = "longest game (default %default)")
+    parser.add_option("--seed", type = "int", default = None)
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+
+    if args[0] == 'run':
+        start = time.time()
+        (winners, plies) = Simulate(options.games, options.maxPlies, options.seed)
+        elapsed = time.time() - start
+        print "%d games, %d plies in %.2f s: %.1f games/s, %.1f plies/s" % \
+              (options.games, plies.sum(), elapsed, options.games / elapsed, plies.sum() / elapsed)
+        print "Silver won %d, Red won %d, unfinished %d; mean length %.1f plies" % \
+              ((winners == PLAYER_SILVER).sum(), (winners == PLAYER_RED).sum(), (winners < 0).sum(), plies.mean())
+
+    elif args[0] == 'check':
+        problems = Check(options.games, options.seed)
+        for problem in problems[:20]:
+            print problem
+        print "%d positions compared, %d differences." % (options.games, len(problems))
+
+    else:
+        parser.error("unknown command %s" % args[0])
+
+
+if __name__ == '__main__':
+    main()
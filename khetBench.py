@@ -0,0 +1,513 @@
+"""khetBench
+
+Benchmarks for the parts of Khet whose speed matters in bulk.
+
+Usage: python khetBench.py <benchmark> [options]; see --help for the list."""
+
+import optparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from khetGame import *
+from khetMatch import LegalMoves
+import khetPosition
+import khetRecord
+
+
+def RandomGame(rng, maxPlies = 200):
+    """Returns a game played out with random legal moves."""
+    game = Game()
+    while not game.IsOver() and len(game.moveStack) < maxPlies:
+        rng.choice(LegalMoves(game)).TakeCompleteTurn(game)
+    return game
+
+def Report(label, count, seconds, unit, extra = ""):
+    print "%-24s %9d %s in %7.2f s: %10.1f %s/s%s" % (label, count, unit, seconds, count / max(seconds, 1e-9), unit, extra)
+
+
+# Game records
+
+def BenchRecords(options):
+    """Writes an archive of options.games records, then times reading it back at each level of detail."""
+    rng = random.Random(options.seed)
+    pool = [str(RandomGame(rng)) for i in range(options.distinct)]
+    (handle, filename) = tempfile.mkstemp(suffix = '.khet')
+    os.close(handle)
+    try:
+        start = time.time()
+        f = open(filename, 'w')
+        try:
+            khetRecord.WriteGames(f, (pool[i % len(pool)] for i in xrange(options.games)))
+        finally:
+            f.close()
+        megabytes = os.path.getsize(filename) / 1e6
+        Report("write", options.games, time.time() - start, "games", " (%.1f MB)" % megabytes)
+
+        def TimeRead(label, limit, work):
+            f = open(filename, 'r')
+            try:
+                start = time.time()
+                count = 0
+                for record in khetRecord.ReadRecords(f):
+                    if count == limit:
+                        break
+                    work(record)
+                    count += 1
+                elapsed = time.time() - start
+            finally:
+                f.close()
+            Report(label, count, elapsed, "games")
+
+        TimeRead("read headers", None, lambda record: record.headers.get('Result'))
+        TimeRead("parse moves", None, lambda record: record.GetMoves())
+        TimeRead("replay and validate", options.replay, lambda record: record.Replay())
+    finally:
+        os.remove(filename)
+
+
+# Game database
+
+def BenchDatabase(options):
+    """Imports options.replay random games into a new database, then times looking up positions from them."""
+    import shutil
+    import khetDatabase
+    rng = random.Random(options.seed)
+    games = [RandomGame(rng) for i in range(options.distinct)]
+    directory = tempfile.mkdtemp(suffix = '.kdb')
+    (handle, filename) = tempfile.mkstemp(suffix = '.khet')
+    os.close(handle)
+    try:
+        f = open(filename, 'w')
+        try:
+            khetRecord.WriteGames(f, (games[i % len(games)] for i in xrange(options.replay)))
+        finally:
+            f.close()
+
+        database = khetDatabase.GameDatabase(directory, create = True)
+        start = time.time()
+        f = open(filename, 'r')
+        try:
+            database.Import([f], options.processes)
+        finally:
+            f.close()
+        Report("import", len(database), time.time() - start, "games", " (%d positions)" % database.PositionCount())
+
+        keys = []
+        for game in games:
+            keys.extend(game.keyHistory)
+        keys = [rng.choice(keys) for i in range(options.positions)]
+        start = time.time()
+        found = 0
+        for key in keys:
+            found += len(database.Lookup(key))
+        Report("lookup", len(keys), time.time() - start, "positions", " (%.1f games each)" % (found / float(len(keys))))
+        database.Close()
+    finally:
+        os.remove(filename)
+        shutil.rmtree(directory)
+
+
+# Monte Carlo playouts
+
+def BenchPlayouts(options):
+    """Times Khufu's random playouts from the opening, and its whole search loop."""
+    from engines.khufu import KhufuEngine
+    random.seed(options.seed)
+    engine = KhufuEngine()
+    engine.verbose = False
+    engine.book = None
+    game = Game()
+    engine.StartAnalysis(game)
+
+    start = time.time()
+    for i in xrange(options.playouts):
+        engine.Playout(engine.game)
+    elapsed = time.time() - start
+    Report("playouts", options.playouts, elapsed, "playouts", " (%.1f plies each)" % (engine.playoutPlies / float(options.playouts)))
+    Report("playout plies", engine.playoutPlies, elapsed, "plies")
+
+    engine.StartAnalysis(game)
+    start = time.time()
+    for i in xrange(options.playouts):
+        engine.Iterate()
+    Report("search iterations", options.playouts, time.time() - start, "iterations")
+
+
+def BenchBatch(options):
+    """Times the NumPy batch simulator on as many games as the playouts benchmark, to the same ply limit."""
+    import khetBatch
+    from engines.khufu import KhufuEngine
+    start = time.time()
+    (winners, plies) = khetBatch.Simulate(options.playouts, KhufuEngine.PLAYOUT_PLIES, options.seed)
+    elapsed = time.time() - start
+    Report("batch playouts", options.playouts, elapsed, "games", " (%.1f plies each)" % plies.mean())
+    Report("batch plies", plies.sum(), elapsed, "plies")
+
+
+# Move generation
+
+def BenchMoveGeneration(options):
+    """Times generating every move from scratch against the game's cached move lists, along random games with moves taken back."""
+    rng = random.Random(options.seed)
+    positions = 0
+    fullTime = 0
+    cachedTime = 0
+    for i in range(options.distinct):
+        game = Game()
+        while not game.IsOver() and len(game.moveStack) < 200:
+            start = time.time()
+            full = []
+            for piece in allPieces(game.board):
+                if piece.color == game.activePlayer:
+                    full.extend(piece.EnumerateMoves(game.board))
+            fullTime += time.time() - start
+
+            # As in a search: try a move, take it back, then generate again.
+            move = rng.choice(full)
+            move.TakeCompleteTurn(game)
+            game.UndoAndPopLastMove()
+            game.PassToNextPlayer()
+            start = time.time()
+            moves = game.EnumerateMoves()
+            cachedTime += time.time() - start
+            positions += 1
+            rng.choice(moves).TakeCompleteTurn(game)
+    Report("from scratch", positions, fullTime, "positions")
+    Report("cached", positions, cachedTime, "positions")
+
+
+# Search
+
+def SearchPositions(rng, count):
+    """Returns count games a few random plies in, and not over, to search."""
+    games = []
+    while len(games) < count:
+        game = Game()
+        for ply in range(rng.randint(2, 40)):
+            if game.IsOver():
+                break
+            rng.choice(LegalMoves(game)).TakeCompleteTurn(game)
+        if not game.IsOver():
+            games.append(game)
+    return games
+
+def BenchSearch(options):
+    """Searches positions from random games with Menes to options.depth plies, with and without alpha-beta pruning.
+
+    Reports the nodes and time each takes, and checks that both find moves with the same value."""
+    from engines.menes import MenesEngine
+    random.seed(options.seed)
+    games = SearchPositions(random.Random(options.seed), options.searches)
+
+    values = {}
+    for alphaBeta in (False, True):
+        start = time.time()
+        nodes = 0
+        values[alphaBeta] = []
+        for game in games:
+            engine = MenesEngine()
+            engine.verbose = False
+            engine.book = None
+            engine.moveStats = None
+            engine.alphaBeta = alphaBeta
+            move = engine.AnalyzeWithLimits(game, options.depth, None, None)
+            nodes += engine.moveCount
+            values[alphaBeta].append(move.oValue)
+        elapsed = time.time() - start
+        Report(["minimax", "alpha-beta"][alphaBeta], nodes, elapsed, "nodes",
+               " (%.1f ms per search)" % (1000.0 * elapsed / len(games)))
+    agree = len([1 for (a, b) in zip(values[False], values[True]) if a == b])
+    print "%-24s %9d of %d" % ("same best value", agree, len(games))
+
+
+def BenchGarbage(options):
+    """Measures the search's garbage collection settings.
+
+    Has Raneb grow its tree on one position to options.nodes nodes, with pauseGC off and on, comparing the time
+    taken; then has Menes search as for BenchSearch with and without its move pool, counting the moves made."""
+    from engines.menes import MenesEngine
+    from engines.raneb import RanebEngine
+    random.seed(options.seed)
+    games = SearchPositions(random.Random(options.seed), options.searches)
+
+    for pauseGC in (False, True):
+        random.seed(options.seed)  # The same move order, so the same tree.
+        engine = RanebEngine()
+        engine.verbose = False
+        engine.book = None
+        engine.moveStats = None
+        engine.pauseGC = pauseGC
+        engine.maxTime = None
+        start = time.time()
+        engine.AnalyzeWithLimits(games[0], None, None, options.nodes)
+        stats = engine.GetStats()
+        Report(["raneb, gc on", "raneb, gc paused"][pauseGC], stats['nodes'], time.time() - start, "nodes",
+               " (%d in the tree; %.3f s collecting between moves)" % (stats['treeMoves'], stats['gcTime']))
+
+    for pooled in (False, True):
+        start = time.time()
+        nodes = 0
+        allocated = 0
+        for game in games:
+            engine = MenesEngine()
+            engine.verbose = False
+            engine.book = None
+            engine.moveStats = None
+            if not pooled:
+                engine.movePool = None
+            engine.AnalyzeWithLimits(game, options.depth, None, None)
+            nodes += engine.moveCount
+            if pooled:
+                allocated += engine.movePool.allocated
+            else:
+                allocated += engine.moveCount  # Every reply searched was a new Move.
+        Report(["menes, new moves", "menes, pooled moves"][pooled], nodes, time.time() - start, "nodes",
+               " (%d moves created)" % allocated)
+
+
+# Mirror images
+
+def MirrorGame(game):
+    """Returns a new game set up with the mirror image of the game's position, with the other player to move."""
+    values = khetPosition.EncodeValues(game)
+    rotations = [values[khetPosition.numSlots + i / 4] >> (i % 4 * 2) & 3 for i in range(khetPosition.numSlots)]
+    groups = []
+    slot = 0
+    for (color, letterCode, count) in khetPosition.slotKinds:
+        pieces = []
+        for i in range(slot, slot + count):
+            if values[i] == khetPosition.OFF_BOARD:
+                pieces.append((values[i], 0))
+            else:
+                (row, col) = (values[i] >> 4, values[i] & 15)
+                pieces.append(((numRows - 1 - row) << 4 | (numCols - 1 - col), (rotations[i] + 2) % 4))
+        pieces.sort()
+        groups.append(pieces)
+        slot += count
+    # The same kinds come in the same order for each color, so swapping colors swaps the two halves.
+    half = len(groups) / 2
+    pieces = sum(groups[half:] + groups[:half], [])
+
+    mirrored = [square for (square, rotation) in pieces]
+    for i in range(0, len(pieces), 4):
+        mirrored.append(pieces[i][1] | pieces[i + 1][1] << 2 | pieces[i + 2][1] << 4 | pieces[i + 3][1] << 6)
+    mirrored.append(1 - game.activePlayer)
+    return khetPosition.DecodeValues(mirrored)
+
+def CheckMirrorImages(games):
+    """Checks that the position after each move in the games and its mirror image have matching keys, moves and evaluations.
+
+    Returns (positions checked, count whose keys or moves differ, count whose evaluation isn't negated)."""
+    from engines.narmer import NarmerEngine
+    from engines.menes import MenesEngine
+    evaluators = [NarmerEngine(), MenesEngine()]
+    checked = 0
+    keyMismatches = 0
+    evalMismatches = 0
+    for moves in games:
+        game = Game()
+        for move in moves:
+            game.TakeTurns([move])
+            if game.IsOver():
+                break
+            mirror = MirrorGame(game)
+            checked += 1
+            if mirror.positionKey != game.mirrorKey or mirror.mirrorKey != game.positionKey \
+                    or len(LegalMoves(mirror)) != len(LegalMoves(game)):
+                keyMismatches += 1
+            for engine in evaluators:
+                values = []
+                for position in (game, mirror):
+                    engine.laserPyramids = [0, 0]
+                    engine.hasGuard = [0, 0]
+                    values.append(engine.EvaluatePosition(position))
+                if abs(values[0] + values[1]) > 1e-9:
+                    evalMismatches += 1
+                    break
+    return (checked, keyMismatches, evalMismatches)
+
+def BenchSymmetry(options):
+    """Plays options.selfplay games between two copies of Menes, then measures what folding mirror images saves.
+
+    Each game starts with two random plies, for variety.  Counts the distinct positions the games reached by
+    position key and by canonical key, then has a Menes engine with and without foldMirrorImages search each
+    position in turn, to the same depth, keeping its cache from move to move as in play.
+
+    Folding is only sound if a position and its mirror image evaluate to the negation of each other, so first checks
+    that for each position in the self-play games and in options.distinct random ones."""
+    from engines.menes import MenesEngine
+    random.seed(options.seed)
+    rng = random.Random(options.seed)
+
+    def NewEngine(fold):
+        engine = MenesEngine()
+        engine.verbose = False
+        engine.book = None
+        engine.foldMirrorImages = fold
+        return engine
+
+    start = time.time()
+    games = []
+    for i in range(options.selfplay):
+        game = Game()
+        for ply in range(2):
+            rng.choice(LegalMoves(game)).TakeCompleteTurn(game)
+        engines = [NewEngine(True), NewEngine(True)]
+        while not game.IsOver() and len(game.moveStack) < options.plies:
+            engine = engines[game.activePlayer]
+            move = engine.AnalyzeWithLimits(game, 2, None, None)
+            Move.FromString(str(move), game.board).TakeCompleteTurn(game)
+        games.append([str(move) for move in game.moveStack])
+    plies = sum([len(moves) for moves in games])
+    Report("self-play", plies, time.time() - start, "plies", " (%d games)" % len(games))
+
+    rawKeys = set()
+    canonicalKeys = set()
+    for moves in games:
+        game = Game()
+        for move in moves:
+            rawKeys.add(game.positionKey)
+            canonicalKeys.add(game.CanonicalKey()[0])
+            game.TakeTurns([move])
+    print "%-24s %9d by position key, %d by canonical key (%.1f%% fewer)" % \
+        ("distinct positions", len(rawKeys), len(canonicalKeys), 100.0 * (len(rawKeys) - len(canonicalKeys)) / max(len(rawKeys), 1))
+
+    randomGames = [[str(move) for move in RandomGame(rng).moveStack] for i in range(options.distinct)]
+    (checked, keyMismatches, evalMismatches) = CheckMirrorImages(games + randomGames)
+    print "%-24s %9d positions: %d with different keys or moves, %d not evaluated as the negation" % \
+        ("mirror images", checked, keyMismatches, evalMismatches)
+
+    for fold in (False, True):
+        start = time.time()
+        hits = 0
+        nodes = 0
+        entries = 0
+        for moves in games:
+            engine = NewEngine(fold)
+            game = Game()
+            for move in moves:
+                engine.AnalyzeWithLimits(game, 2, None, None)
+                hits += engine.cacheHits
+                nodes += engine.moveCount
+                game.TakeTurns([move])
+            entries += len(engine.cache)
+        Report(["unfolded cache", "folded cache"][fold], nodes, time.time() - start, "nodes",
+               " (%d hits, %.2f%%; %d entries)" % (hits, 100.0 * hits / max(nodes, 1), entries))
+
+
+# Positions
+
+def BenchPositions(options):
+    """Encodes the positions from random games into one buffer, then times decoding them all."""
+    rng = random.Random(options.seed)
+    games = []
+    for i in range(options.distinct):
+        game = RandomGame(rng)
+        while game.moveStack:
+            games.append(Game())
+            games[-1].TakeTurns([str(move) for move in game.moveStack])
+            game.UndoAndPopLastMove()
+            if len(games) >= options.positions:
+                break
+        if len(games) >= options.positions:
+            break
+
+    start = time.time()
+    data = khetPosition.EncodeAll(games)
+    Report("encode", len(games), time.time() - start, "positions", " (%d bytes)" % len(data))
+
+    start = time.time()
+    for game in khetPosition.DecodeAll(data):
+        pass
+    Report("decode", len(games), time.time() - start, "positions")
+
+    start = time.time()
+    for (i, game) in enumerate(khetPosition.DecodeAll(data)):
+        if game.positionKey != games[i].positionKey:
+            raise khetPosition.PositionError("position %d doesn't round-trip" % i)
+    Report("round-trip check", len(games), time.time() - start, "positions")
+
+
+# Imports
+
+# The modules a headless program runs from, and the statements that load them.
+IMPORT_ENTRY_POINTS = [
+    ('khetGame', 'import khetGame'),
+    ('khetPosition', 'import khetPosition'),
+    ('khetRecord', 'import khetRecord'),
+    ('khetMatch', 'import khetMatch'),
+    ('khetProtocol', 'import khetProtocol'),
+    ('engines', 'import engines'),
+    ]
+
+# Modules that are slow to load or not always there, which headless imports shouldn't need.
+HEAVY_MODULES = ['numpy', 'multiprocessing', 'wx', 'ossaudiodev', 'winsound']
+
+def TimeImport(statement, repeat):
+    """Returns (seconds, heavy modules loaded) for running statement in a fresh interpreter, the fastest of repeat tries."""
+    script = "import sys, time\n" \
+        "start = time.time()\n" \
+        "%s\n" \
+        "elapsed = time.time() - start\n" \
+        "print elapsed, ' '.join([name for name in %r if name in sys.modules])\n" % (statement, HEAVY_MODULES)
+    best = None
+    for i in range(repeat):
+        child = subprocess.Popen([sys.executable, '-c', script], stdout = subprocess.PIPE, cwd = os.path.dirname(os.path.abspath(__file__)))
+        words = child.communicate()[0].split()
+        if child.returncode != 0:
+            raise RuntimeError("%s failed" % statement)
+        if best == None or float(words[0]) < best:
+            best = float(words[0])
+        heavy = words[1:]
+    return (best, heavy)
+
+def BenchImports(options):
+    """Times importing each headless entry point, and each engine, in a fresh interpreter."""
+    from engines import ENGINE_CLASSES
+    entryPoints = IMPORT_ENTRY_POINTS + \
+        [('engine ' + name, 'import engines; engines.ENGINES[%r]' % name) for name in sorted(ENGINE_CLASSES.keys())]
+    for (label, statement) in entryPoints:
+        (seconds, heavy) = TimeImport(statement, options.repeat)
+        print "%-24s %7.1f ms%s" % (label, seconds * 1000, "".join([" +" + name for name in heavy]))
+
+
+BENCHMARKS = {
+    'batch': BenchBatch,
+    'database': BenchDatabase,
+    'gc': BenchGarbage,
+    'movegen': BenchMoveGeneration,
+    'imports': BenchImports,
+    'playouts': BenchPlayouts,
+    'positions': BenchPositions,
+    'records': BenchRecords,
+    'search': BenchSearch,
+    'symmetry': BenchSymmetry,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage = "%%prog %s [options]" % "|".join(sorted(BENCHMARKS.keys())))
+    parser.add_option("--seed", type = "int", default = 0, help = "random seed (default %default)")
+    parser.add_option("--games", type = "int", default = 100000, help = "records: archive size (default %default)")
+    parser.add_option("--distinct", type = "int", default = 200, help = "records: distinct games in the archive; movegen: games to play; symmetry: random games to check (default %default)")
+    parser.add_option("--replay", type = "int", default = 2000, help = "records, database: games to replay (default %default)")
+    parser.add_option("--playouts", type = "int", default = 1000, help = "playouts, batch: number to time (default %default)")
+    parser.add_option("--positions", type = "int", default = 10000, help = "positions: number to encode; database: number to look up (default %default)")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "database: worker processes for importing (default: one per core)")
+    parser.add_option("--searches", type = "int", default = 8, help = "search, gc: positions to search (default %default)")
+    parser.add_option("--depth", type = "int", default = 3, help = "search, gc: plies to search each position (default %default)")
+    parser.add_option("--nodes", type = "int", default = 100000, help = "gc: nodes for Raneb to grow its tree to (default %default)")
+    parser.add_option("--selfplay", type = "int", default = 2, help = "symmetry: self-play games to measure (default %default)")
+    parser.add_option("--plies", type = "int", default = 30, help = "symmetry: most plies in each game (default %default)")
+    parser.add_option("--repeat", type = "int", default = 5, help = "imports: tries per entry point, taking the fastest (default %default)")
+    (options, args) = parser.parse_args()
+    if not args or args[0] not in BENCHMARKS:
+        parser.error("missing or unknown benchmark")
+    BENCHMARKS[args[0]](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""khetBook
+
+The opening book: moves worked out ahead of time, by long analysis of the Classic setup and
+the positions that follow it, so engines can play them without searching.
+
+The book file is a header followed by fixed-size entries of (position key, move code, weight, score,
+depth), sorted by key, so all the moves for a position are adjacent.  The file is mapped into memory
+and binary-searched, so opening it costs nothing however big it is.  Move codes are from Move.Encode();
+scores are from the point of view of the player to move, and weights are relative within a position.
+
+A position and its mirror image (see Game.CanonicalKey) share their entries, under the canonical key,
+with the moves for the position that key is for; the other one's moves are their mirror images.
+The score, for the player to move, is the same for both.
+
+Usage:
+    python khetBook.py build -o khet.book --plies 4 --depth 3
+    python khetBook.py show khet.book
+
+Engines look for khet.book in the same directory as this file (see DefaultBook).  The tuners and the
+distributed and server workers turn it off, since they need every move searched."""
+
+import mmap
+import optparse
+import os
+import random
+import struct
+
+from khetGame import *
+
+
+HEADER_FORMAT = '<4sII'
+HEADER_MAGIC = 'KBOK'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+BOOK_VERSION = 2
+
+entryStruct = struct.Struct('<QHHhH')  # key, move code, weight, score, depth
+keyStruct = struct.Struct('<Q')
+ENTRY_SIZE = entryStruct.size
+
+DEFAULT_BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'khet.book')
+
+# Weight given to the best move in a position; the others scale down to 1 at the edge of the margin.
+MAX_WEIGHT = 100
+
+
+class BookError(Exception):
+    pass
+
+
+class OpeningBook:
+    """A book file, mapped into memory for lookups."""
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise BookError("%s is not an opening book" % filename)
+            (magic, version, self.count) = struct.unpack(HEADER_FORMAT, header)
+            if magic != HEADER_MAGIC or version != BOOK_VERSION:
+                raise BookError("%s is not a compatible opening book" % filename)
+            if os.fstat(f.fileno()).st_size != HEADER_SIZE + self.count * ENTRY_SIZE:
+                raise BookError("%s is truncated" % filename)
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def __len__(self):
+        return self.count
+
+    def Close(self):
+        self.data.close()
+
+    def Entry(self, i):
+        """Returns entry i, as (key, move code, weight, score, depth)."""
+        return entryStruct.unpack_from(self.data, HEADER_SIZE + i * ENTRY_SIZE)
+
+    def Key(self, i):
+        return keyStruct.unpack_from(self.data, HEADER_SIZE + i * ENTRY_SIZE)[0]
+
+    def Lookup(self, key):
+        """Returns the entries for the position with the given key, best first; an empty list if it's not in the book."""
+        # Binary search for the first entry with this key.
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) / 2
+            if self.Key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        result = []
+        while low < self.count and self.Key(low) == key:
+            result.append(self.Entry(low))
+            low += 1
+        return result
+
+    def Moves(self, game):
+        """Returns the book's (move code, weight, score, depth) entries for the game's current position, best first.
+
+        The codes are for moves on this game's board, even if the book has them for the mirror image."""
+        (key, sign) = game.CanonicalKey()
+        result = []
+        for (entryKey, code, weight, score, depth) in self.Lookup(key):
+            if sign < 0:
+                code = MirrorMoveCode(code)
+            result.append((code, weight, score, depth))
+        return result
+
+    def ChooseMove(self, game, rng = random):
+        """Returns one of the book's moves for the game's current position, on its board, chosen at random by weight.
+
+        Also sets the move's oValue (positive for Silver, like the engines') and exploredDepth.
+        Returns None if the position isn't in the book, or the chosen move isn't legal there."""
+        entries = self.Moves(game)
+        if not entries:
+            return None
+        choice = rng.uniform(0, sum([weight for (code, weight, score, depth) in entries]))
+        for (code, weight, score, depth) in entries:
+            choice -= weight
+            if choice <= 0:
+                break
+
+        move = Move.Decode(code, game.board)
+        if not IsLegal(game, move):
+            return None
+        if game.activePlayer == PLAYER_SILVER:
+            move.oValue = score
+        else:
+            move.oValue = -score
+        move.exploredDepth = depth
+        return move
+
+
+def IsLegal(game, move):
+    """Returns true if move is one the active player could make; guards against the odd key collision."""
+    piece = move.piece
+    if piece == None or piece.color != game.activePlayer:
+        return False
+    for legal in piece.EnumerateMoves(game.board):
+        if legal.Matches(move) and getattr(legal, 'unstackObelisk', False) == move.unstackObelisk:
+            return True
+    return False
+
+
+defaultBook = None
+
+def DefaultBook():
+    """Returns the OpeningBook in DEFAULT_BOOK, opening it on first use; None if there isn't one."""
+    global defaultBook
+    if defaultBook == None and os.path.exists(DEFAULT_BOOK):
+        defaultBook = OpeningBook(DEFAULT_BOOK)
+    return defaultBook
+
+
+# Building
+
+def AnalyzePosition(moveStrings, depth, width, margin):
+    """Searches the position reached by the given moves from Classic.  Runs in a worker process.
+
+    Returns (canonical position key, entries for the best moves, within margin of the best and at most width of them).
+    The entries' moves are for the position the key is for; see Game.CanonicalKey."""
+    from engines.menes import MenesEngine
+    game = Game()
+    game.TakeTurns(moveStrings)
+    (key, mirrorSign) = game.CanonicalKey()
+    if game.IsOver():
+        return (key, [])
+
+    engine = MenesEngine()
+    engine.verbose = False
+    engine.book = None  # Don't just read back the old book.
+    engine.alphaBeta = False  # The alternatives need exact scores, not just the best.
+    engine.maxDepth = depth
+    engine.StartAnalysis(game)
+    while engine.ContinueAnalysis(True):
+        pass
+
+    sign = engine.GetColorFactor(game.activePlayer)
+    best = engine.moves[0].oValue * sign
+    entries = []
+    for move in engine.moves[:width]:
+        score = move.oValue * sign
+        loss = best - score
+        if loss > margin:
+            break
+        if margin > 0:
+            weight = 1 + int((MAX_WEIGHT - 1) * (margin - loss) / margin)
+        else:
+            weight = MAX_WEIGHT
+        code = move.Encode()
+        if mirrorSign < 0:
+            code = MirrorMoveCode(code)
+        entries.append((key, code, weight, int(max(-32768, min(32767, round(score)))), depth))
+    return (key, entries)
+
+def AnalyzePositionJob(args):
+    return AnalyzePosition(*args)
+
+def Build(filename, plies = 4, depth = 3, width = 3, margin = 2, processes = None, log = None):
+    """Builds a book by analyzing Classic and the positions reached by its book moves, to the given number of plies.
+
+    Each level of the tree is analyzed in parallel.  Returns the number of entries written."""
+    import multiprocessing  # Only here, so engines reading the book don't load it.
+    entries = []
+    seen = set()
+    level = [[]]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for ply in range(plies):
+            jobs = [(moveStrings, depth, width, margin) for moveStrings in level]
+            results = pool.map(AnalyzePositionJob, jobs)
+            nextLevel = []
+            for (moveStrings, (key, positionEntries)) in zip(level, results):
+                if key in seen:
+                    continue  # Reached by transposition, or it's the mirror image of one already analyzed.
+                seen.add(key)
+                entries.extend(positionEntries)
+                game = Game()
+                game.TakeTurns(moveStrings)
+                sign = game.CanonicalKey()[1]
+                for entry in positionEntries:
+                    code = entry[1]
+                    if sign < 0:
+                        code = MirrorMoveCode(code)
+                    nextLevel.append(moveStrings + [str(Move.Decode(code, game.board))])
+            if log:
+                log("Ply %d: analyzed %d positions." % (ply + 1, len(level)))
+            level = nextLevel
+    finally:
+        pool.close()
+        pool.join()
+
+    Write(filename, entries)
+    return len(entries)
+
+def Write(filename, entries):
+    """Writes the given (key, move code, weight, score, depth) entries as a book file."""
+    entries = sorted(entries, key = lambda e: (e[0], -e[2]))
+    f = open(filename, 'wb')
+    try:
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, BOOK_VERSION, len(entries)))
+        for entry in entries:
+            f.write(entryStruct.pack(*entry))
+    finally:
+        f.close()
+
+
+def Show(book, game, plies, indent = ""):
+    """Prints the book's moves from the given position, following each to the given number of plies."""
+    for (code, weight, score, depth) in book.Moves(game):
+        move = Move.Decode(code, game.board)
+        print "%s%s  weight %d, score %d, depth %d" % (indent, move, weight, score, depth)
+        if plies > 1:
+            move.TakeCompleteTurn(game)
+            try:
+                Show(book, game, plies - 1, indent + "    ")
+            finally:
+                game.UndoAndPopLastMove()
+                game.PassToNextPlayer()
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog build|show [options] [book]")
+    parser.add_option("-o", "--output", default = DEFAULT_BOOK, help = "book file to write (default %default)")
+    parser.add_option("-p", "--plies", type = "int", default = 4, help = "plies from Classic to cover (default %default)")
+    parser.add_option("-d", "--depth", type = "int", default = 3, help = "search depth for each position (default %default)")
+    parser.add_option("-w", "--width", type = "int", default = 3, help = "most moves kept per position (default %default)")
+    parser.add_option("-m", "--margin", type = "float", default = 2,
+                      help = "keep moves scoring within this much of the best (default %default)")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "worker processes (default: one per core)")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+
+    if args[0] == 'build':
+        def Log(s):
+            print s
+        count = Build(options.output, options.plies, options.depth, options.width, options.margin, options.processes, Log)
+        print "Wrote %d entries to %s." % (count, options.output)
+
+    elif args[0] == 'show':
+        if len(args) > 1:
+            book = OpeningBook(args[1])
+        else:
+            book = OpeningBook(DEFAULT_BOOK)
+        print "%d entries." % len(book)
+        Show(book, Game(), options.plies)
+
+    else:
+        parser.error("unknown command %s" % args[0])
+
+
+if __name__ == '__main__':
+    main()
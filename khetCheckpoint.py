@@ -0,0 +1,338 @@
+"""khetCheckpoint
+
+Saving an engine's analysis to a file, and resuming it later - so a long analysis survives
+the process dying, and can be carried on another day.
+
+A checkpoint holds the root position (in khetPosition's encoding, plus the keys of the positions
+before it, for repetitions), a few of the engine's counters and timings, its position cache if it
+has one, and its search tree.  The tree is written depth-first with each move after its replies
+(post-order), as fixed-size records of the move's code (from Move.Encode), its search results,
+and the number of records under it; so any move's whole subtree is the run of records just before
+it, and its replies can be found by stepping back from it, sibling by sibling.
+
+That lets a resumed engine start with just the root moves, mapping the file into memory and
+rebuilding the rest of the tree only as the search reaches it (see KhetEngine.EnumerateNextMoves),
+so resuming is quick however big the file is.  Saving again copies the parts not yet rebuilt
+straight across from the old file.
+
+Usage:
+    python khetCheckpoint.py analyze --engine raneb --time 3600 prep.kckp
+    python khetCheckpoint.py show prep.kckp"""
+
+import mmap
+import optparse
+import os
+import struct
+import time
+
+from khetGame import *
+import khetPosition
+
+
+HEADER_FORMAT = '<4sIIIIQQ'  # magic, version, root moves, key history length, state length, cache entries, records
+HEADER_MAGIC = 'KCKP'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CHECKPOINT_VERSION = 1
+
+keyStruct = struct.Struct('<Q')
+cacheStruct = struct.Struct('<QdB')  # position key, oValue, exploredDepth
+
+# Each move in the tree: code, flags, exploredDepth, maxExploredDepth, oValue, visits, wins,
+# replies (if expanded), and the number of records under it.
+nodeStruct = struct.Struct('<HBBBdIdHI')
+NODE_CODE, NODE_FLAGS, NODE_EXPLORED_DEPTH, NODE_MAX_EXPLORED_DEPTH, NODE_VALUE, NODE_VISITS, NODE_WINS, NODE_REPLIES, NODE_BELOW = range(9)
+
+FLAG_EXPANDED = 1  # The move's replies were saved (there may be none, if the game was over).
+FLAG_SOLVED = 2
+FLAG_BOUNDED = 4  # The move's oValue is only a bound, from an alpha-beta search.
+
+# Copy records not yet rebuilt from an old checkpoint to a new one in pieces this big.
+COPY_SIZE = 1 << 20
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def ParseState(text):
+    """Returns the dictionary of numbers and names saved as name=value pairs by Write."""
+    result = {}
+    for pair in text.split():
+        (name, value) = pair.split('=', 1)
+        for kind in (int, float):
+            try:
+                value = kind(value)
+                break
+            except ValueError:
+                pass
+        result[name] = value
+    return result
+
+
+class Checkpoint:
+    """A checkpoint file, mapped into memory for resuming from."""
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise CheckpointError("%s is not a checkpoint" % filename)
+            (magic, version, self.rootCount, historyCount, stateLength, self.cacheCount, self.nodeCount) = \
+                    struct.unpack(HEADER_FORMAT, header)
+            if magic != HEADER_MAGIC or version != CHECKPOINT_VERSION:
+                raise CheckpointError("%s is not a compatible checkpoint" % filename)
+
+            self.historyOffset = HEADER_SIZE + khetPosition.POSITION_SIZE
+            stateOffset = self.historyOffset + historyCount * keyStruct.size
+            self.cacheOffset = stateOffset + stateLength
+            self.nodesOffset = self.cacheOffset + self.cacheCount * cacheStruct.size
+            if os.fstat(f.fileno()).st_size != self.nodesOffset + self.nodeCount * nodeStruct.size:
+                raise CheckpointError("%s is truncated" % filename)
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        self.historyCount = historyCount
+        self.state = ParseState(self.data[stateOffset:self.cacheOffset])
+
+    def Close(self):
+        self.data.close()
+
+    def RootGame(self):
+        """Returns a new Game set up with the root position, remembering the positions before it for repetitions."""
+        game = khetPosition.Decode(self.data, HEADER_SIZE)
+        for i in xrange(self.historyCount):
+            key = keyStruct.unpack_from(self.data, self.historyOffset + i * keyStruct.size)[0]
+            game.keyHistory.append(key)
+            game.keyCounts[key] = game.keyCounts.get(key, 0) + 1
+        return game
+
+    def RootKey(self):
+        return khetPosition.Decode(self.data, HEADER_SIZE).positionKey
+
+    def CacheEntries(self):
+        """A generator of the saved cache entries, as (key, (oValue, exploredDepth))."""
+        for i in xrange(self.cacheCount):
+            (key, value, depth) = cacheStruct.unpack_from(self.data, self.cacheOffset + i * cacheStruct.size)
+            yield (key, (value, depth))
+
+    def Node(self, index):
+        """Returns record index, as a tuple indexed by the NODE_ constants."""
+        return nodeStruct.unpack_from(self.data, self.nodesOffset + index * nodeStruct.size)
+
+    def Replies(self, index):
+        """Returns the indices of the records for the replies to the move in record index, in order.
+
+        Index nodeCount stands for the root, whose replies are the root moves."""
+        if index == self.nodeCount:
+            count = self.rootCount
+        else:
+            count = self.Node(index)[NODE_REPLIES]
+        result = []
+        i = index - 1
+        for n in xrange(count):
+            result.append(i)
+            i -= 1 + self.Node(i)[NODE_BELOW]
+        result.reverse()
+        return result
+
+    def RestoreMoves(self, engine, game, index):
+        """Returns the replies saved for the move in record index, which has just been made on game, as the engine's moves.
+
+        The moves come from engine.EnumerateMoves, in the saved order, with their saved results;
+        any not in the checkpoint go at the end.  Each one whose own replies were saved gets
+        checkpointIndex, so they can be restored in turn.  Returns None if no replies were saved."""
+        if index != self.nodeCount and not self.Node(index)[NODE_FLAGS] & FLAG_EXPANDED:
+            return None
+        moves = dict([(move.Encode(), move) for move in engine.EnumerateMoves(game)])
+        result = []
+        for i in self.Replies(index):
+            node = self.Node(i)
+            move = moves.pop(node[NODE_CODE], None)
+            if move == None:
+                continue  # Shouldn't happen, unless the checkpoint is for a different position.
+            RestoreNode(move, node)
+            if node[NODE_FLAGS] & FLAG_EXPANDED:
+                move.checkpointIndex = i
+            result.append(move)
+        result.extend(moves.values())
+        return result
+
+    def Restore(self, engine):
+        """Sets up the engine's root moves, counters, and cache from the checkpoint; engine.game must be at the root position."""
+        if self.state.get('engine') != engine.__class__.__name__:
+            raise CheckpointError("%s was saved by %s, not %s" % (self.filename, self.state.get('engine'), engine.__class__.__name__))
+        if engine.game.positionKey != self.RootKey():
+            raise CheckpointError("%s is for a different position" % self.filename)
+        engine.moves = self.RestoreMoves(engine, engine.game, self.nodeCount)
+        for name in engine.CHECKPOINT_FIELDS:
+            if name in self.state:
+                setattr(engine, name, self.state[name])
+        if hasattr(engine, 'cache'):
+            engine.cache = dict(self.CacheEntries())
+
+    def CopySubtree(self, f, index):
+        """Writes the records under record index (not including it) to the open file f.  Returns how many there were."""
+        below = self.Node(index)[NODE_BELOW]
+        start = self.nodesOffset + (index - below) * nodeStruct.size
+        end = self.nodesOffset + index * nodeStruct.size
+        while start < end:
+            f.write(self.data[start:min(end, start + COPY_SIZE)])
+            start += COPY_SIZE
+        return below
+
+
+def RestoreNode(move, node):
+    """Sets the search results saved in a record on move, for those the engine's moves have."""
+    for (name, value) in [('oValue', node[NODE_VALUE]),
+                          ('exploredDepth', node[NODE_EXPLORED_DEPTH]),
+                          ('maxExploredDepth', node[NODE_MAX_EXPLORED_DEPTH]),
+                          ('visits', node[NODE_VISITS]),
+                          ('wins', node[NODE_WINS]),
+                          ('solved', bool(node[NODE_FLAGS] & FLAG_SOLVED)),
+                          ('bounded', bool(node[NODE_FLAGS] & FLAG_BOUNDED))]:
+        if hasattr(move, name):
+            setattr(move, name, value)
+
+
+# Saving
+
+def WriteMoves(f, moves, checkpoint):
+    """Writes the trees under the given moves, then the moves themselves, to the open file f.
+
+    Returns the number of records written."""
+    count = 0
+    for move in moves:
+        count += WriteMove(f, move, checkpoint)
+    return count
+
+def WriteMove(f, move, checkpoint):
+    """Writes the tree under move, then move itself.  Returns the number of records written."""
+    flags = 0
+    replies = 0
+    if hasattr(move, 'nextMoves'):
+        below = WriteMoves(f, move.nextMoves, checkpoint)
+        flags |= FLAG_EXPANDED
+        replies = len(move.nextMoves)
+    elif getattr(move, 'checkpointIndex', None) != None and checkpoint != None:
+        # Not rebuilt since resuming: copy it from the old checkpoint as it is.
+        below = checkpoint.CopySubtree(f, move.checkpointIndex)
+        flags |= FLAG_EXPANDED
+        replies = checkpoint.Node(move.checkpointIndex)[NODE_REPLIES]
+    else:
+        below = 0
+    if getattr(move, 'solved', False):
+        flags |= FLAG_SOLVED
+    if getattr(move, 'bounded', False):
+        flags |= FLAG_BOUNDED
+    f.write(nodeStruct.pack(move.Encode(), flags,
+                            min(getattr(move, 'exploredDepth', 0), 255),
+                            min(getattr(move, 'maxExploredDepth', 0), 255),
+                            getattr(move, 'oValue', 0) or 0,
+                            getattr(move, 'visits', 0),
+                            getattr(move, 'wins', 0),
+                            replies, below))
+    return below + 1
+
+def Write(filename, engine):
+    """Saves the engine's analysis of its current position to filename.
+
+    Writes to a temporary file first, then replaces filename, so a crash midway leaves the old checkpoint."""
+    if getattr(engine, 'game', None) == None or getattr(engine, 'moves', None) == None:
+        raise CheckpointError("%s has no analysis to save" % engine.name)
+    game = engine.game
+
+    state = dict([(name, getattr(engine, name)) for name in engine.CHECKPOINT_FIELDS])
+    state['engine'] = engine.__class__.__name__
+    state['depth'] = engine.GetStats()['depth']
+    state['saved'] = time.time()
+    stateText = " ".join(["%s=%r" % (name, value) for (name, value) in sorted(state.items())]).replace("'", "")
+    cache = getattr(engine, 'cache', {})
+
+    temporary = filename + '.tmp'
+    f = open(temporary, 'wb')
+    try:
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, CHECKPOINT_VERSION, 0, 0, 0, 0, 0))
+        f.write(khetPosition.Encode(game))
+        for key in game.keyHistory:
+            f.write(keyStruct.pack(key))
+        f.write(stateText)
+        for (key, (value, depth)) in cache.iteritems():
+            f.write(cacheStruct.pack(key, value, min(depth, 255)))
+        nodeCount = WriteMoves(f, engine.moves, engine.checkpoint)
+
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, CHECKPOINT_VERSION, len(engine.moves),
+                            len(game.keyHistory), len(stateText), len(cache), nodeCount))
+    finally:
+        f.close()
+
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)  # Windows won't rename over an existing file.
+    os.rename(temporary, filename)
+    return nodeCount
+
+
+def Show(checkpoint, count = 10):
+    """Prints a summary of a checkpoint, and its best root moves."""
+    print "%s: %d moves in the tree, %d cache entries." % (checkpoint.filename, checkpoint.nodeCount, checkpoint.cacheCount)
+    for (name, value) in sorted(checkpoint.state.items()):
+        print "    %s: %s" % (name, value)
+    game = checkpoint.RootGame()
+    for i in checkpoint.Replies(checkpoint.nodeCount)[:count]:
+        node = checkpoint.Node(i)
+        print "%-10s score %g, depth %d, visits %d, %d moves under it" % \
+              (Move.Decode(node[NODE_CODE], game.board), node[NODE_VALUE], node[NODE_EXPLORED_DEPTH], node[NODE_VISITS], node[NODE_BELOW])
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog analyze|show [options] checkpoint")
+    parser.add_option("-e", "--engine", default = 'raneb', help = "engine to analyze with (default %default)")
+    parser.add_option("-m", "--moves", default = "", help = "analyze the position after these moves from Classic, space-separated")
+    parser.add_option("-t", "--time", type = "float", default = 60, help = "seconds to analyze for (default %default)")
+    parser.add_option("-i", "--interval", type = "float", default = 60, help = "seconds between checkpoints (default %default)")
+    (options, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.error("missing command or checkpoint")
+    (command, filename) = args[:2]
+
+    if command == 'analyze':
+        from khetProtocol import ENGINES, FormatInfo
+        if options.engine not in ENGINES:
+            parser.error("unknown engine %s" % options.engine)
+        engine = ENGINES[options.engine]()
+        engine.verbose = False
+        if hasattr(engine, 'maxTime'):
+            engine.maxTime = None
+        engine.checkpointFile = filename
+        engine.checkpointInterval = options.interval
+
+        engine.StartApparentTime()
+        if os.path.exists(filename):
+            engine.ResumeAnalysis(filename)
+            print "Resumed from %s." % filename
+        else:
+            game = Game()
+            game.TakeTurns(options.moves.split())
+            engine.StartAnalysis(game)
+
+        start = time.time()
+        lastInfo = start
+        while engine.ContinueAnalysis(True) and time.time() - start < options.time:
+            if time.time() - lastInfo >= 10:
+                print FormatInfo(engine.GetStats())
+                lastInfo = time.time()
+        print FormatInfo(engine.GetStats())
+        engine.SaveCheckpoint(filename)
+        print "Saved to %s." % filename
+
+    elif command == 'show':
+        Show(Checkpoint(filename))
+
+    else:
+        parser.error("unknown command %s" % command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,542 @@
+"""khetDatabase
+
+A database of played games, indexed by position, for questions like "which games reached this
+position?" and "how did the games go after each move from here?".
+
+A database is a directory.  The games are imported from files of game records (see khetRecord),
+and stored compactly: each as its header lines, in the record format, followed by its moves as
+16-bit codes from Move.Encode, in games.kgd.  games.kgi has a fixed-size entry for each game, by
+game id (numbered from 0, in the order imported), giving where it starts, its length, and its result.
+
+The position index holds an entry of (position key, game id, ply) for every position in every game,
+including the setup at ply 0, so the move played from a position is the game's move at that ply.
+Its entries are fixed-size and big-endian, so sorting the packed entries as plain strings sorts them
+by key, and they're kept in sorted segment files (positions-NNNNNN.kpi), each mapped into memory
+and binary-searched.  Every import adds segments of its own, at most SEGMENT_ENTRIES each, so it
+runs in bounded memory and never rewrites what's there; once there are more than MAX_SEGMENTS,
+they're merged into one.  The merged segment is written before the others are removed, and its header
+records the highest-numbered segment it replaces, so if the removal is interrupted, the replaced
+segments are ignored when the database is opened (and removed by the next import or compaction).
+
+Importing replays each game once, which is the slow part, so it's spread across processes.
+A segment's header records how many games the index covers once it's written; games stored beyond
+that (by an import that was interrupted) are dropped when the database is next opened for import.
+A record that doesn't replay the way it says it does is skipped, and reported, rather than ending the import.
+
+Usage:
+    python khetDatabase.py import -d games.kdb archive.khet ...
+    python khetDatabase.py find -d games.kdb "pd6c6 pe3f3"
+    python khetDatabase.py show -d games.kdb 1234
+    python khetDatabase.py compact -d games.kdb"""
+
+import glob
+import heapq
+import itertools
+import mmap
+import optparse
+import os
+import struct
+import time
+
+from khetGame import *
+import khetRecord
+
+
+DATA_FILE = 'games.kgd'
+GAMES_FILE = 'games.kgi'
+SEGMENT_PATTERN = 'positions-%06d.kpi'
+
+gameStruct = struct.Struct('<QHHB')  # offset in the data file, header length, plies, index of the result in gameResults
+GAME_SIZE = gameStruct.size
+
+SEGMENT_HEADER_FORMAT = '<4sIIII'  # magic, version, entries, games covered, highest segment number it replaces (or 0)
+SEGMENT_MAGIC = 'KPIX'
+SEGMENT_HEADER_SIZE = struct.calcsize(SEGMENT_HEADER_FORMAT)
+DATABASE_VERSION = 2
+
+entryStruct = struct.Struct('>QIH')  # position key, game id, ply; big-endian, so entries sort as strings
+keyStruct = struct.Struct('>Q')
+ENTRY_SIZE = entryStruct.size
+
+# Most entries held in memory, and written to one segment, while importing.
+SEGMENT_ENTRIES = 1 << 20
+
+# Segments allowed before an import merges them.
+MAX_SEGMENTS = 8
+
+# Games handed out to the worker processes at a time.
+IMPORT_CHUNK = 1000
+
+# Merge segments by writing this many entries at a time.
+WRITE_BATCH = 1 << 16
+
+UNKNOWN_RESULT = gameResults.index('*')
+
+
+class DatabaseError(Exception):
+    pass
+
+
+def SegmentNumber(filename):
+    return int(os.path.basename(filename)[len('positions-'):-len('.kpi')])
+
+
+class Segment:
+    """One sorted segment of the position index, mapped into memory."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.number = SegmentNumber(filename)
+        f = open(filename, 'rb')
+        try:
+            header = f.read(SEGMENT_HEADER_SIZE)
+            if len(header) < SEGMENT_HEADER_SIZE:
+                raise DatabaseError("%s is not a position index" % filename)
+            (magic, version, self.count, self.games, self.replaces) = struct.unpack(SEGMENT_HEADER_FORMAT, header)
+            if magic != SEGMENT_MAGIC or version != DATABASE_VERSION:
+                raise DatabaseError("%s is not a compatible position index" % filename)
+            if os.fstat(f.fileno()).st_size != SEGMENT_HEADER_SIZE + self.count * ENTRY_SIZE:
+                raise DatabaseError("%s is truncated" % filename)
+            if self.count:
+                self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            else:
+                self.data = ""  # Can't map an empty file.
+        finally:
+            f.close()
+
+    def Close(self):
+        if self.count:
+            self.data.close()
+
+    def Entries(self):
+        """A generator yielding each packed entry, in order."""
+        for i in xrange(self.count):
+            start = SEGMENT_HEADER_SIZE + i * ENTRY_SIZE
+            yield self.data[start:start + ENTRY_SIZE]
+
+    def Lookup(self, key):
+        """Returns a list of (game id, ply) for each of the segment's entries with the given key."""
+        packedKey = keyStruct.pack(key)
+
+        # Binary search for the first entry with this key, comparing the packed keys directly.
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) / 2
+            start = SEGMENT_HEADER_SIZE + middle * ENTRY_SIZE
+            if self.data[start:start + 8] < packedKey:
+                low = middle + 1
+            else:
+                high = middle
+
+        result = []
+        start = SEGMENT_HEADER_SIZE + low * ENTRY_SIZE
+        while low < self.count and self.data[start:start + 8] == packedKey:
+            result.append(entryStruct.unpack_from(self.data, start)[1:])
+            low += 1
+            start += ENTRY_SIZE
+        return result
+
+
+def WriteSegment(filename, entries, games, replaces = 0):
+    """Writes the given packed entries, already sorted, as a segment covering the given number of games.
+
+    If the segment is a merge, replaces is the highest number of the segments merged into it.
+    entries can be any iterable of strings; the file is written under another name and renamed into place when complete."""
+    temporary = filename + '.tmp'
+    f = open(temporary, 'wb')
+    try:
+        f.write(struct.pack(SEGMENT_HEADER_FORMAT, SEGMENT_MAGIC, DATABASE_VERSION, 0, games, replaces))
+        count = 0
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == WRITE_BATCH:
+                f.write("".join(batch))
+                count += len(batch)
+                batch = []
+        f.write("".join(batch))
+        count += len(batch)
+        f.seek(0)
+        f.write(struct.pack(SEGMENT_HEADER_FORMAT, SEGMENT_MAGIC, DATABASE_VERSION, count, games, replaces))
+    finally:
+        f.close()
+    if os.path.exists(filename):
+        os.remove(filename)  # For Windows, which won't rename over it.
+    os.rename(temporary, filename)
+
+
+def HeaderText(headers):
+    return "".join(['[%s "%s"]\n' % (name, value) for (name, value) in sorted(headers.items())])
+
+def GameResult(game, recorded):
+    """Returns the index in gameResults of the replayed game's result, falling back on the recorded one."""
+    if game.tied:
+        return gameResults.index(TIE_RESULT)
+    elif game.pharaohs[PLAYER_RED].square == None:
+        return gameResults.index('1-0')
+    elif game.pharaohs[PLAYER_SILVER].square == None:
+        return gameResults.index('0-1')
+    elif recorded in gameResults:
+        return gameResults.index(recorded)
+    else:
+        return UNKNOWN_RESULT
+
+def ReplayRecord(gameId, recordText, validate):
+    """Replays one game record, as its text.  Runs in a worker process.
+
+    Returns (header text, move codes packed as a string, result, packed index entries)."""
+    record = khetRecord.ReadRecords(recordText.splitlines()).next()
+    game = Game()
+    keys = [game.positionKey]
+    codes = []
+    for (moveString, hitSquare) in record.GetMoves():
+        move = Move.FromString(moveString, game.board)
+        codes.append(move.Encode())
+        move.TakeCompleteTurn(game)
+        if validate:
+            if move.hitPiece:
+                actual = str(move.hitPieceSquare)
+            else:
+                actual = None
+            if actual != hitSquare:
+                raise RecordError("move %d, %s: recorded hit %s, but replay hit %s" %
+                                  (len(game.moveStack), moveString, hitSquare, actual))
+        keys.append(game.positionKey)
+    game.SetRecordedResult(record.GetResult())
+
+    entries = "".join([entryStruct.pack(key, gameId, ply) for (ply, key) in enumerate(keys)])
+    return (HeaderText(record.headers), struct.pack('<%dH' % len(codes), *codes), GameResult(game, record.GetResult()), entries)
+
+def ReplayRecordJob(args):
+    """ReplayRecord, but returning the RecordError if the record is bad, so the rest of the chunk still gets replayed."""
+    try:
+        return ReplayRecord(*args)
+    except RecordError, e:
+        return e
+
+
+class GameDatabase:
+    """A database directory, with its games and position index open for lookups."""
+    def __init__(self, directory, create = False):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            if not create:
+                raise DatabaseError("%s is not a game database" % directory)
+            os.makedirs(directory)
+        for name in (DATA_FILE, GAMES_FILE):
+            filename = os.path.join(directory, name)
+            if not os.path.exists(filename):
+                open(filename, 'wb').close()
+
+        self.segments = []
+        for filename in sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN.replace('%06d', '[0-9]' * 6)))):
+            self.segments.append(Segment(filename))
+        # Leave out any segments a merge replaced, but didn't get to remove.
+        self.replacedSegments = []
+        if self.segments:
+            replaced = max([segment.replaces for segment in self.segments])
+            for segment in self.segments:
+                if segment.number <= replaced:
+                    segment.Close()
+                    self.replacedSegments.append(segment.filename)
+            self.segments = [segment for segment in self.segments if segment.number > replaced]
+
+        # Games are only there once the index covers them.
+        if self.segments:
+            self.count = max([segment.games for segment in self.segments])
+        else:
+            self.count = 0
+        self.gamesFile = open(os.path.join(directory, GAMES_FILE), 'rb')
+        self.dataFile = open(os.path.join(directory, DATA_FILE), 'rb')
+        if os.fstat(self.gamesFile.fileno()).st_size < self.count * GAME_SIZE:
+            raise DatabaseError("%s is truncated" % GAMES_FILE)
+
+    def __len__(self):
+        return self.count
+
+    def Close(self):
+        for segment in self.segments:
+            segment.Close()
+        self.segments = []
+        self.gamesFile.close()
+        self.dataFile.close()
+
+    def PositionCount(self):
+        return sum([segment.count for segment in self.segments])
+
+    # Lookups
+
+    def Lookup(self, key):
+        """Returns a sorted list of (game id, ply) for every time a position with the given key occurred."""
+        result = []
+        for segment in self.segments:
+            result.extend(segment.Lookup(key))
+        result.sort()
+        return result
+
+    def Find(self, game):
+        """Returns a sorted list of (game id, ply) for every time the game's current position occurred."""
+        return self.Lookup(game.positionKey)
+
+    def GameEntry(self, gameId):
+        """Returns (offset, header length, plies, result index) for the game with the given id."""
+        if not 0 <= gameId < self.count:
+            raise DatabaseError("no game %d" % gameId)
+        self.gamesFile.seek(gameId * GAME_SIZE)
+        return gameStruct.unpack(self.gamesFile.read(GAME_SIZE))
+
+    def Result(self, gameId):
+        """Returns the game's result, as one of gameResults."""
+        return gameResults[self.GameEntry(gameId)[3]]
+
+    def MoveCode(self, gameId, ply):
+        """Returns the code of the move played at the given ply of the game, or None if the game ended there."""
+        (offset, headerLength, plies, result) = self.GameEntry(gameId)
+        if ply >= plies:
+            return None
+        self.dataFile.seek(offset + headerLength + 2 * ply)
+        return struct.unpack('<H', self.dataFile.read(2))[0]
+
+    def Record(self, gameId):
+        """Returns (headers, move codes) for the game with the given id."""
+        (offset, headerLength, plies, result) = self.GameEntry(gameId)
+        self.dataFile.seek(offset)
+        data = self.dataFile.read(headerLength + 2 * plies)
+        headers = {}
+        for line in data[:headerLength].splitlines():
+            (name, value) = ParseHeader(line)
+            headers[name] = value
+        return (headers, struct.unpack('<%dH' % plies, data[headerLength:]))
+
+    def Game(self, gameId):
+        """Returns the game with the given id, replayed as a Game."""
+        (headers, codes) = self.Record(gameId)
+        game = Game()
+        game.headers = headers
+        for p in players:
+            game.playerNames[p] = headers.get(colorName[p], game.playerNames[p])
+        for code in codes:
+            Move.Decode(code, game.board).TakeCompleteTurn(game)
+        game.SetRecordedResult(self.Result(gameId))
+        return game
+
+    def MoveStats(self, game):
+        """Returns how the games that reached the game's current position went, after each move played from it.
+
+        Returns a list of (move, games, Silver wins, Red wins, ties), most played first, with the moves on the game's board.
+        Games that ended in the position, or where it repeated, are counted once, at its first occurrence."""
+        stats = {}
+        counted = set()
+        for (gameId, ply) in self.Find(game):
+            if gameId in counted:
+                continue
+            counted.add(gameId)
+            code = self.MoveCode(gameId, ply)
+            if code == None:
+                continue
+            if code not in stats:
+                stats[code] = [0, 0, 0, 0]
+            counts = stats[code]
+            counts[0] += 1
+            result = self.Result(gameId)
+            if result == '1-0':
+                counts[1] += 1
+            elif result == '0-1':
+                counts[2] += 1
+            elif result == TIE_RESULT:
+                counts[3] += 1
+        result = [tuple([Move.Decode(code, game.board)] + counts) for (code, counts) in stats.items()]
+        result.sort(key = lambda s: -s[1])
+        return result
+
+    # Importing
+
+    def Import(self, files, processes = None, validate = True, log = None):
+        """Adds the games in the given open files of game records.  Returns the number added.
+
+        The games are replayed across the given number of processes (default: one per core).
+        Records that fail validation are skipped; self.skipped lists them, as (record number in the import, RecordError)."""
+        import multiprocessing  # Only here, so lookups don't load it.
+        self.DropUnindexedGames()
+        self.RemoveReplacedSegments()
+        self.skipped = []
+
+        if processes == 1:
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes)
+        gamesFile = open(os.path.join(self.directory, GAMES_FILE), 'ab')
+        dataFile = open(os.path.join(self.directory, DATA_FILE), 'ab')
+        offset = dataFile.tell()
+        firstId = self.count
+        nextId = self.count
+        recordsRead = 0
+        entries = []
+        entryCount = 0
+        try:
+            records = (str(record) for f in files for record in khetRecord.ReadRecords(f))
+            while True:
+                chunk = [(nextId + i, text, validate) for (i, text) in enumerate(itertools.islice(records, IMPORT_CHUNK))]
+                if not chunk:
+                    break
+                if pool:
+                    results = pool.map(ReplayRecordJob, chunk)
+                else:
+                    results = map(ReplayRecordJob, chunk)
+
+                for (i, replayed) in enumerate(results):
+                    if isinstance(replayed, RecordError):
+                        self.skipped.append((recordsRead + i + 1, replayed))
+                        if log:
+                            log("Skipped record %d: %s" % (recordsRead + i + 1, replayed))
+                        continue
+                    (headerText, codes, result, positions) = replayed
+                    dataFile.write(headerText)
+                    dataFile.write(codes)
+                    gamesFile.write(gameStruct.pack(offset, len(headerText), len(codes) / 2, result))
+                    offset += len(headerText) + len(codes)
+                    for start in xrange(0, len(positions), ENTRY_SIZE):
+                        entry = positions[start:start + ENTRY_SIZE]
+                        if nextId != chunk[i][0]:
+                            # A record before it in the chunk was skipped, so it gets the next id along instead.
+                            (key, gameId, ply) = entryStruct.unpack(entry)
+                            entry = entryStruct.pack(key, nextId, ply)
+                        entries.append(entry)
+                    nextId += 1
+                recordsRead += len(chunk)
+
+                if len(entries) >= SEGMENT_ENTRIES:
+                    entryCount += len(entries)
+                    self.AddSegment(entries, nextId, dataFile, gamesFile)
+                    entries = []
+                if log:
+                    log("Imported %d games, %d positions." % (nextId - firstId, entryCount + len(entries)))
+
+            if entries:
+                self.AddSegment(entries, nextId, dataFile, gamesFile)
+        finally:
+            gamesFile.close()
+            dataFile.close()
+            if pool:
+                pool.close()
+                pool.join()
+
+        if len(self.segments) > MAX_SEGMENTS:
+            self.Compact()
+        return self.count - firstId
+
+    def AddSegment(self, entries, games, dataFile, gamesFile):
+        """Sorts and writes the given packed entries as a new segment, covering the given number of games."""
+        dataFile.flush()
+        gamesFile.flush()  # The games must be there before the index says so.
+        entries.sort()
+        filename = os.path.join(self.directory, SEGMENT_PATTERN % self.NextSegmentNumber())
+        WriteSegment(filename, entries, games)
+        self.segments.append(Segment(filename))
+        self.count = games
+
+    def NextSegmentNumber(self):
+        numbers = [segment.number for segment in self.segments] + [SegmentNumber(f) for f in self.replacedSegments]
+        return max(numbers + [0]) + 1
+
+    def RemoveReplacedSegments(self):
+        """Removes the segments left behind by a merge that was interrupted before it removed them."""
+        for filename in self.replacedSegments:
+            os.remove(filename)
+        self.replacedSegments = []
+
+    def DropUnindexedGames(self):
+        """Truncates the games files to the games the index covers, discarding what an interrupted import left."""
+        gamesFilename = os.path.join(self.directory, GAMES_FILE)
+        dataFilename = os.path.join(self.directory, DATA_FILE)
+        if self.count:
+            (offset, headerLength, plies, result) = self.GameEntry(self.count - 1)
+            end = offset + headerLength + 2 * plies
+        else:
+            end = 0
+        for (filename, size) in ((gamesFilename, self.count * GAME_SIZE), (dataFilename, end)):
+            if os.path.getsize(filename) > size:
+                f = open(filename, 'r+b')
+                try:
+                    f.truncate(size)
+                finally:
+                    f.close()
+
+    def Compact(self):
+        """Merges all the segments into one."""
+        self.RemoveReplacedSegments()
+        if len(self.segments) < 2:
+            return
+        filename = os.path.join(self.directory, SEGMENT_PATTERN % self.NextSegmentNumber())
+        WriteSegment(filename, heapq.merge(*[segment.Entries() for segment in self.segments]), self.count,
+                     self.segments[-1].number)
+        for segment in self.segments:
+            segment.Close()
+            os.remove(segment.filename)
+        self.segments = [Segment(filename)]
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog import|find|show|compact -d database [files | moves | game id]")
+    parser.add_option("-d", "--database", default = None, help = "the database directory")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "import: worker processes (default: one per core)")
+    parser.add_option("--no-validate", action = "store_false", dest = "validate", default = True,
+                      help = "import: don't check that replaying each move hits what the record says")
+    parser.add_option("-n", "--limit", type = "int", default = 20, help = "find: most games to list (default %default)")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+    if not options.database:
+        parser.error("missing database")
+    command = args[0]
+
+    if command == 'import':
+        database = GameDatabase(options.database, create = True)
+        def Log(s):
+            print s
+        start = time.time()
+        for filename in args[1:]:
+            f = open(filename, 'r')
+            try:
+                count = database.Import([f], options.processes, options.validate, Log)
+            finally:
+                f.close()
+            if database.skipped:
+                print "Imported %d games from %s, skipping %d bad records." % (count, filename, len(database.skipped))
+            else:
+                print "Imported %d games from %s." % (count, filename)
+        print "%d games, %d positions, in %d segments; took %.1f s." % \
+            (len(database), database.PositionCount(), len(database.segments), time.time() - start)
+
+    elif command == 'find':
+        database = GameDatabase(options.database)
+        game = Game()
+        if len(args) > 1:
+            game.TakeTurns(" ".join(args[1:]).split())
+        start = time.time()
+        occurrences = database.Find(game)
+        elapsed = time.time() - start
+        print "%d occurrences in %d games (%.2f ms)." % \
+            (len(occurrences), len(set([gameId for (gameId, ply) in occurrences])), elapsed * 1000)
+        for (move, games, silverWins, redWins, ties) in database.MoveStats(game):
+            print "%-8s %6d games: %5.1f%% Silver, %5.1f%% Red, %5.1f%% tied" % \
+                (str(move).split()[0], games, 100.0 * silverWins / games, 100.0 * redWins / games, 100.0 * ties / games)
+        for (gameId, ply) in occurrences[:options.limit]:
+            print "game %d, ply %d: %s" % (gameId, ply, database.Result(gameId))
+
+    elif command == 'show':
+        if len(args) < 2:
+            parser.error("missing game id")
+        print GameDatabase(options.database).Game(int(args[1]))
+
+    elif command == 'compact':
+        database = GameDatabase(options.database)
+        database.Compact()
+        print "%d positions in %d segments." % (database.PositionCount(), len(database.segments))
+
+    else:
+        parser.error("unknown command %s" % command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""khetDistributed
+
+Spreads one long analysis (opening preparation, say) across worker processes that may be on other hosts.
+
+The coordinator splits the root position - by its first ply, or its first two plies - into work units,
+deals them out to the connected workers, and merges their scores back up into a best move.
+Each worker keeps a queue of its own; when it runs dry, it takes units from the shared pool of
+undealt ones, and then steals from the back of the longest queue left, so fast workers aren't left
+idle while slow ones finish.  Units go into the pool when no worker has arrived by the time they're
+dealt, or when a worker goes away without scoring one.
+
+Usage:
+    python khetDistributed.py coordinator [--port N] [--depth N] [--split 1|2] [--expect N] [move ...]
+    python khetDistributed.py worker --connect HOST:PORT [--engine NAME]
+    python khetDistributed.py local --workers N [--depth N] [--split 1|2] [move ...]
+    python khetDistributed.py scaling --workers N [--depth N] [--split 1|2] [move ...]
+
+'local' runs the coordinator and its workers on this machine; 'scaling' does so repeatedly with
+increasing numbers of workers, and reports the speedup and efficiency of each.
+
+Messages, one per line:
+    worker -> coordinator:  hello <host>
+                            result <unit> score <score> nodes <count>
+    coordinator -> worker:  unit <unit> depth <plies> moves <move> ...
+                            done"""
+
+import collections
+import multiprocessing
+import optparse
+import socket
+import threading
+import time
+
+from khetGame import *
+from khetMatch import LegalMoves
+from khetProtocol import ENGINES, MoveText
+from engines.narmer import EvaluationWeights
+
+DEFAULT_PORT = 7468
+DEFAULT_WORKER_ENGINE = 'menes'
+
+# How long the coordinator waits for the expected workers before dealing out units anyway, in seconds.
+START_TIMEOUT = 30
+
+
+def TerminalScore(game):
+    """Returns the score of a finished game: a Pharaoh's worth in favor of the winner."""
+    pharaohValue = EvaluationWeights().pharaoh
+    if game.Pharaoh(PLAYER_SILVER).square == None:
+        return -pharaohValue
+    else:
+        return pharaohValue
+
+def BestScore(scores, player):
+    """Returns the best of the scores for the given player: the highest for Silver, the lowest for Red."""
+    if player == PLAYER_SILVER:
+        return max(scores)
+    else:
+        return min(scores)
+
+
+class WorkUnit:
+    def __init__(self, id, moves, depth):
+        self.id = id
+        self.moves = moves  # From the Classic setup, through the root moves, to the unit's own position.
+        self.depth = depth
+        self.score = None
+        self.nodes = 0
+
+
+class Coordinator:
+    """Splits a search into work units, serves them to workers over TCP, and merges the results."""
+    def __init__(self, moves, depth, splitPlies = 1, port = DEFAULT_PORT):
+        if depth <= splitPlies:
+            raise ValueError("depth must be more than the %d plies split at the root" % splitPlies)
+        self.rootMoves = moves
+        self.depth = depth
+        self.splitPlies = splitPlies
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(16)
+        self.address = self.listener.getsockname()
+
+        self.lock = threading.Condition()
+        self.queues = []      # One deque of units per worker.
+        self.pending = collections.deque()  # Units in no worker's queue, for whoever asks next.
+        self.workerNames = []
+        self.unitsDone = []   # Count per worker.
+        self.dealt = False
+        self.steals = 0
+        self.BuildUnits()
+
+    def BuildUnits(self):
+        """Makes a unit for each position splitPlies into the search.
+
+        self.tree maps each first-ply move to either a unit, or (when splitting two plies)
+        a dictionary mapping second-ply moves to units.  Positions where the game is over get
+        no unit; they're scored directly."""
+        self.units = []
+        game = Game()
+        game.TakeTurns(self.rootMoves)
+        self.rootPlayer = game.activePlayer
+        self.tree = self.BuildSubtree(game, self.splitPlies)
+
+    def BuildSubtree(self, game, plies):
+        result = {}
+        for move in LegalMoves(game):
+            moveText = MoveText(move)
+            move.TakeCompleteTurn(game)
+            try:
+                if game.IsOver():
+                    result[moveText] = TerminalScore(game)
+                elif plies == 1:
+                    unit = WorkUnit(len(self.units), [MoveText(m) for m in game.moveStack], self.depth - self.splitPlies)
+                    self.units.append(unit)
+                    result[moveText] = unit
+                else:
+                    result[moveText] = self.BuildSubtree(game, plies - 1)
+            finally:
+                game.PassToNextPlayer()
+                game.UndoAndPopLastMove()
+        return result
+
+    # Serving workers
+
+    def Run(self, expectedWorkers = 1):
+        """Serves units until all are scored; returns a dictionary describing the result.
+
+        The time reported is from when the units are dealt, so it doesn't include waiting for workers."""
+        acceptor = threading.Thread(target = self.AcceptWorkers)
+        acceptor.setDaemon(True)
+        acceptor.start()
+
+        # Deal once the expected workers have arrived (or we've waited long enough).
+        self.lock.acquire()
+        try:
+            deadline = time.time() + START_TIMEOUT
+            while len(self.queues) < expectedWorkers and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            self.Deal()
+            startTime = time.time()
+            while [unit for unit in self.units if unit.score == None]:
+                self.lock.wait(1)
+        finally:
+            self.lock.release()
+        self.listener.close()
+
+        return self.Merge(time.time() - startTime)
+
+    def AcceptWorkers(self):
+        while True:
+            try:
+                (sock, address) = self.listener.accept()
+            except socket.error:
+                return  # Closed: we're done.
+            thread = threading.Thread(target = self.ServeWorker, args = (sock,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def Deal(self):
+        """Deals the units round-robin into the workers' queues, or into the pool if there are no workers yet.
+        Call with the lock held."""
+        if self.queues:
+            for unit in self.units:
+                self.queues[unit.id % len(self.queues)].append(unit)
+        else:
+            self.pending.extend(self.units)
+        self.dealt = True
+        self.lock.notifyAll()
+
+    def ServeWorker(self, sock):
+        f = sock.makefile('rw', 0)
+        unit = None  # The unit the worker has, if any.
+        try:
+            words = f.readline().split()
+            self.lock.acquire()
+            try:
+                index = len(self.queues)
+                self.queues.append(collections.deque())
+                self.workerNames.append(" ".join(words[1:]) or "worker")
+                self.unitsDone.append(0)
+                self.lock.notifyAll()
+            finally:
+                self.lock.release()
+
+            while True:
+                unit = self.NextUnit(index)
+                if unit == None:
+                    f.write("done\n")
+                    break
+                f.write("unit %d depth %d moves %s\n" % (unit.id, unit.depth, " ".join(unit.moves)))
+                words = f.readline().split()
+                if not words:
+                    break  # Lost the worker.
+                self.RecordResult(index, unit, float(words[3]), int(words[5]))
+                unit = None
+        except socket.error:
+            pass
+        finally:
+            if unit != None:
+                # The worker went away with it; put it back for someone else.
+                self.ReturnUnit(index, unit)
+            f.close()
+            sock.close()
+
+    def NextUnit(self, index):
+        """Returns the next unit for the given worker: from its own queue, then the pool, then stolen from another's.
+
+        Returns None when there's nothing left to do: every unit is scored.  While the last units are still
+        out with other workers, waits, in case one of them goes away and its unit comes back."""
+        self.lock.acquire()
+        try:
+            while not self.dealt:
+                self.lock.wait()
+            while True:
+                if self.queues[index]:
+                    return self.queues[index].popleft()
+                if self.pending:
+                    return self.pending.popleft()
+                victim = max(self.queues, key = len)
+                if victim:
+                    self.steals += 1
+                    return victim.pop()
+                if not [unit for unit in self.units if unit.score == None]:
+                    return None
+                self.lock.wait()
+        finally:
+            self.lock.release()
+
+    def ReturnUnit(self, index, unit):
+        """Puts back a unit whose worker went away without scoring it, into the pool, along with the rest of its queue."""
+        self.lock.acquire()
+        try:
+            self.pending.append(unit)
+            self.pending.extend(self.queues[index])
+            self.queues[index].clear()
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def RecordResult(self, index, unit, score, nodes):
+        self.lock.acquire()
+        try:
+            unit.score = score
+            unit.nodes = nodes
+            self.unitsDone[index] += 1
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    # Merging
+
+    def Merge(self, elapsed):
+        scores = {}
+        for moveText, child in self.tree.items():
+            scores[moveText] = self.SubtreeScore(child, 1 - self.rootPlayer)
+        bestMove = None
+        if scores:
+            bestScore = BestScore(scores.values(), self.rootPlayer)
+            bestMove = [m for m in scores if scores[m] == bestScore][0]
+        return {
+            'bestMove': bestMove,
+            'score': scores.get(bestMove, 0),
+            'moveScores': scores,
+            'units': len(self.units),
+            'nodes': sum([unit.nodes for unit in self.units]),
+            'seconds': elapsed,
+            'steals': self.steals,
+            'workers': zip(self.workerNames, self.unitsDone),
+            }
+
+    def SubtreeScore(self, node, player):
+        """Returns the score of a node in self.tree, where it's the given player's turn to move."""
+        if isinstance(node, WorkUnit):
+            return node.score
+        elif isinstance(node, dict):
+            if not node:
+                return 0  # No legal moves; call it even.
+            return BestScore([self.SubtreeScore(child, 1 - player) for child in node.values()], player)
+        else:
+            return node  # Already scored: the game was over.
+
+
+# Workers
+
+def RunWorker(address, engineName = DEFAULT_WORKER_ENGINE):
+    """Connects to a coordinator and analyzes the units it sends until it says it's done."""
+    sock = socket.create_connection(address)
+    f = sock.makefile('rw', 0)
+    engine = ENGINES[engineName]()
+    engine.verbose = False
+    engine.book = None  # Units ask for a search to their depth, not a book move.
+    engine.moveStats = None  # Nor reorder moves by a khet.stats that may only be on some hosts.
+    try:
+        f.write("hello %s\n" % socket.gethostname())
+        while True:
+            words = f.readline().split()
+            if not words or words[0] == 'done':
+                break
+            unitId = int(words[1])
+            depth = int(words[3])
+            game = Game()
+            game.TakeTurns(words[5:])
+
+            engine.AnalyzeWithLimits(game, depth = depth)
+            stats = engine.GetStats()
+            f.write("result %d score %r nodes %d\n" % (unitId, stats['score'], stats['nodes']))
+    finally:
+        f.close()
+        sock.close()
+
+def RunLocal(moves, depth, splitPlies, workers, engineName = DEFAULT_WORKER_ENGINE):
+    """Runs a coordinator with the given number of worker processes on this machine; returns its result."""
+    coordinator = Coordinator(moves, depth, splitPlies, port = 0)
+    address = ('localhost', coordinator.address[1])
+    processes = [multiprocessing.Process(target = RunWorker, args = (address, engineName)) for i in range(workers)]
+    for p in processes:
+        p.daemon = True
+        p.start()
+    try:
+        return coordinator.Run(workers)
+    finally:
+        for p in processes:
+            p.join()
+
+
+def PrintResult(result):
+    print "Best move %s, score %g" % (result['bestMove'], result['score'])
+    print "%d units, %d nodes in %.2f s (%d nodes/s); %d steals" % \
+        (result['units'], result['nodes'], result['seconds'], result['nodes'] / max(result['seconds'], 1e-6), result['steals'])
+    for name, done in result['workers']:
+        print "    %s: %d units" % (name, done)
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog coordinator|worker|local|scaling [options] [move ...]")
+    parser.add_option("-p", "--port", type = "int", default = DEFAULT_PORT, help = "coordinator port (default %default)")
+    parser.add_option("-d", "--depth", type = "int", default = 3, help = "total search depth in plies (default %default)")
+    parser.add_option("-s", "--split", type = "int", default = 1, help = "plies to split at the root: 1 or 2 (default %default)")
+    parser.add_option("-x", "--expect", type = "int", default = 1, help = "coordinator: workers to wait for (default %default)")
+    parser.add_option("-c", "--connect", help = "worker: HOST:PORT of the coordinator")
+    parser.add_option("-w", "--workers", type = "int", default = multiprocessing.cpu_count(),
+                      help = "local/scaling: worker processes (default %default)")
+    parser.add_option("-e", "--engine", default = DEFAULT_WORKER_ENGINE, help = "worker engine (default %default)")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+    (command, moves) = (args[0], args[1:])
+
+    if command == 'coordinator':
+        coordinator = Coordinator(moves, options.depth, options.split, options.port)
+        print "%d units; waiting for workers on port %d." % (len(coordinator.units), coordinator.address[1])
+        PrintResult(coordinator.Run(options.expect))
+
+    elif command == 'worker':
+        if not options.connect:
+            parser.error("worker needs --connect")
+        host, port = options.connect.split(':')
+        RunWorker((host, int(port)), options.engine)
+
+    elif command == 'local':
+        PrintResult(RunLocal(moves, options.depth, options.split, options.workers, options.engine))
+
+    elif command == 'scaling':
+        counts = [1]
+        while counts[-1] * 2 <= options.workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != options.workers:
+            counts.append(options.workers)
+
+        baseline = None
+        print "workers  seconds  speedup  efficiency"
+        for count in counts:
+            result = RunLocal(moves, options.depth, options.split, count, options.engine)
+            if baseline == None:
+                baseline = result['seconds']
+            speedup = baseline / result['seconds']
+            print "%7d  %7.2f  %7.2f  %9.0f%%" % (count, result['seconds'], speedup, 100 * speedup / count)
+
+    else:
+        parser.error("unknown command %s" % command)
+
+
+if __name__ == '__main__':
+    main()
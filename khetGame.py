@@ -8,6 +8,8 @@ representation (graphical or textual), nor any player control.
 
 import copy
 import datetime
+import random
+import types
 
 
 # Player constants
@@ -42,6 +44,60 @@ def allPieces(board):
 def IsLegalSquare(row, col):
     return row >= 0 and row < numRows and col >= 0 and col < numCols
 
+# For each square's index (row * numCols + col), the indices of it and its neighbors:
+# the squares whose pieces' moves can change when its contents do.
+neighborhoods = [[r * numCols + c for r in range(row - 1, row + 2) for c in range(col - 1, col + 2) if IsLegalSquare(r, c)]
+                 for row in allRows for col in allCols]
+
+
+# Position keys are Zobrist hashes: a random 64-bit number for each (square, piece state) pair,
+# XORed together, plus one more when Red is to move.
+# They're generated from a fixed seed, so keys are the same in every process and every run.
+def PieceStateIndex(piece):
+    """Returns a small integer distinguishing everything about a piece except where it is."""
+    result = 'POpD'.index(piece.letterCode) * 2 + piece.color
+    result = result * 4 + piece.rotation / 90
+    result = result * 2 + int(getattr(piece, 'stacked', False))
+    return result
+
+numPieceStates = 4 * 2 * 4 * 2
+
+def MakeZobristTable(seed):
+    rng = random.Random(seed)
+    return [[rng.getrandbits(64) for state in range(numPieceStates)] for square in range(numRows * numCols)]
+
+zobristTable = MakeZobristTable(0x4B686574)
+zobristRedToMove = random.Random(0x52656421).getrandbits(64)
+
+def SquareKey(square):
+    """Returns the Zobrist contribution of the given square's contents."""
+    if square.piece:
+        return zobristTable[square.row * numCols + square.col][PieceStateIndex(square.piece)]
+    else:
+        return 0
+
+# The Classic setup is its own mirror image (see Game.MirrorVertically): turned 180 degrees, with the colors
+# swapped.  The rules are too, so a position and its mirror image, with the other player to move, are worth
+# the same to the player to move.  The mirror key is the position key the mirror image would have, so
+# the smaller of the two (see Game.CanonicalKey) is the same for both.
+def MirrorPieceState(state):
+    """Returns the PieceStateIndex of the given one's mirror image: the other color, turned 180 degrees."""
+    (rest, stacked) = divmod(state, 2)
+    (rest, rotation) = divmod(rest, 4)
+    (kind, color) = divmod(rest, 2)
+    return ((kind * 2 + 1 - color) * 4 + (rotation + 2) % 4) * 2 + stacked
+
+# Each square's contribution to the mirror key; the mirror of square index i is numRows * numCols - 1 - i.
+mirrorZobristTable = [[zobristTable[numRows * numCols - 1 - square][MirrorPieceState(state)] for state in range(numPieceStates)]
+                      for square in range(numRows * numCols)]
+
+def MirrorSquareKey(square):
+    """Returns the given square's contribution to the mirror key."""
+    if square.piece:
+        return mirrorZobristTable[square.row * numCols + square.col][PieceStateIndex(square.piece)]
+    else:
+        return 0
+
 
 def SwapPair(p):
     """Swaps the members of a binary tuple."""
@@ -52,6 +108,49 @@ def SwapAndNegate(p):
     return (-p[1], -p[0])
 
 
+# Game records
+
+class RecordError(Exception):
+    """A game record is malformed, or doesn't replay the way it says it does."""
+    pass
+
+# Tokens that end a record's moves.
+gameResults = ['1-0', '0-1', '1/2-1/2', '*']
+TIE_RESULT = '1/2-1/2'
+
+# A tie can be claimed once the same position (with the same player to move) has occurred this many times.
+TIE_REPETITIONS = 3
+
+def ParseHeader(line):
+    """Splits a header line like '[Silver "Human Player"]' into a (name, value) tuple."""
+    line = line.strip()
+    if not (line.startswith('[') and line.endswith(']')):
+        raise RecordError("bad header line: %s" % line)
+    (name, value) = (line[1:-1].split(None, 1) + [''])[:2]
+    return (name, value.strip('"'))
+
+def ParseMoveText(text):
+    """Parses a record's moves, like '1. pd6c6 pe3f3 xf2 2. ...'.
+
+    Returns (moves, result): moves is a list of (move string, hit square string or None),
+    and result is the game result token, or None if there isn't one."""
+    moves = []
+    result = None
+    for word in text.split():
+        if word in gameResults:
+            result = word
+        elif word[0].isdigit():
+            pass  # A move number.
+        elif word[0] == 'x':
+            # The piece hit by the previous move.
+            if not moves:
+                raise RecordError("hit annotation before any move: %s" % word)
+            moves[-1] = (moves[-1][0], word[1:])
+        else:
+            moves.append((word, None))
+    return (moves, result)
+
+
 class Piece:
     def __init__(self, color, rotation = 0):
         self.color = color
@@ -172,6 +271,7 @@ class Obelisk(Piece):
             if hasattr(move, 'unstackObelisk') and move.unstackObelisk:
                 self.stacked = False
                 Obelisk(self.color, False).MoveTo(move.fromSquare)
+                move.fromSquare.piece.rotation = self.rotation  # Like the rest of the stack, so mirror images stay alike.
             # Otherwise, move the whole stack (the default).
 
     def FinishUndoMove(self, move):
@@ -212,7 +312,7 @@ class Obelisk(Piece):
                 elif self.stacked:
                     # Moving onto a blank square: We have the choice.
                     # Add another copy that does unstack.
-                    unstackedMove = copy.copy(result[i])
+                    unstackedMove = CopyMove(result[i])
                     unstackedMove.unstackObelisk = True
                     result.append(unstackedMove)
                 
@@ -372,6 +472,24 @@ class Square:
         return result
 
 
+# Low bytes of the move codes produced by Move.Encode().
+MOVE_CODE_UNSTACK = 0x80
+MOVE_CODE_ROTATE_LEFT = 0xFE
+MOVE_CODE_ROTATE_RIGHT = 0xFF
+
+def MirrorSquareIndex(index):
+    return numRows * numCols - 1 - index
+
+def MirrorMoveCode(code):
+    """Returns the code (see Move.Encode) of the mirror image of the move with the given code.
+
+    Turning the board around doesn't change which way a piece rotates, so only the squares change."""
+    action = code & 0xFF
+    result = MirrorSquareIndex(code >> 8) << 8
+    if action == MOVE_CODE_ROTATE_LEFT or action == MOVE_CODE_ROTATE_RIGHT:
+        return result | action
+    return result | MirrorSquareIndex(action & ~MOVE_CODE_UNSTACK) | (action & MOVE_CODE_UNSTACK)
+
 class Move:
     def __init__(self, piece, toSquare, rotateDir = 0):
         """Creates a new move; rotation is in the range [-1, +1]."""
@@ -416,6 +534,7 @@ class Move:
 
         Assumes the string contains a single legal move, and currently does no checking to confirm that.
         Ignores the hit-piece bit."""
+        s = s.split()[0]
         fromSquare = Square.FromString(s[1:3], board)
         if s[3] == '<':
             toSquare = fromSquare
@@ -430,6 +549,42 @@ class Move:
         result.unstackObelisk = (s[5:] == '-')
         return result
 
+    def Encode(self):
+        """Returns the move as a 16-bit integer, for compact storage.
+
+        The high byte is the index (row * numCols + col) of the square moved from; the low byte is
+        MOVE_CODE_ROTATE_LEFT or MOVE_CODE_ROTATE_RIGHT, or else the index of the square moved to,
+        plus MOVE_CODE_UNSTACK if an obelisk unstacks.  The hit piece isn't included."""
+        result = (self.fromSquare.row * numCols + self.fromSquare.col) << 8
+        if self.rotateDir == -1:
+            return result | MOVE_CODE_ROTATE_LEFT
+        elif self.rotateDir == 1:
+            return result | MOVE_CODE_ROTATE_RIGHT
+        result |= self.toSquare.row * numCols + self.toSquare.col
+        if getattr(self, 'unstackObelisk', False):
+            result |= MOVE_CODE_UNSTACK
+        return result
+
+    @staticmethod
+    def Decode(code, board):
+        """Constructs a new move on the given board from a code produced by Encode().
+
+        Like FromString, assumes the code is for a legal move."""
+        index = code >> 8
+        fromSquare = board[index / numCols][index % numCols]
+        action = code & 0xFF
+        if action == MOVE_CODE_ROTATE_LEFT:
+            result = Move(fromSquare.piece, fromSquare, -1)
+            result.unstackObelisk = False
+        elif action == MOVE_CODE_ROTATE_RIGHT:
+            result = Move(fromSquare.piece, fromSquare, 1)
+            result.unstackObelisk = False
+        else:
+            index = action & ~MOVE_CODE_UNSTACK
+            result = Move(fromSquare.piece, board[index / numCols][index % numCols])
+            result.unstackObelisk = bool(action & MOVE_CODE_UNSTACK)
+        return result
+
     def Matches(self, other):
         return other.fromSquare.HasSameCoords(self.fromSquare) and other.toSquare.HasSameCoords(self.toSquare) and other.rotateDir == self.rotateDir
 
@@ -440,6 +595,13 @@ class Move:
         this move was created."""
         return Move.FromString(str(self), board)
 
+    def AffectedSquares(self):
+        """Returns a list of the squares whose contents this move changes, not counting any hit piece."""
+        if self.toSquare and self.toSquare != self.fromSquare:
+            return [self.fromSquare, self.toSquare]
+        else:
+            return [self.fromSquare]
+
     def MovePiece(self):
         """Moves the given piece on the board.  Does not fire a laser."""
         self.piece.MoveTo(self.toSquare)
@@ -465,12 +627,48 @@ class Move:
 
         # Add any extra behavior needed by the piece class.
         self.piece.FinishUndoMove(self)
-        
+
+
+def CopyMove(move):
+    """Returns a new Move with the same attributes as the given one; quicker than copy.copy."""
+    return types.InstanceType(Move, dict(move.__dict__))
+
+
+class MovePool:
+    """A free list of Moves, for a search that's done with most of its moves as soon as it's searched them.
+
+    Copy() hands out a copy of a move, reusing one given back with Release() if it can, so a search
+    that releases each move when it's done with it only ever creates about one per ply."""
+    def __init__(self):
+        self.free = []
+        self.allocated = 0  # Moves created.
+        self.reused = 0  # Moves handed out again.
+
+    def Copy(self, template):
+        if self.free:
+            move = self.free.pop()
+            attributes = move.__dict__
+            attributes.clear()
+            attributes.update(template.__dict__)
+            self.reused += 1
+            return move
+        self.allocated += 1
+        return types.InstanceType(Move, dict(template.__dict__))
+
+    def Release(self, move):
+        """Takes back a move from Copy(); nothing else may still be using it."""
+        self.free.append(move)
+
 
 class Game:
+    # Set to check every cached move list against regenerating it from scratch; for debugging.
+    verifyMoves = False
+
     def __init__(self):
         self.CreateBoard()
         self.activePlayer = None
+        self.squareMoves = [None] * (numRows * numCols)
+        self.savedMoves = []
         self.ResetToClassic()
 
     def CreateBoard(self):
@@ -481,14 +679,29 @@ class Game:
                 self.board[row].append(Square(row, col))
 
     def ResetGame(self):
+        self.ClearHistory()
+
+        # Clear the board.
+        for piece in allPieces(self.board):
+            piece.MoveTo(None)
+        self.RefreshPositionKey()
+
+    def ClearHistory(self):
+        """Forgets the moves, players, headers and repetitions, leaving the board alone; Silver is to move."""
         self.activePlayer = PLAYER_SILVER
         self.moveStack = []
         self.pharaohs = [None, None]
         self.playerNames = ['Human Player', 'Human Player']
+        self.headers = {}
+        self.tied = False
 
-        # Clear the board.
-        for piece in allPieces(self.board):
-            piece.MoveTo(None)
+        # Repetition tracking: the key of the position before each move in moveStack,
+        # and how many times each key appears in that list.
+        self.keyHistory = []
+        self.keyCounts = {}
+
+        # For each move in moveStack, the cached moves from before it, or None (see SquareMoves).
+        self.savedMoves = []
 
     def MoveTo(self, row, col, piece):
         piece.MoveTo(self.board[row][col])
@@ -515,53 +728,86 @@ class Game:
 
         self.pharaohs[PLAYER_SILVER] = self.board[7][4].piece
         self.pharaohs[PLAYER_RED] = self.board[0][5].piece
+        self.RefreshPositionKey()
 
-    def Load(self, s):
-        """Loads from the game in string s, in the same format produced by __str__()."""
+    def Load(self, s, validate = True):
+        """Loads from the game in string s, in the same format produced by __str__().
+
+        Headers go into self.headers (and the player names).
+        If validate is set, raises RecordError if a piece hit on replay doesn't match the record's xNN annotations."""
+        moveText = []
         for line in s.splitlines():
-            if line[0] == '[':
-                pass  # Need to handle metadata later
+            if line.startswith('['):
+                (name, value) = ParseHeader(line)
+                self.headers[name] = value
             else:
-                if line.find("1.") == 0:
-                    # It's a list of moves.
-                    for word in line.split():
-                        print "'%s'" % word
-                        if word[0].isdigit():
-                            # It's a move number; skip it.
-                            pass
-                        elif word[0] == 'x':
-                            # A piece was destroyed; we'll find that out automatically.
-                            # A future implementation might like to validate that, though.
-                            pass
-                        else:
-                            # An actual move; make a complete turn from it.
-                            Move.FromString(word, self.board).TakeCompleteTurn(self)
+                moveText.append(line)
+        for p in players:
+            self.playerNames[p] = self.headers.get(colorName[p], self.playerNames[p])
+
+        (moves, result) = ParseMoveText(" ".join(moveText))
+        self.ReplayMoves(moves, validate)
+        self.SetRecordedResult(self.headers.get('Result', result))
+
+    def ReplayMoves(self, moves, validate = True):
+        """Plays moves as complete turns; moves is a list of (move string, hit square string or None) as from ParseMoveText.
+
+        If validate is set, raises RecordError if the piece hit by any move doesn't match."""
+        for (moveString, hitSquare) in moves:
+            move = Move.FromString(moveString, self.board)
+            move.TakeCompleteTurn(self)
+            if validate:
+                if move.hitPiece:
+                    actual = str(move.hitPieceSquare)
+                else:
+                    actual = None
+                if actual != hitSquare:
+                    raise RecordError("move %d, %s: recorded hit %s, but replay hit %s" %
+                                      (len(self.moveStack), moveString, hitSquare, actual))
+
+    def SetRecordedResult(self, result):
+        """Applies a result read from a game record.
+
+        Wins follow from the board, so only a tie needs recording."""
+        if result == TIE_RESULT:
+            self.tied = True
+
+    def TakeTurns(self, moveStrings):
+        """Plays the given moves (strings as produced by Move.__str__()) as complete turns, from the current position."""
+        for s in moveStrings:
+            Move.FromString(s, self.board).TakeCompleteTurn(self)
 
     def __str__(self):
         # Metadata
-        gameResult = str(int(self.pharaohs[PLAYER_RED].square == None)) + "-" + str(int(self.pharaohs[PLAYER_SILVER].square == None))
-        result = '[Date "%s"]\n' % str(datetime.date.today())
+        if self.tied:
+            gameResult = TIE_RESULT
+        else:
+            gameResult = str(int(self.pharaohs[PLAYER_RED].square == None)) + "-" + str(int(self.pharaohs[PLAYER_SILVER].square == None))
+        result = ['[Date "%s"]\n' % self.headers.get('Date', str(datetime.date.today()))]
         for p in players:
-            result += '[%s "%s"]\n' % (colorName[p], self.playerNames[p])
+            result.append('[%s "%s"]\n' % (colorName[p], self.playerNames[p]))
+        for name in sorted(self.headers.keys()):
+            if name not in ('Date', 'Result', colorName[PLAYER_SILVER], colorName[PLAYER_RED]):
+                result.append('[%s "%s"]\n' % (name, self.headers[name]))
                 
         if self.IsOver():
-            result += '[Result "%s"]\n' % gameResult
+            result.append('[Result "%s"]\n' % gameResult)
 
         # Moves
         moveNum = 1
         doingPlayer = PLAYER_SILVER
         for m in self.moveStack:
             if doingPlayer == PLAYER_SILVER:
-                result += "%d. " % moveNum
+                result.append("%d. " % moveNum)
                 moveNum += 1
-            result += str(m) + " "
+            result.append(str(m) + " ")
             doingPlayer = 1 - doingPlayer
 
         # Result
         if self.IsOver():
-            result += gameResult
+            result.append(gameResult)
 
-        return result
+        return "".join(result)
 
     def MirrorVertically(self):
         """Creates pieces to duplicate the top half of the board to the bottom, swapping sides and rotations."""
@@ -578,7 +824,27 @@ class Game:
         return self.pharaohs[color]
 
     def IsOver(self):
-        return self.pharaohs[PLAYER_SILVER].square == None or self.pharaohs[PLAYER_RED].square == None
+        return self.pharaohs[PLAYER_SILVER].square == None or self.pharaohs[PLAYER_RED].square == None or self.tied
+
+    # Repetitions
+
+    def TimesSeen(self, key):
+        """Returns how many times the position with the given key occurred before the current one, in constant time.
+
+        To ask whether a move would repeat, pass the key the position will have once the turn passes."""
+        return self.keyCounts.get(key, 0)
+
+    def RepetitionCount(self):
+        """Returns how many times the current position has occurred, counting this time."""
+        return self.TimesSeen(self.positionKey) + 1
+
+    def CanClaimTie(self):
+        """Returns true if a tie can be claimed (by either player), because the position has repeated often enough."""
+        return not self.IsOver() and self.RepetitionCount() >= TIE_REPETITIONS
+
+    def ClaimTie(self):
+        """Ends the game in a tie; undoing the last move takes it back."""
+        self.tied = True
 
     def FindLaserPath(self, color):
         """Simulates firing the laser of the indicated color.
@@ -621,6 +887,20 @@ class Game:
         else:
             return None
 
+    def LaserPathSquares(self, laserPath):
+        """Returns the set of indices (row * numCols + col) of the squares the laser crosses, from a path as from FindLaserPath.
+
+        The path only lists where the laser turns and ends; this includes every square in between."""
+        result = set()
+        for i in range(1, len(laserPath)):
+            ((row, col), (endRow, endCol)) = (laserPath[i - 1], laserPath[i])
+            (dRow, dCol) = (cmp(endRow, row), cmp(endCol, col))
+            while (row, col) != (endRow, endCol):
+                (row, col) = (row + dRow, col + dCol)
+                if IsLegalSquare(row, col):
+                    result.add(row * numCols + col)
+        return result
+
     def FindSquareInGrid(self, row, col):
         if IsLegalSquare(row, col):
             return self.board[row][col]
@@ -630,13 +910,79 @@ class Game:
     def PassToNextPlayer(self):
         """Swaps the turn - sets the active player to the other one."""
         self.activePlayer = 1 - self.activePlayer
+        self.positionKey ^= zobristRedToMove
+        self.mirrorKey ^= zobristRedToMove
+
+    def ComputePositionKey(self):
+        """Computes the position key from scratch.
+
+        Normally it's kept up to date incrementally, in positionKey."""
+        result = 0
+        for square in allSquares(self.board):
+            result ^= SquareKey(square)
+        if self.activePlayer == PLAYER_RED:
+            result ^= zobristRedToMove
+        return result
+
+    def ComputeMirrorKey(self):
+        """Computes the mirror key from scratch: the position key of the mirror image, with the other player to move."""
+        result = 0
+        for square in allSquares(self.board):
+            result ^= MirrorSquareKey(square)
+        if self.activePlayer == PLAYER_SILVER:
+            result ^= zobristRedToMove
+        return result
+
+    def RefreshPositionKey(self):
+        """Recomputes positionKey and mirrorKey, and forgets the cached moves; needed after changing the board other than through the Game's move methods."""
+        self.positionKey = self.ComputePositionKey()
+        self.mirrorKey = self.ComputeMirrorKey()
+        self.InvalidateMoves()
+
+    def CanonicalKey(self):
+        """Returns (key, sign): a key shared by this position and its mirror image, and the factor for values stored under it.
+
+        Multiplying a value (positive for Silver, as usual) by sign gives its value in the position the key is for;
+        store that, and multiply by sign again to read it back."""
+        if self.positionKey <= self.mirrorKey:
+            return (self.positionKey, 1)
+        else:
+            return (self.mirrorKey, -1)
+
+    def ToggleSquareKeys(self, squares):
+        for square in squares:
+            if square.piece:
+                index = square.row * numCols + square.col
+                state = PieceStateIndex(square.piece)
+                self.positionKey ^= zobristTable[index][state]
+                self.mirrorKey ^= mirrorZobristTable[index][state]
 
     def MakeAndPushMove(self, move):        
+        self.keyHistory.append(self.positionKey)
+        self.keyCounts[self.positionKey] = self.keyCounts.get(self.positionKey, 0) + 1
+        squares = move.AffectedSquares()
+        self.ToggleSquareKeys(squares)
         move.MovePiece()
+        self.ToggleSquareKeys(squares)
         self.moveStack.append(move)
+        self.savedMoves.append(self.squareMoves)
+        self.squareMoves = None  # See SquareMoves.
 
     def UndoAndPopLastMove(self):
-        self.moveStack.pop().UndoMove()
+        move = self.moveStack.pop()
+        squares = move.AffectedSquares()
+        if move.hitPiece and move.hitPieceSquare not in squares:
+            squares.append(move.hitPieceSquare)
+        self.ToggleSquareKeys(squares)
+        move.UndoMove()
+        self.ToggleSquareKeys(squares)
+        self.squareMoves = self.savedMoves.pop()
+        key = self.keyHistory.pop()
+        if self.keyCounts[key] == 1:
+            del self.keyCounts[key]
+        else:
+            self.keyCounts[key] -= 1
+        self.tied = False
 
     def FireLaser(self, move):
         """Actually fires the laser; if a piece is hit, it's removed and placed in the move (for undoing)."""
@@ -646,5 +992,189 @@ class Game:
             # Save it in the move, for later undoing.
             hitPiece.SaveHitInfo(move)
             # Delete it.
+            self.ToggleSquareKeys([hitPiece.square])
             hitPiece.DoHit(self)
-            
\ No newline at end of file
+            self.ToggleSquareKeys([move.hitPieceSquare])
+            if self.squareMoves != None:
+                # Moves were generated since the move was made; SquareMoves sees to the hit otherwise.
+                for index in neighborhoods[move.hitPieceSquare.row * numCols + move.hitPieceSquare.col]:
+                    self.squareMoves[index] = None
+        else:
+            move.hitPiece = None  # In case the move was made and fired before, in a different position.
+            
+    # Move generation
+    #
+    # The moves each piece could make are cached by square, as Moves that are copied to hand out.
+    # A move changes only what can move on and next to the squares whose contents it changes (and
+    # the rotation of the piece it turns), so only those lists need forgetting.  That's done lazily:
+    # making a move just sets the cache aside, and undoing it puts it back, so positions where no
+    # moves are generated (most of a search) pay nothing for it.
+
+    def InvalidateMoves(self):
+        """Forgets all the cached moves."""
+        self.squareMoves = [None] * (numRows * numCols)
+
+    def SquareMoves(self):
+        """Returns the cached moves, by square index, for the current position.
+
+        If they were set aside by moves since, copies the last ones there were, forgetting the lists those moves affect."""
+        if self.squareMoves == None:
+            depth = len(self.savedMoves) - 1
+            while self.savedMoves[depth] == None:
+                depth -= 1
+            squareMoves = self.savedMoves[depth][:]
+            for move in self.moveStack[depth:]:
+                if move.rotateDir:
+                    squareMoves[move.fromSquare.row * numCols + move.fromSquare.col] = None
+                else:
+                    for square in move.AffectedSquares():
+                        for index in neighborhoods[square.row * numCols + square.col]:
+                            squareMoves[index] = None
+                if move.hitPiece:
+                    for index in neighborhoods[move.hitPieceSquare.row * numCols + move.hitPieceSquare.col]:
+                        squareMoves[index] = None
+            self.squareMoves = squareMoves
+        return self.squareMoves
+
+    def EnumeratePieceMoves(self, piece):
+        """Returns a new list of the moves the given piece, on this game's board, could make; like Piece.EnumerateMoves."""
+        square = piece.square
+        index = square.row * numCols + square.col
+        squareMoves = self.SquareMoves()
+        moves = squareMoves[index]
+        if moves == None:
+            moves = squareMoves[index] = piece.EnumerateMoves(self.board)
+        # Copy each Move's attributes into a new one, which is quicker than constructing it.
+        return [types.InstanceType(Move, dict(move.__dict__)) for move in moves]
+
+    def EnumerateMoves(self, player = None):
+        """Returns a new list of all the moves the given player (by default, the active one) could make, piece by piece."""
+        if player == None:
+            player = self.activePlayer
+        result = []
+        for row in self.board:
+            for square in row:
+                if square.piece and square.piece.color == player:
+                    result.extend(self.EnumeratePieceMoves(square.piece))
+        if Game.verifyMoves:
+            self.VerifyMoves(player, result)
+        return result
+
+    def GenerateMoves(self, firstCode = None, pool = None):
+        """Yields new copies of the active player's moves, in stages, for a search that may not want them all.
+
+        First the move with code firstCode (see Move.Encode), if it's legal: e.g. the best reply found before.
+        Then the moves that change either laser's path, by moving or turning a piece on it or moving one onto it;
+        only those can change what gets hit.  Then the other rotations, then the other moves.
+
+        If the mover's laser already hits an opponent's piece, though, every move that leaves its path alone
+        captures that piece, so those come first - the ones that change the opponent's path, then the other
+        rotations, then the other moves - and the ones that change the mover's path come last.
+
+        Each stage is only worked out when the one before it is used up.
+        The copies come from the given MovePool, if there is one."""
+        player = self.activePlayer
+        board = self.board
+        squareMoves = self.SquareMoves()
+        if pool != None:
+            Copy = pool.Copy
+        else:
+            Copy = CopyMove
+
+        def Templates(index):
+            moves = squareMoves[index]
+            if moves == None:
+                moves = squareMoves[index] = board[index / numCols][index % numCols].piece.EnumerateMoves(board)
+            return moves
+
+        first = None
+        if firstCode != None:
+            index = firstCode >> 8
+            piece = board[index / numCols][index % numCols].piece
+            if piece and piece.color == player:
+                for move in Templates(index):
+                    if move.Encode() == firstCode:
+                        first = move
+                        yield Copy(move)
+                        break
+
+        pieceSquares = []  # Indices of the player's pieces.
+        for row in board:
+            for square in row:
+                if square.piece and square.piece.color == player:
+                    pieceSquares.append(square.row * numCols + square.col)
+
+        paths = [None, None]  # The squares on each color's laser path, as indices.
+        hit = None
+        for color in (PLAYER_SILVER, PLAYER_RED):
+            laserPath = self.FindLaserPath(color)
+            paths[color] = self.LaserPathSquares(laserPath)
+            if color == player:
+                hit = self.FindLaserPathEnd(laserPath)
+
+        if hit and hit.color != player:
+            for move in self.GenerateCapturesFirst(pieceSquares, Templates, paths[player], paths[1 - player], first, Copy):
+                yield move
+            return
+
+        onPath = paths[PLAYER_SILVER] | paths[PLAYER_RED]
+        for index in pieceSquares:
+            if index in onPath:
+                for move in Templates(index):
+                    if move is not first:
+                        yield Copy(move)
+            else:
+                for neighbor in neighborhoods[index]:
+                    if neighbor in onPath:
+                        for move in Templates(index):
+                            if not move.rotateDir and move is not first \
+                               and move.toSquare.row * numCols + move.toSquare.col in onPath:
+                                yield Copy(move)
+                        break
+
+        for index in pieceSquares:
+            if index not in onPath:
+                for move in Templates(index):
+                    if move.rotateDir and move is not first:
+                        yield Copy(move)
+
+        for index in pieceSquares:
+            if index not in onPath:
+                for move in Templates(index):
+                    if not move.rotateDir and move is not first \
+                       and move.toSquare.row * numCols + move.toSquare.col not in onPath:
+                        yield Copy(move)
+
+    def GenerateCapturesFirst(self, pieceSquares, Templates, ownPath, otherPath, first, Copy):
+        """The rest of GenerateMoves, for when the mover's laser already hits an opponent's piece."""
+        def Changes(index, move, path):
+            return index in path or not move.rotateDir and move.toSquare.row * numCols + move.toSquare.col in path
+
+        def Stage(index, move):
+            if Changes(index, move, ownPath):
+                return 3
+            elif Changes(index, move, otherPath):
+                return 0
+            elif move.rotateDir:
+                return 1
+            else:
+                return 2
+
+        for stage in range(4):
+            for index in pieceSquares:
+                for move in Templates(index):
+                    if move is not first and Stage(index, move) == stage:
+                        yield Copy(move)
+
+    def VerifyMoves(self, player, moves):
+        """Raises AssertionError unless moves are the same as generating the player's moves from scratch."""
+        def Describe(moves):
+            return sorted([(move.Encode(), getattr(move, 'unstackObelisk', None), move.fromRotation, move.oldPiece) for move in moves])
+        expected = []
+        for piece in allPieces(self.board):
+            if piece.color == player:
+                expected.extend(piece.EnumerateMoves(self.board))
+        if Describe(moves) != Describe(expected):
+            raise AssertionError("cached moves differ after %s: %s, expected %s" %
+                                 (" ".join([str(move) for move in self.moveStack]),
+                                  sorted([str(move) for move in moves]), sorted([str(move) for move in expected])))
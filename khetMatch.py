@@ -0,0 +1,61 @@
+"""khetMatch
+
+Plays engines against one another with no user interface - for tuning, testing,
+and generating games in bulk."""
+
+import random
+
+from khetGame import *
+
+# Games still going after this many plies are abandoned as ties.
+DEFAULT_MAX_PLIES = 200
+
+
+def PlayGame(engines, maxPlies = DEFAULT_MAX_PLIES, game = None, onMove = None, randomMoveRate = 0):
+    """Plays a game between two engines, given as a list indexed by color.  Returns the finished Game.
+
+    Starts from the Classic setup unless a game is given.  A tie is claimed as soon as one can be.
+    If onMove is given, it's called with the game after each complete turn.
+    With probability randomMoveRate, each move is a random legal one instead of the engine's choice;
+    useful for getting some variety into self-play."""
+    if game == None:
+        game = Game()
+    for p in players:
+        game.playerNames[p] = engines[p].name
+
+    while not game.IsOver() and len(game.moveStack) < maxPlies:
+        if randomMoveRate and random.random() < randomMoveRate:
+            move = random.choice(LegalMoves(game))
+        else:
+            engine = engines[game.activePlayer]
+            engine.StartApparentTime()
+            engine.StartAnalysis(game)
+            while engine.ContinueAnalysis(True):
+                pass
+
+            move = engine.GetMove()
+            if move == None:
+                break
+
+        # Rebuild the move on our own board; engines may have found it on a copy.
+        Move.FromString(str(move), game.board).TakeCompleteTurn(game)
+        if game.CanClaimTie():
+            game.ClaimTie()
+        if onMove:
+            onMove(game)
+
+    return game
+
+
+def LegalMoves(game):
+    """Returns a list of all the active player's legal moves."""
+    return game.EnumerateMoves()
+
+def GameScore(game, color):
+    """Returns the result of the game for the given player: 1 for a win, 0 for a loss, 0.5 for anything else."""
+    if game.Pharaoh(1 - color).square == None:
+        return 1
+    elif game.Pharaoh(color).square == None:
+        return 0
+    else:
+        return 0.5
@@ -0,0 +1,268 @@
+"""khetMoveStats
+
+How often each move was played from the positions of a game collection, and how it scored, for
+engines to try the moves that have done well first (see KhetEngine.EnumerateMoves).  Moves are ranked
+by how well they can be trusted to score: the low end of a confidence interval on their score, so a
+move that scored well in many games beats one that scored a little better in a few.
+
+The table is built from a game database (see khetDatabase), covering the positions in the first
+few plies of its games.  Each position gets one fixed-size slot: its key, then its most played
+moves, at most MAX_MOVES of them, each as (move code, games, score), most played first.  Move codes
+are from Move.Encode(); the score is the percentage of the points the player making the move got
+from the games whose result is known, with a tie worth half a win.
+
+The slots are an open-addressed hash table, a power of two in size and at most half full, probed
+linearly from the slot given by the low bits of the key; an empty slot has key 0.  So a lookup
+reads a slot or two, however big the table is, and the file is mapped into memory when first used,
+so loading it costs nothing.
+
+Usage:
+    python khetMoveStats.py build -d games.kdb -o khet.stats --plies 8
+    python khetMoveStats.py show khet.stats "pd6c6"
+
+Engines look for khet.stats in the same directory as this file (see DefaultMoveStats).  The tuners and the
+distributed and server workers ignore it, so their results don't depend on whether it's there."""
+
+import heapq
+import itertools
+import math
+import mmap
+import optparse
+import os
+import struct
+
+from khetGame import *
+
+
+HEADER_FORMAT = '<4sIIII'  # magic, version, slots, positions, plies covered
+HEADER_MAGIC = 'KMST'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+STATS_VERSION = 1
+
+# Moves kept for each position, at most.
+MAX_MOVES = 8
+
+slotStruct = struct.Struct('<Q' + 'HHB' * MAX_MOVES)  # key, then (move code, games, score) for each move
+keyStruct = struct.Struct('<Q')
+SLOT_SIZE = slotStruct.size
+
+DEFAULT_STATS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'khet.stats')
+
+# Games counted per move, at most, to fit the slot.
+MAX_GAMES = 0xFFFF
+
+# Moves played in fewer games than this aren't put first, however they scored.
+MIN_ORDER_GAMES = 5
+
+# Standard deviations below its score that a move's rank is taken from (about a 95% interval).
+CONFIDENCE_Z = 1.96
+
+
+def ScoreBound(games, score):
+    """Returns the lower end of the confidence interval (Wilson's) on the score of a move played in games games,
+    scoring score percent, as a fraction."""
+    if games == 0:
+        return 0.0
+    p = score / 100.0
+    z2 = CONFIDENCE_Z * CONFIDENCE_Z
+    spread = CONFIDENCE_Z * math.sqrt(p * (1 - p) / games + z2 / (4.0 * games * games))
+    return (p + z2 / (2.0 * games) - spread) / (1 + z2 / games)
+
+
+class MoveStatsError(Exception):
+    pass
+
+
+class MoveStats:
+    """A move statistics file, mapped into memory for lookups."""
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise MoveStatsError("%s is not a move statistics table" % filename)
+            (magic, version, self.slots, self.count, self.plies) = struct.unpack(HEADER_FORMAT, header)
+            if magic != HEADER_MAGIC or version != STATS_VERSION or self.slots & (self.slots - 1):
+                raise MoveStatsError("%s is not a compatible move statistics table" % filename)
+            if os.fstat(f.fileno()).st_size != HEADER_SIZE + self.slots * SLOT_SIZE:
+                raise MoveStatsError("%s is truncated" % filename)
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.mask = self.slots - 1
+
+    def __len__(self):
+        return self.count
+
+    def Close(self):
+        self.data.close()
+
+    def Lookup(self, key):
+        """Returns a list of (move code, games, score) for the position with the given key, most played first.
+
+        Returns an empty list if the position isn't in the table."""
+        slot = key & self.mask
+        while True:
+            offset = HEADER_SIZE + slot * SLOT_SIZE
+            slotKey = keyStruct.unpack_from(self.data, offset)[0]
+            if slotKey == key:
+                values = slotStruct.unpack_from(self.data, offset)
+                return [values[i:i + 3] for i in range(1, len(values), 3) if values[i + 1]]
+            elif slotKey == 0:
+                return []
+            slot = (slot + 1) & self.mask
+
+    def Order(self, game, moves):
+        """Sorts moves (legal in the game's current position) so that those in the table come first, best first.
+
+        The best is the one with the highest ScoreBound, then the most played.  Moves played in fewer
+        than MIN_ORDER_GAMES games, and the rest, keep their order after them.  Does nothing if the game
+        is past the plies the table covers."""
+        if len(game.moveStack) >= self.plies:
+            return
+        stats = [s for s in self.Lookup(game.positionKey) if s[1] >= MIN_ORDER_GAMES]
+        if not stats:
+            return
+        stats.sort(key = lambda (code, games, score): (-ScoreBound(games, score), -games))
+        ranks = dict([(code, rank) for (rank, (code, games, score)) in enumerate(stats)])
+        moves.sort(key = lambda move: ranks.get(move.Encode(), MAX_MOVES))
+
+
+defaultMoveStats = None
+
+def DefaultMoveStats():
+    """Returns the MoveStats in DEFAULT_STATS, opening it on first use; None if there isn't one."""
+    global defaultMoveStats
+    if defaultMoveStats == None and os.path.exists(DEFAULT_STATS):
+        defaultMoveStats = MoveStats(DEFAULT_STATS)
+    return defaultMoveStats
+
+
+# Building
+
+def PositionStats(database, occurrences):
+    """Returns the (move code, games, score) list for one position, from its (game id, ply) occurrences in database.
+
+    A game where the position repeated counts only once, at its first occurrence."""
+    stats = {}  # Move code -> [games, games with a known result, points, in half-points]
+    counted = set()
+    for (gameId, ply) in sorted(occurrences):
+        if gameId in counted:
+            continue
+        counted.add(gameId)
+        code = database.MoveCode(gameId, ply)
+        if code == None:
+            continue  # The game ended here.
+        if code not in stats:
+            stats[code] = [0, 0, 0]
+        counts = stats[code]
+        counts[0] += 1
+        result = database.Result(gameId)
+        if result == TIE_RESULT:
+            counts[1] += 1
+            counts[2] += 1
+        elif result in ('1-0', '0-1'):
+            counts[1] += 1
+            if (result == '1-0') == (ply % 2 == PLAYER_SILVER):  # Silver moves first.
+                counts[2] += 2
+
+    result = []
+    for (code, (games, decided, points)) in stats.items():
+        if decided:
+            score = int(round(50.0 * points / decided))
+        else:
+            score = 50
+        result.append((code, min(games, MAX_GAMES), score))
+    result.sort(key = lambda s: (-s[1], -s[2]))
+    return result
+
+def Build(database, plies = 8, minGames = 2):
+    """Returns a list of (key, move stats) for the positions in the first plies of the games in database.
+
+    Moves played in fewer than minGames games are left out, and so are positions left with no moves."""
+    import khetDatabase
+    result = []
+    entries = heapq.merge(*[segment.Entries() for segment in database.segments])
+    for (packedKey, group) in itertools.groupby(entries, lambda entry: entry[:8]):
+        occurrences = []
+        for entry in group:
+            (key, gameId, ply) = khetDatabase.entryStruct.unpack(entry)
+            if ply < plies:
+                occurrences.append((gameId, ply))
+        if not occurrences:
+            continue
+        stats = [s for s in PositionStats(database, occurrences) if s[1] >= minGames][:MAX_MOVES]
+        if stats:
+            result.append((key, stats))
+    return result
+
+def Write(filename, positions, plies):
+    """Writes the given (key, move stats) list as a table covering the given number of plies."""
+    slots = 1
+    while slots < 2 * len(positions):
+        slots *= 2
+    mask = slots - 1
+    table = [None] * slots
+    for (key, stats) in positions:
+        if key == 0:
+            continue  # Marks an empty slot; a real position with this key can do without.
+        slot = key & mask
+        while table[slot] != None:
+            slot = (slot + 1) & mask
+        table[slot] = (key, stats)
+
+    emptySlot = '\0' * SLOT_SIZE
+    f = open(filename, 'wb')
+    try:
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, STATS_VERSION, slots, len(positions), plies))
+        for entry in table:
+            if entry == None:
+                f.write(emptySlot)
+            else:
+                (key, stats) = entry
+                values = [key]
+                for s in stats + [(0, 0, 0)] * (MAX_MOVES - len(stats)):
+                    values.extend(s)
+                f.write(slotStruct.pack(*values))
+    finally:
+        f.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog build|show [options] [table] [moves]")
+    parser.add_option("-d", "--database", default = None, help = "build: the game database to take the statistics from")
+    parser.add_option("-o", "--output", default = DEFAULT_STATS, help = "build: table to write (default %default)")
+    parser.add_option("-p", "--plies", type = "int", default = 8, help = "build: plies from the start of each game to cover (default %default)")
+    parser.add_option("-m", "--min-games", type = "int", default = 2, dest = "minGames",
+                      help = "build: leave out moves played in fewer games than this (default %default)")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+
+    if args[0] == 'build':
+        import khetDatabase
+        if not options.database:
+            parser.error("missing database")
+        positions = Build(khetDatabase.GameDatabase(options.database), options.plies, options.minGames)
+        Write(options.output, positions, options.plies)
+        print "Wrote %d positions to %s." % (len(positions), options.output)
+
+    elif args[0] == 'show':
+        if len(args) > 1:
+            stats = MoveStats(args[1])
+        else:
+            stats = MoveStats(DEFAULT_STATS)
+        game = Game()
+        if len(args) > 2:
+            game.TakeTurns(" ".join(args[2:]).split())
+        print "%d positions, to ply %d." % (len(stats), stats.plies)
+        for (code, games, score) in stats.Lookup(game.positionKey):
+            print "%-8s %6d games, scoring %d%% (at least %d%%)" % \
+                (str(Move.Decode(code, game.board)).split()[0], games, score, int(100 * ScoreBound(games, score)))
+
+    else:
+        parser.error("unknown command %s" % args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""khetPosition
+
+A compact, canonical binary encoding of a board position, and bulk encoding and decoding
+of many positions packed end to end in one buffer.
+
+Every position reachable from the standard setups holds at most the standard set of pieces:
+for each side, a Pharaoh, four Obelisks (counting each half of a stack), seven Pyramids, and
+two Djeds.  So a position is a fixed table of 28 piece slots, one byte each: the row in the
+high nibble and the column in the low one, with 0xFF for a piece that's off the board
+(a stack is two Obelisk slots on the same square).  That's followed by two bits of rotation
+per slot and a byte for the side to move, for POSITION_SIZE = 36 bytes in all.
+
+Slots of the same color and kind are sorted, so equal positions always encode to equal bytes,
+whatever order the pieces were moved in; the encoding can be compared and hashed directly.
+Records are fixed-size and have no header, so record i of a buffer, file, or mmap is at
+offset i * POSITION_SIZE.
+
+Decoding into a Game that was decoded into before reuses its pieces, moving, turning and
+stacking them into place, so decoding a buffer into one Game creates no objects per position."""
+
+import mmap
+import os
+import struct
+
+from khetGame import *
+
+
+# The piece slots, in encoding order: (color, letter code, slot count).
+slotKinds = [(color, letterCode, count) for color in players for (letterCode, count) in [('P', 1), ('O', 4), ('p', 7), ('D', 2)]]
+numSlots = sum([count for (color, letterCode, count) in slotKinds])
+
+OFF_BOARD = 0xFF
+POSITION_SIZE = numSlots + numSlots / 4 + 1
+positionStruct = struct.Struct('%dB' % POSITION_SIZE)
+
+pieceClasses = {'P': Pharaoh, 'O': Obelisk, 'p': Pyramid, 'D': Djed}
+
+
+class PositionError(Exception):
+    """Raised when a position can't be encoded, or bytes don't decode to a position."""
+    pass
+
+
+def EncodeValues(game):
+    """Returns the encoding of the game's current position as a list of POSITION_SIZE byte values."""
+    # Collect the (square, rotation) of each piece, by color and kind.
+    found = {}
+    for kind in slotKinds:
+        found[kind[:2]] = []
+    for piece in allPieces(game.board):
+        entry = ((piece.square.row << 4) | piece.square.col, piece.rotation / 90)
+        pieces = found[(piece.color, piece.letterCode)]
+        pieces.append(entry)
+        if getattr(piece, 'stacked', False):
+            pieces.append(entry)
+
+    squares = []
+    rotations = []
+    for (color, letterCode, count) in slotKinds:
+        pieces = found[(color, letterCode)]
+        if len(pieces) > count:
+            raise PositionError("%s has too many of piece %s to encode" % (colorName[color], letterCode))
+        pieces.sort()
+        pieces.extend([(OFF_BOARD, 0)] * (count - len(pieces)))
+        for (square, rotation) in pieces:
+            squares.append(square)
+            rotations.append(rotation)
+
+    for i in range(0, numSlots, 4):
+        squares.append(rotations[i] | rotations[i + 1] << 2 | rotations[i + 2] << 4 | rotations[i + 3] << 6)
+    squares.append(game.activePlayer)
+    return squares
+
+def Encode(game):
+    """Returns the encoding of the game's current position, as a string of POSITION_SIZE bytes."""
+    return positionStruct.pack(*EncodeValues(game))
+
+def EncodeInto(game, buffer, offset = 0):
+    """Writes the encoding of the game's current position into a writable buffer (bytearray, array, mmap) at offset."""
+    positionStruct.pack_into(buffer, offset, *EncodeValues(game))
+
+def SlotPieces(game):
+    """Returns the game's pieces for decoding into, one per slot, creating them the first time.
+
+    They're kept in game.decodedPieces; the second Obelisk of a stack goes unused."""
+    pieces = getattr(game, 'decodedPieces', None)
+    if pieces == None:
+        pieces = game.decodedPieces = []
+        for (color, letterCode, count) in slotKinds:
+            for i in range(count):
+                if letterCode == 'O':
+                    pieces.append(Obelisk(color, False))
+                else:
+                    pieces.append(pieceClasses[letterCode](color, 0))
+    return pieces
+
+def DecodeValues(values, game = None):
+    """Sets up a game with the position in the given sequence of POSITION_SIZE byte values, and returns it.
+
+    If game is None, creates a new Game; otherwise replaces the given game's position and forgets its moves.
+    The pieces are the game's own from SlotPieces, so any pieces from before are taken off the board."""
+    if game == None:
+        game = Game()
+    activePlayer = values[-1]
+    if activePlayer not in players:
+        raise PositionError("bad side to move %d" % activePlayer)
+    game.ClearHistory()
+    game.activePlayer = activePlayer
+    board = game.board
+    for row in board:
+        for square in row:
+            square.piece = None
+
+    pieces = SlotPieces(game)
+    placed = []  # Squares with pieces on them.
+    slot = 0
+    for (color, letterCode, count) in slotKinds:
+        lastSquare = None
+        for i in range(slot, slot + count):
+            piece = pieces[i]
+            piece.square = None
+            square = values[i]
+            if letterCode == 'O':
+                piece.stacked = False
+                if square == lastSquare and square != OFF_BOARD:
+                    # The other half of a stack we just placed.
+                    board[square >> 4][square & 15].piece.stacked = True
+                    continue
+            piece.rotation = (values[numSlots + i / 4] >> (i % 4 * 2) & 3) * 90
+            if square != OFF_BOARD:
+                (row, col) = (square >> 4, square & 15)
+                if not IsLegalSquare(row, col) or board[row][col].piece:
+                    raise PositionError("bad square %02x in slot %d" % (square, i))
+                boardSquare = board[row][col]
+                boardSquare.piece = piece
+                piece.square = boardSquare
+                placed.append(boardSquare)
+            if letterCode == 'P':
+                # Keep captured Pharaohs too, so IsOver() works.
+                game.pharaohs[color] = piece
+            lastSquare = square
+        slot += count
+
+    # As RefreshPositionKey does, but only looking at the squares with pieces.
+    positionKey = 0
+    mirrorKey = 0
+    for square in placed:
+        positionKey ^= SquareKey(square)
+        mirrorKey ^= MirrorSquareKey(square)
+    if activePlayer == PLAYER_RED:
+        positionKey ^= zobristRedToMove
+    else:
+        mirrorKey ^= zobristRedToMove
+    game.positionKey = positionKey
+    game.mirrorKey = mirrorKey
+    game.InvalidateMoves()
+    return game
+
+def Decode(data, offset = 0, game = None):
+    """Returns a game set up with the position encoded in any buffer (string, bytearray, mmap) at offset.
+
+    If game is given, it's reused rather than creating a new one."""
+    return DecodeValues(positionStruct.unpack_from(data, offset), game)
+
+
+# Bulk encoding and decoding
+
+def EncodeAll(games):
+    """Returns a bytearray holding the current positions of all the given games, end to end."""
+    games = list(games)
+    result = bytearray(len(games) * POSITION_SIZE)
+    for (i, game) in enumerate(games):
+        EncodeInto(game, result, i * POSITION_SIZE)
+    return result
+
+def Count(data):
+    """Returns the number of positions in a buffer."""
+    if len(data) % POSITION_SIZE:
+        raise PositionError("buffer length %d isn't a whole number of positions" % len(data))
+    return len(data) / POSITION_SIZE
+
+def DecodeAll(data, game = None):
+    """A generator that decodes each position in the buffer in turn.
+
+    Decodes into the same Game each time (a new one if game is None), so don't hold on to it between iterations;
+    the buffer is read in place, without copying."""
+    if game == None:
+        game = Game()
+    for i in xrange(Count(data)):
+        yield Decode(data, i * POSITION_SIZE, game)
+
+def WriteAll(f, games):
+    """Appends the current positions of the given games to the open binary file f."""
+    for game in games:
+        f.write(Encode(game))
+
+def MapFile(filename):
+    """Returns a read-only mmap of a file of positions, for use with Decode, DecodeAll, and Count.
+
+    Returns an empty string for an empty file, which mmap won't map."""
+    f = open(filename, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        f.close()
@@ -0,0 +1,227 @@
+"""khetProtocol
+
+A line-based text protocol for running a Khet engine in a process of its own,
+talking over stdin and stdout, plus the driver that exposes any KhetEngine through it.
+Run this module to serve an engine: python khetProtocol.py [engine name].
+
+Commands, one per line, sent to the engine:
+    khet                        Identify; the engine replies "id name <name>", then "khetok".
+    isready                     The engine replies "readyok", even in the middle of a search.
+    newgame                     Forget the previous game.
+    position classic [moves <move> ...]
+                                Set the position: the Classic setup, followed by the given moves.
+    go [depth <plies>] [movetime <ms>] [nodes <count>]
+                                Search the current position, within the given limits.
+                                With no limits, the engine decides when it's done.
+    stop                        Finish the current search early.  Its bestmove is still sent.
+    quit                        Exit as soon as possible.
+
+Replies from the engine:
+    info depth <plies> score <score> nodes <count> nps <count> time <ms> pv <move> ...
+                                Progress, sent periodically during a search.
+                                Scores are positive for Silver, as with the engines themselves.
+    info string <text>          A message for humans, e.g. about an unknown command.
+    bestmove <move>             The result of a search; "bestmove none" if there's no legal move.
+
+Moves are written as Move.__str__() does, without the hit annotation: e.g. "pd6c6", "De5>", "Oe8e7-"."""
+
+import optparse
+import Queue
+import sys
+import threading
+
+from khetGame import *
+from engines import ENGINES  # Engine modules are only imported when an engine is chosen.
+
+DEFAULT_ENGINE = 'raneb'
+
+
+# Message formatting and parsing, shared by both ends.
+
+def MoveText(move):
+    """Returns the protocol's notation for a move (its string form, without the hit annotation)."""
+    return str(move).split()[0]
+
+def FormatPosition(moveStrings):
+    if moveStrings:
+        return "position classic moves " + " ".join(moveStrings)
+    else:
+        return "position classic"
+
+def ParsePosition(words):
+    """Returns the list of moves given in a 'position' command's words (after the command itself)."""
+    if not words or words[0] != 'classic':
+        raise ValueError("unsupported position: %s" % " ".join(words))
+    if len(words) > 1 and words[1] == 'moves':
+        return words[2:]
+    return []
+
+def FormatGo(depth = None, moveTime = None, nodes = None):
+    """Returns a 'go' command; moveTime is in seconds."""
+    result = "go"
+    if depth != None:
+        result += " depth %d" % depth
+    if moveTime != None:
+        result += " movetime %d" % int(moveTime * 1000)
+    if nodes != None:
+        result += " nodes %d" % nodes
+    return result
+
+def ParseGo(words):
+    """Returns (depth, moveTime, nodes) from a 'go' command's words; moveTime is in seconds."""
+    limits = {}
+    for i in range(0, len(words) - 1, 2):
+        limits[words[i]] = int(words[i + 1])
+    moveTime = limits.get('movetime')
+    if moveTime != None:
+        moveTime /= 1000.0
+    return (limits.get('depth'), moveTime, limits.get('nodes'))
+
+def FormatInfo(stats):
+    elapsed = stats['time']
+    if elapsed > 0:
+        nps = int(stats['nodes'] / elapsed)
+    else:
+        nps = 0
+    result = "info depth %d score %g nodes %d nps %d time %d" % \
+        (stats['depth'], stats['score'], stats['nodes'], nps, int(elapsed * 1000))
+    if stats['pv']:
+        result += " pv " + " ".join(stats['pv'])
+    return result
+
+def ParseInfo(words):
+    """Returns a stats dictionary (as from KhetEngine.GetStats) from an 'info' reply's words."""
+    result = {'depth': 0, 'score': 0, 'nodes': 0, 'time': 0, 'pv': []}
+    i = 0
+    while i < len(words):
+        key = words[i]
+        if key == 'pv':
+            result['pv'] = words[i + 1:]
+            break
+        elif key == 'score':
+            result['score'] = float(words[i + 1])
+        elif key == 'time':
+            result['time'] = int(words[i + 1]) / 1000.0
+        else:
+            result[key] = int(words[i + 1])
+        i += 2
+    return result
+
+
+def ReadLines(stream, lines, atEnd):
+    """Copies lines from stream into the queue lines until the stream ends, then queues atEnd.
+
+    Meant to run on its own thread, so the reading end never blocks on the pipe."""
+    for line in iter(stream.readline, ''):
+        lines.put(line.strip())
+    lines.put(atEnd)
+
+
+class EngineDriver:
+    """Serves a KhetEngine over the protocol, reading commands from input and writing replies to output."""
+    def __init__(self, engine, input = sys.stdin, output = sys.stdout):
+        self.engine = engine
+        self.engine.verbose = False  # The console is ours now.
+        self.input = input
+        self.output = output
+        self.commands = Queue.Queue()
+        self.deferred = []  # Commands that arrived during a search, to handle after it.
+        self.moves = []
+        self.stopping = False
+        self.quitting = False
+
+    def Send(self, line):
+        self.output.write(line + "\n")
+        self.output.flush()
+
+    def Run(self):
+        reader = threading.Thread(target = ReadLines, args = (self.input, self.commands, 'quit'))
+        reader.setDaemon(True)
+        reader.start()
+
+        while not self.quitting:
+            if self.deferred:
+                line = self.deferred.pop(0)
+            else:
+                line = self.commands.get()
+            self.Handle(line)
+
+    def Handle(self, line):
+        words = line.split()
+        if not words:
+            return
+        command = words[0]
+        if command == 'khet':
+            self.Send("id name " + self.engine.name)
+            self.Send("khetok")
+        elif command == 'isready':
+            self.Send("readyok")
+        elif command == 'newgame':
+            self.moves = []
+        elif command == 'position':
+            self.moves = ParsePosition(words[1:])
+        elif command == 'go':
+            self.Go(words[1:])
+        elif command == 'quit':
+            self.quitting = True
+        elif command == 'stop':
+            pass  # Nothing to stop.
+        else:
+            self.Send("info string unknown command: " + line)
+
+    def Go(self, words):
+        (depth, moveTime, nodes) = ParseGo(words)
+        game = Game()
+        game.TakeTurns(self.moves)
+
+        self.stopping = False
+        if game.IsOver():
+            move = None
+        else:
+            move = self.engine.AnalyzeWithLimits(game, depth, moveTime, nodes, self.PollDuringSearch, self.SendInfo)
+        if move:
+            self.Send("bestmove " + MoveText(move))
+        else:
+            self.Send("bestmove none")
+
+    def PollDuringSearch(self):
+        """Handles any commands that have arrived mid-search.  Returns True if the search should stop."""
+        while True:
+            try:
+                line = self.commands.get_nowait()
+            except Queue.Empty:
+                break
+            command = line.split()[:1]
+            if command == ['stop']:
+                self.stopping = True
+            elif command == ['quit']:
+                self.stopping = True
+                self.quitting = True
+            elif command == ['isready']:
+                self.Send("readyok")
+            else:
+                self.deferred.append(line)
+        return self.stopping
+
+    def SendInfo(self, stats):
+        self.Send(FormatInfo(stats))
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%%prog [%s]" % "|".join(sorted(ENGINES.keys())))
+    parser.add_option("--memory", type = "int", default = None, help = "memory budget for the search, in megabytes, for engines that have one")
+    (options, args) = parser.parse_args()
+    if args:
+        name = args[0].lower()
+    else:
+        name = DEFAULT_ENGINE
+    if name not in ENGINES:
+        parser.error("unknown engine %s" % name)
+    engine = ENGINES[name]()
+    if options.memory != None and hasattr(engine, 'memoryBudget'):
+        engine.memoryBudget = options.memory * 1024 * 1024
+    EngineDriver(engine).Run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""khetRecord
+
+Streaming reading and writing of files holding many concatenated game records,
+each in the format produced by Game.__str__().
+
+Records are read lazily, one at a time, so archives of any size can be processed in
+constant memory.  Replaying a record's moves on a board is the expensive part, so it's
+optional: GameRecord keeps the headers and move text, and replays only when asked."""
+
+from khetGame import *
+
+
+class GameRecord:
+    """One game as it appears in a file: its headers, moves, and result, without a board."""
+    def __init__(self, headers, moveText):
+        self.headers = headers
+        self.moveText = moveText
+        self.parsedMoves = None
+        self.result = None
+
+    def GetMoves(self):
+        """Returns a list of (move string, hit square string or None), parsing the move text the first time."""
+        if self.parsedMoves == None:
+            (self.parsedMoves, self.result) = ParseMoveText(self.moveText)
+        return self.parsedMoves
+
+    def GetResult(self):
+        """Returns the result header, or the result at the end of the moves; None if neither is there."""
+        if 'Result' in self.headers:
+            return self.headers['Result']
+        self.GetMoves()
+        return self.result
+
+    def MoveStrings(self):
+        return [move for (move, hit) in self.GetMoves()]
+
+    def Replay(self, validate = True):
+        """Returns a new Game with the record's moves played on it.
+
+        If validate is set, raises RecordError if replay hits different pieces than the record says."""
+        game = Game()
+        game.headers = dict(self.headers)
+        for p in players:
+            game.playerNames[p] = self.headers.get(colorName[p], game.playerNames[p])
+        game.ReplayMoves(self.GetMoves(), validate)
+        game.SetRecordedResult(self.GetResult())
+        return game
+
+    def __str__(self):
+        lines = ['[%s "%s"]\n' % (name, value) for (name, value) in sorted(self.headers.items())]
+        lines.append(self.moveText)
+        return "".join(lines)
+
+
+def ReadRecords(f):
+    """A generator yielding each GameRecord in the open file f, in order.
+
+    A record is a run of header lines followed by move text; it ends at a blank line,
+    the next record's headers, or the end of the file."""
+    headers = {}
+    moveLines = []
+    for line in f:
+        line = line.strip()
+        if line.startswith('['):
+            if moveLines:
+                yield GameRecord(headers, " ".join(moveLines))
+                headers = {}
+                moveLines = []
+            (name, value) = ParseHeader(line)
+            headers[name] = value
+        elif line:
+            moveLines.append(line)
+        elif moveLines or headers:
+            yield GameRecord(headers, " ".join(moveLines))
+            headers = {}
+            moveLines = []
+    if moveLines or headers:
+        yield GameRecord(headers, " ".join(moveLines))
+
+def ReadGames(f, validate = True):
+    """A generator yielding each record in the open file f, replayed as a Game."""
+    for record in ReadRecords(f):
+        yield record.Replay(validate)
+
+def WriteGames(f, games):
+    """Writes each of the given Games (or GameRecords) to the open file f, separated by blank lines.
+
+    games can be any iterable, including a generator, so records can be streamed straight through."""
+    for game in games:
+        f.write(str(game))
+        f.write("\n\n")
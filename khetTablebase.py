@@ -0,0 +1,443 @@
+"""khetTablebase
+
+Endgame tablebases: every position with a given small set of pieces, solved exactly.
+
+A material signature names the pieces on each side, Silver's first: "Pp-P" is Silver's Pharaoh and
+one Pyramid against Red's lone Pharaoh.  Besides its Pharaoh, each side can have Pyramids (p),
+Djeds (D), and at most one Obelisk (O) - two could stack, and stacks aren't covered.
+
+Each position gets a dense index: a mixed-radix number with one digit per piece (which of the
+squares that piece's color may stand on, times its distinct rotations) and a last digit for the
+side to move.  Positions with two pieces on one square are marked invalid.
+
+Generating a table plays every legal move from every position with the game's own rules.
+Moves whose laser hits nothing lead to another position in the same table; moves that hit a
+Pharaoh end the game, and moves that hit any other piece lead into a smaller table, which
+is generated first.  The positions are then solved by retrograde analysis, working back from
+the known results one ply at a time: a position is won in d plies if some move leads to a
+position lost in d - 1, and lost if every move leads to a won one.  Whatever is left over can't
+be forced either way, so it's a draw.  Move generation is split across processes; the solving
+is vectorized, so generation needs NumPy (probing doesn't).
+
+Each table is stored as one byte per position, the result in the top two bits and the distance
+to the end in plies (capped at MAX_DISTANCE) in the rest, and is memory-mapped for probing.
+
+That's a deliberate trade-off against packing the results two bits to a position under a perfect
+index of only the legal placements.  Probing needs the distance as well as the result, to score
+a win by how soon it comes, so a separate distance array would give back most of what packing the
+results saved, and cost a second read.  And the dense index only wastes the slots where pieces
+overlap - squares a color can't use aren't numbered - which is 1% of P-P, 4% of the three-piece
+tables and about 8% of the four-piece ones; ranking placements without overlaps would make each
+index computation a combinatorial sum, both when generating and when probing from a search.
+
+Usage:
+    python khetTablebase.py generate P-P Pp-P PD-P -d tablebases
+    python khetTablebase.py stats Pp-P -d tablebases
+
+Engines look in the tablebases directory next to this file (see DefaultTablebases)."""
+
+import array
+import mmap
+import optparse
+import os
+import struct
+
+from khetGame import *
+
+numpy = None  # Only needed for generating, so imported then, by RequireNumpy; engines don't pay for it.
+
+
+HEADER_FORMAT = '<4sII'
+HEADER_MAGIC = 'KTBL'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TABLEBASE_VERSION = 1
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebases')
+
+# Results, from the point of view of the player to move.
+DRAW = 0
+WIN = 1
+LOSS = 2
+INVALID = 3
+
+resultNames = ['draw', 'win', 'loss', 'invalid']
+
+MAX_DISTANCE = 63
+
+# Piece kinds other than the Pharaoh, in signature order.
+KIND_ORDER = 'ODp'
+
+# How many rotations of each kind behave differently; a Djed at 180 is the same as one at 0.
+rotationStates = {'P': 1, 'O': 1, 'D': 2, 'p': 4}
+
+pieceClasses = {'P': Pharaoh, 'O': Obelisk, 'D': Djed, 'p': Pyramid}
+
+# The squares each color's pieces may stand on, and each one's number in that list.
+legalSquares = []
+squareNumbers = []
+for color in players:
+    legalSquares.append([(square.row, square.col) for square in allSquares(Game().board) if square.color in (PLAYER_NONE, color)])
+    squareNumbers.append(dict([(rowCol, i) for (i, rowCol) in enumerate(legalSquares[color])]))
+
+
+class TablebaseError(Exception):
+    pass
+
+
+class Signature:
+    """A material signature, and the indexing of the positions that have it."""
+    def __init__(self, name):
+        self.name = name
+        sides = name.split('-')
+        if len(sides) != 2:
+            raise TablebaseError("bad signature %s" % name)
+        # The pieces, as (color, kind), in index order: each side's Pharaoh, then its other pieces in KIND_ORDER.
+        self.slots = []
+        for (color, side) in zip(players, sides):
+            if not side.startswith('P') or [kind for kind in side[1:] if kind not in KIND_ORDER] or side.count('O') > 1:
+                raise TablebaseError("bad signature %s" % name)
+            self.slots.append((color, 'P'))
+            self.slots.extend([(color, kind) for kind in sorted(side[1:], key = KIND_ORDER.index)])
+        self.name = "-".join([SideName([kind for (c, kind) in self.slots if c == color]) for color in players])
+
+        self.radices = [len(legalSquares[color]) * rotationStates[kind] for (color, kind) in self.slots]
+        self.size = 2
+        for radix in self.radices:
+            self.size *= radix
+
+    def Index(self, pieces, sideToMove):
+        """Returns the index of the position with the given pieces (in slot order) on the board."""
+        result = 0
+        for (piece, radix) in zip(pieces, self.radices):
+            states = rotationStates[piece.letterCode]
+            digit = squareNumbers[piece.color][(piece.square.row, piece.square.col)] * states + piece.rotation / 90 % states
+            result = result * radix + digit
+        return result * 2 + sideToMove
+
+    def Decode(self, index):
+        """Returns the position with the given index, as ([(row, col, rotation) for each slot], side to move)."""
+        sideToMove = index % 2
+        index /= 2
+        placement = []
+        for i in range(len(self.slots) - 1, -1, -1):
+            (color, kind) = self.slots[i]
+            (index, digit) = divmod(index, self.radices[i])
+            (squareNumber, rotation) = divmod(digit, rotationStates[kind])
+            (row, col) = legalSquares[color][squareNumber]
+            placement.append((row, col, rotation * 90))
+        placement.reverse()
+        return (placement, sideToMove)
+
+    def Smaller(self):
+        """Returns the names of the signatures reachable by a laser hit, i.e. with one Pyramid or Obelisk fewer."""
+        result = []
+        for i in range(len(self.slots)):
+            (color, kind) = self.slots[i]
+            if kind in 'Op':
+                rest = self.slots[:i] + self.slots[i + 1:]
+                name = "-".join([SideName([k for (c, k) in rest if c == p]) for p in players])
+                if name not in result:
+                    result.append(name)
+        return result
+
+
+def SideName(kinds):
+    return 'P' + "".join(sorted([kind for kind in kinds if kind != 'P'], key = KIND_ORDER.index))
+
+def SignatureOf(game, maxPieces = None):
+    """Returns (signature name, the pieces in slot order) for the game's position.
+
+    Returns None if the game is over, there's a stacked Obelisk, or there are more than maxPieces pieces."""
+    if game.IsOver():
+        return None
+    sides = [[], []]
+    count = 0
+    for piece in allPieces(game.board):
+        count += 1
+        if getattr(piece, 'stacked', False) or (maxPieces != None and count > maxPieces):
+            return None
+        sides[piece.color].append(piece)
+    for side in sides:
+        # Group by kind, Pharaoh first; the order within a kind doesn't matter, so long as it's consistent.
+        side.sort(key = lambda piece: ('P' + KIND_ORDER).index(piece.letterCode))
+    name = "-".join([SideName([piece.letterCode for piece in side]) for side in sides])
+    return (name, sides[0] + sides[1])
+
+
+class Tablebase:
+    """One generated table, mapped into memory for probing."""
+    def __init__(self, filename):
+        self.signature = Signature(os.path.splitext(os.path.basename(filename))[0])
+        f = open(filename, 'rb')
+        try:
+            (magic, version, size) = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+            if magic != HEADER_MAGIC or version != TABLEBASE_VERSION or size != self.signature.size \
+               or os.fstat(f.fileno()).st_size != HEADER_SIZE + size:
+                raise TablebaseError("%s is not a compatible tablebase" % filename)
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def Lookup(self, index):
+        """Returns (result, distance) for the position with the given index."""
+        value = ord(self.data[HEADER_SIZE + index])
+        return (value >> 6, value & MAX_DISTANCE)
+
+    def Close(self):
+        self.data.close()
+
+
+class Tablebases:
+    """All the tables in a directory, by signature name."""
+    def __init__(self, directory = DEFAULT_DIRECTORY):
+        self.tables = {}
+        self.maxPieces = 0
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename.endswith('.ktb'):
+                    table = Tablebase(os.path.join(directory, filename))
+                    self.tables[table.signature.name] = table
+                    self.maxPieces = max(self.maxPieces, len(table.signature.slots))
+
+    def __len__(self):
+        return len(self.tables)
+
+    def Probe(self, game, sideToMove):
+        """Returns (result, distance) for the game's position with the given player to move; None if there's no table for it."""
+        found = SignatureOf(game, self.maxPieces)
+        if found == None or found[0] not in self.tables:
+            return None
+        table = self.tables[found[0]]
+        return table.Lookup(table.signature.Index(found[1], sideToMove))
+
+
+defaultTablebases = None
+
+def DefaultTablebases():
+    """Returns the Tablebases in DEFAULT_DIRECTORY, loading them on first use; None if there aren't any."""
+    global defaultTablebases
+    if defaultTablebases == None:
+        defaultTablebases = Tablebases()
+    if len(defaultTablebases) == 0:
+        return None
+    return defaultTablebases
+
+
+# Generating
+
+def AnalyzeRange(name, start, stop, directory):
+    """Plays every move from positions start through stop - 1 of a table.  Runs in a worker process.
+
+    Returns strings of packed arrays, one entry per position unless noted:
+    flags (1 = invalid, 2 = some move leads to a draw in a smaller table, or there are no moves),
+    the shortest win by a move that ends the game or leaves the table (0 if none),
+    the longest loss likewise, the number of moves staying in the table, and their indices (one per move)."""
+    signature = Signature(name)
+    smaller = Tablebases(directory)
+    game = Game()
+    game.ResetGame()
+    pieces = [pieceClasses[kind](color, 0) for (color, kind) in signature.slots]
+    for piece in pieces:
+        if piece.letterCode == 'O':
+            piece.stacked = False
+    game.pharaohs = [pieces[0], pieces[[kind for (color, kind) in signature.slots].index('P', 1)]]
+
+    flags = array.array('b')
+    winDistances = array.array('h')
+    lossDistances = array.array('h')
+    counts = array.array('i')
+    successors = array.array('i')
+    for index in xrange(start, stop):
+        (placement, sideToMove) = signature.Decode(index)
+        for piece in pieces:
+            piece.MoveTo(None)
+        valid = True
+        for (piece, (row, col, rotation)) in zip(pieces, placement):
+            if game.board[row][col].piece:
+                valid = False
+                break
+            game.MoveTo(row, col, piece)
+            piece.rotation = rotation
+        if not valid:
+            flags.append(1)
+            winDistances.append(0)
+            lossDistances.append(0)
+            counts.append(0)
+            continue
+
+        game.activePlayer = sideToMove
+        flag = 0
+        winDistance = 0
+        lossDistance = 0
+        count = 0
+        for piece in pieces:
+            if piece.color != sideToMove:
+                continue
+            for move in piece.EnumerateMoves(game.board):
+                game.MakeAndPushMove(move)
+                try:
+                    game.FireLaser(move)
+                    hitPiece = move.hitPiece
+                    if hitPiece == None:
+                        successors.append(signature.Index(pieces, 1 - sideToMove))
+                        count += 1
+                        continue
+                    if isinstance(hitPiece, Pharaoh):
+                        if hitPiece.color == sideToMove:
+                            (result, distance) = (LOSS, 1)
+                        else:
+                            (result, distance) = (WIN, 1)
+                    else:
+                        found = smaller.Probe(game, 1 - sideToMove)
+                        if found == None:
+                            raise TablebaseError("%s needs a table for %s" % (name, SignatureOf(game)[0]))
+                        (result, distance) = found
+                        # That's for the opponent; turn it around.
+                        result = {DRAW: DRAW, WIN: LOSS, LOSS: WIN}[result]
+                        distance += 1
+                    if result == WIN:
+                        if winDistance == 0 or distance < winDistance:
+                            winDistance = distance
+                    elif result == LOSS:
+                        lossDistance = max(lossDistance, distance)
+                    else:
+                        flag |= 2
+                finally:
+                    game.UndoAndPopLastMove()
+        if count == 0 and winDistance == 0 and lossDistance == 0:
+            flag |= 2  # No moves at all; call it a draw.
+        flags.append(flag)
+        winDistances.append(winDistance)
+        lossDistances.append(lossDistance)
+        counts.append(count)
+
+    return (flags.tostring(), winDistances.tostring(), lossDistances.tostring(), counts.tostring(), successors.tostring())
+
+def AnalyzeRangeJob(args):
+    return AnalyzeRange(*args)
+
+def Solve(flags, winDistances, lossDistances, counts, successors):
+    """Retrograde analysis over the move graph.  Returns (results, distances) as NumPy arrays."""
+    size = len(flags)
+    sources = numpy.repeat(numpy.arange(size), counts)
+    results = numpy.zeros(size, numpy.int8)
+    distances = numpy.zeros(size, numpy.int32)
+    results[(flags & 1) != 0] = INVALID
+    canDraw = (flags & 2) != 0
+    lastExternal = max(winDistances.max(), lossDistances.max())
+
+    distance = 1
+    while True:
+        unknown = results == DRAW
+        successorResults = results[successors]
+
+        # Won now: a move ends the game or leaves the table with a win this soon, or leads to a position lost one ply sooner.
+        winning = (winDistances == distance)
+        winning[sources[(successorResults == LOSS) & (distances[successors] == distance - 1)]] = True
+        winning &= unknown
+
+        # Lost now: every move loses, and the slowest of them loses at this distance.
+        successorWins = successorResults == WIN
+        winCounts = numpy.bincount(sources[successorWins], minlength = size)
+        losing = unknown & ~winning & ~canDraw & (winDistances == 0) & (winCounts == counts)
+        if losing.any():
+            longest = lossDistances.astype(numpy.int32)
+            edges = successorWins & losing[sources]
+            numpy.maximum.at(longest, sources[edges], distances[successors[edges]] + 1)
+            losing &= (longest == distance)
+
+        results[winning] = WIN
+        distances[winning] = distance
+        results[losing] = LOSS
+        distances[losing] = distance
+        if not winning.any() and not losing.any() and distance >= lastExternal:
+            break
+        distance += 1
+
+    return (results, distances)
+
+def RequireNumpy():
+    """Imports NumPy, the first time it's needed; raises TablebaseError if it's not installed."""
+    global numpy
+    if numpy == None:
+        try:
+            import numpy
+        except ImportError:
+            raise TablebaseError("generating tablebases needs NumPy")
+
+def Generate(name, directory = DEFAULT_DIRECTORY, processes = None, log = None):
+    """Generates the table for the named signature in directory, and any smaller ones it needs that aren't there yet."""
+    import multiprocessing
+    RequireNumpy()
+    signature = Signature(name)
+    filename = os.path.join(directory, signature.name + '.ktb')
+    if os.path.exists(filename):
+        return
+    for smallerName in signature.Smaller():
+        Generate(smallerName, directory, processes, log)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunk = max(1, signature.size / (8 * multiprocessing.cpu_count()))
+        jobs = [(signature.name, start, min(start + chunk, signature.size), directory) for start in range(0, signature.size, chunk)]
+        parts = pool.map(AnalyzeRangeJob, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    (flags, winDistances, lossDistances, counts, successors) = \
+        [numpy.fromstring("".join([part[i] for part in parts]), dtype) for (i, dtype) in enumerate(['b', 'h', 'h', 'i', 'i'])]
+    (results, distances) = Solve(flags, winDistances, lossDistances, counts, successors)
+    values = (results.astype(numpy.uint8) << 6) | numpy.minimum(distances, MAX_DISTANCE).astype(numpy.uint8)
+
+    f = open(filename + '.tmp', 'wb')
+    try:
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, TABLEBASE_VERSION, signature.size))
+        f.write(values.tostring())
+    finally:
+        f.close()
+    os.rename(filename + '.tmp', filename)
+    if log:
+        log("%s: %d positions, %d moves." % (signature.name, signature.size, len(successors)))
+
+
+def Stats(table):
+    """Returns a dictionary of counts by result name, and the longest win."""
+    result = dict([(name, 0) for name in resultNames])
+    longest = 0
+    for index in xrange(table.signature.size):
+        (value, distance) = table.Lookup(index)
+        result[resultNames[value]] += 1
+        if value == WIN:
+            longest = max(longest, distance)
+    result['longest win'] = longest
+    return result
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog generate|stats [options] signature...")
+    parser.add_option("-d", "--directory", default = DEFAULT_DIRECTORY, help = "where the tables are (default %default)")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "worker processes (default: one per core)")
+    (options, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.error("missing command or signature")
+
+    if args[0] == 'generate':
+        def Log(s):
+            print s
+        for name in args[1:]:
+            Generate(name, options.directory, options.processes, Log)
+
+    elif args[0] == 'stats':
+        for name in args[1:]:
+            table = Tablebase(os.path.join(options.directory, Signature(name).name + '.ktb'))
+            stats = Stats(table)
+            print "%s: %s" % (table.signature.name, ", ".join(["%s %d" % (key, stats[key]) for key in sorted(stats.keys())]))
+
+    else:
+        parser.error("unknown command %s" % args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""khetTexel
+
+Batch ("Texel-style") tuning of the evaluation weights against a dataset of positions.
+
+Self-play games are exported as rows of (evaluation features, game result) into a compact
+binary file; the weights are then fit by minimizing the error between each position's
+result and a logistic function of its evaluation, with vectorized gradient steps.
+Features come from NarmerEngine.EvaluationFeatures, so fitted weights are in the same
+units the engines use and can be loaded straight back with EvaluationWeights.Load.
+
+Usage:
+    python khetTexel.py export -o positions.ktx -n 1000
+    python khetTexel.py fit positions.ktx -o weights.txt
+    python khetTexel.py check"""
+
+import array
+import multiprocessing
+import optparse
+import os
+import random
+import struct
+import sys
+
+from khetGame import *
+from khetMatch import PlayGame, GameScore
+from engines.narmer import NarmerEngine, EvaluationWeights
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Only needed for fitting; exporting works without it.
+
+
+# Dataset file layout: a header, then rows of little-endian float32s - the features
+# in FEATURE_NAMES order, followed by the game result for Silver (1, 0.5, or 0).
+FEATURE_NAMES = NarmerEngine.FEATURE_NAMES
+HEADER_FORMAT = '<4sII'
+HEADER_MAGIC = 'KTXL'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DATASET_VERSION = 1
+
+# Weights the Menes engine's pared-down evaluation actually uses.
+MENES_WEIGHTS = ['stackedObelisk', 'obelisk', 'pyramid', 'laserPyramid']
+
+
+# Exporting
+
+def GameFeatureRows(seed, randomMoveRate, maxPlies):
+    """Plays one self-play game and returns its rows as a flat array of floats.
+
+    Each position is described as it is when the engine evaluates it: just after the mover's laser has fired,
+    with the mover still active.  Runs in a worker process."""
+    random.seed(seed)
+    engine = NarmerEngine()
+    engine.verbose = False
+    engine.book = None  # Book moves aren't the evaluation's choices.
+    engine.moveStats = None
+    features = []
+
+    def OnMove(game):
+        if not game.IsOver():
+            game.PassToNextPlayer()
+            try:
+                features.append(engine.EvaluationFeatures(game))
+            finally:
+                game.PassToNextPlayer()
+
+    game = PlayGame([engine, engine], maxPlies, onMove = OnMove, randomMoveRate = randomMoveRate)
+    score = GameScore(game, PLAYER_SILVER)
+
+    result = array.array('f')
+    for row in features:
+        result.extend(row)
+        result.append(score)
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result.tostring()
+
+def Export(filename, games, processes = None, randomMoveRate = 0.1, maxPlies = 200, seed = None):
+    """Appends rows from the given number of self-play games to the dataset file, creating it if needed."""
+    if os.path.exists(filename):
+        CheckHeader(filename)
+        f = open(filename, 'ab')
+    else:
+        f = open(filename, 'wb')
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, DATASET_VERSION, len(FEATURE_NAMES)))
+
+    rng = random.Random(seed)
+    jobs = [(rng.getrandbits(32), randomMoveRate, maxPlies) for i in range(games)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        rows = 0
+        for data in pool.imap_unordered(GameFeatureRowsJob, jobs):
+            f.write(data)
+            rows += len(data) / (4 * (len(FEATURE_NAMES) + 1))
+    finally:
+        pool.close()
+        pool.join()
+        f.close()
+    return rows
+
+def GameFeatureRowsJob(args):
+    return GameFeatureRows(*args)
+
+def CheckHeader(filename):
+    f = open(filename, 'rb')
+    try:
+        (magic, version, featureCount) = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+    finally:
+        f.close()
+    if magic != HEADER_MAGIC or version != DATASET_VERSION or featureCount != len(FEATURE_NAMES):
+        raise ValueError("%s is not a compatible position dataset" % filename)
+
+
+# Fitting
+
+def LoadDataset(filename):
+    """Maps the dataset file into memory; returns (features, results) as NumPy arrays."""
+    CheckHeader(filename)
+    data = numpy.memmap(filename, dtype = '<f4', mode = 'r', offset = HEADER_SIZE)
+    data = data.reshape((-1, len(FEATURE_NAMES) + 1))
+    return data[:, :-1], data[:, -1]
+
+def ModelScores(w, X, gradients = None):
+    """Evaluates positions the way NarmerEngine.EvaluatePosition does, for every row of X at once.
+
+    w is a dict of weights by name.  If gradients is a dict, it's filled in with the derivative of
+    each row's score with respect to each weight."""
+    col = dict([(name, X[:, i].astype(numpy.float64)) for i, name in enumerate(FEATURE_NAMES)])
+    kinds = NarmerEngine.MATERIAL_KINDS
+
+    score = w['laserPyramid'] * col['laserPyramid'] + w['guard'] * col['guard'] \
+        + w['pharaohFriend'] * (col['pharaohOrthogonal'] + w['diagonal'] * col['pharaohDiagonal'])
+    for kind in kinds:
+        score += w[kind] * col[kind]
+
+    # The opponent's threatened hit: full value against us, a capped fraction against them.
+    rawHit = sum([w[kind] * col['hit_' + kind] for kind in kinds])
+    againstThem = col['hitOpponent'] > 0.5
+    scaledHit = rawHit * w['hitFactor']
+    cappedHigh = againstThem & (scaledHit > w['hitCap'])
+    cappedLow = againstThem & (scaledHit < -w['hitCap'])
+    capped = cappedHigh | cappedLow
+    score -= numpy.where(againstThem, numpy.clip(scaledHit, -w['hitCap'], w['hitCap']), rawHit)
+
+    if gradients is not None:
+        hitSlope = numpy.where(againstThem, numpy.where(capped, 0, w['hitFactor']), 1)
+        for kind in kinds:
+            gradients[kind] = col[kind] - hitSlope * col['hit_' + kind]
+        gradients['laserPyramid'] = col['laserPyramid']
+        gradients['guard'] = col['guard']
+        gradients['pharaohFriend'] = col['pharaohOrthogonal'] + w['diagonal'] * col['pharaohDiagonal']
+        gradients['diagonal'] = w['pharaohFriend'] * col['pharaohDiagonal']
+        gradients['hitFactor'] = numpy.where(againstThem & ~capped, -rawHit, 0)
+        gradients['hitCap'] = numpy.where(cappedHigh, -1, numpy.where(cappedLow, 1, 0))
+    return score
+
+def Sigmoid(x):
+    return 1 / (1 + numpy.exp(-x))
+
+def DatasetError(w, X, results, k, chunkSize):
+    total = 0.0
+    for start in range(0, len(results), chunkSize):
+        p = Sigmoid(k * ModelScores(w, X[start:start + chunkSize]))
+        total += ((results[start:start + chunkSize] - p) ** 2).sum()
+    return total / len(results)
+
+def FindScale(w, X, results, chunkSize):
+    """Finds the logistic scale that best fits the starting weights, so only the weights need fitting."""
+    candidates = [0.01 * 1.25 ** i for i in range(30)]
+    return min(candidates, key = lambda k: DatasetError(w, X, results, k, chunkSize))
+
+def Fit(X, results, names, iterations = 500, learningRate = 0.05, chunkSize = 1000000, start = None, log = None):
+    """Fits the named weights to the dataset with Adam-style gradient steps; the rest stay fixed.
+
+    Returns (EvaluationWeights, final mean squared error)."""
+    if start == None:
+        start = EvaluationWeights()
+    w = dict([(name, float(getattr(start, name))) for name in EvaluationWeights.NAMES])
+    k = FindScale(w, X, results, chunkSize)
+    if log:
+        log("Scale %g, starting error %.6f" % (k, DatasetError(w, X, results, k, chunkSize)))
+
+    moment = dict.fromkeys(names, 0.0)
+    velocity = dict.fromkeys(names, 0.0)
+    (beta1, beta2, epsilon) = (0.9, 0.999, 1e-8)
+    for step in range(1, iterations + 1):
+        total = dict.fromkeys(names, 0.0)
+        for begin in range(0, len(results), chunkSize):
+            gradients = {}
+            scores = ModelScores(w, X[begin:begin + chunkSize], gradients)
+            p = Sigmoid(k * scores)
+            common = -2 * (results[begin:begin + chunkSize] - p) * p * (1 - p) * k
+            for name in names:
+                total[name] += (common * gradients[name]).sum()
+
+        for name in names:
+            g = total[name] / len(results)
+            moment[name] = beta1 * moment[name] + (1 - beta1) * g
+            velocity[name] = beta2 * velocity[name] + (1 - beta2) * g * g
+            mHat = moment[name] / (1 - beta1 ** step)
+            vHat = velocity[name] / (1 - beta2 ** step)
+            w[name] -= learningRate * mHat / (vHat ** 0.5 + epsilon)
+
+        if log and step % 50 == 0:
+            log("Step %d: error %.6f" % (step, DatasetError(w, X, results, k, chunkSize)))
+
+    error = DatasetError(w, X, results, k, chunkSize)
+    return EvaluationWeights([w[name] for name in EvaluationWeights.NAMES]), error
+
+
+# Checking
+
+def CheckFeatures(games = 5, seed = 0):
+    """Confirms that ModelScores reproduces NarmerEngine.EvaluatePosition over some self-play positions.
+
+    Returns the largest discrepancy found."""
+    random.seed(seed)
+    engine = NarmerEngine(EvaluationWeights())
+    engine.verbose = False
+    weights = dict([(name, getattr(engine.weights, name)) for name in EvaluationWeights.NAMES])
+    worst = [0.0]
+
+    def OnMove(game):
+        if not game.IsOver():
+            game.PassToNextPlayer()
+            try:
+                X = numpy.array([engine.EvaluationFeatures(game)], dtype = numpy.float32)
+                engine.laserPyramids = [0, 0]
+                engine.hasGuard = [0, 0]
+                expected = engine.EvaluatePosition(game)
+                worst[0] = max(worst[0], abs(ModelScores(weights, X)[0] - expected))
+            finally:
+                game.PassToNextPlayer()
+
+    for i in range(games):
+        PlayGame([engine, engine], onMove = OnMove, randomMoveRate = 0.2)
+    return worst[0]
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog export|fit|check [options] [dataset]")
+    parser.add_option("-o", "--output", help = "dataset file to write (export) or weights file to write (fit)")
+    parser.add_option("-n", "--games", type = "int", default = 1000, help = "self-play games to export (default %default)")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "worker processes (default: one per core)")
+    parser.add_option("-r", "--random-moves", type = "float", default = 0.1, dest = "randomMoveRate",
+                      help = "fraction of random moves in self-play (default %default)")
+    parser.add_option("-i", "--iterations", type = "int", default = 500, help = "gradient steps (default %default)")
+    parser.add_option("--menes", action = "store_true", default = False,
+                      help = "fit only the weights the Menes evaluation uses")
+    parser.add_option("--seed", type = "int", default = None)
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("missing command")
+
+    if args[0] == 'export':
+        if not options.output:
+            parser.error("export needs --output")
+        rows = Export(options.output, options.games, options.processes, options.randomMoveRate, seed = options.seed)
+        print "Exported %d positions to %s." % (rows, options.output)
+
+    elif args[0] == 'fit':
+        if len(args) < 2:
+            parser.error("fit needs a dataset file")
+        X, results = LoadDataset(args[1])
+        print "Fitting %d positions." % len(results)
+        if options.menes:
+            names = MENES_WEIGHTS
+        else:
+            names = [name for name in EvaluationWeights.NAMES if name != 'pharaoh']
+        def Log(s):
+            print s
+        weights, error = Fit(X, results, names, options.iterations, log = Log)
+        print "Final error %.6f: %s" % (error, weights)
+        if options.output:
+            weights.Save(options.output)
+
+    elif args[0] == 'check':
+        print "Largest difference from EvaluatePosition: %g" % CheckFeatures()
+
+    else:
+        parser.error("unknown command %s" % args[0])
+
+
+if __name__ == '__main__':
+    main()
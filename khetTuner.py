@@ -0,0 +1,240 @@
+"""khetTuner
+
+Tunes the evaluation coefficients of NarmerEngine (and so of the engines derived from it)
+with a genetic algorithm: cross randomly-generated sets of coefficients, play them off,
+and breed the winners.
+
+Games are played with no lookahead, because the point is to evaluate the coefficients'
+ability to predict without it, and they're spread across a pool of processes.
+The population is checkpointed to disk after every generation, so long runs can be resumed.
+
+Usage: python khetTuner.py [options]; see --help."""
+
+import multiprocessing
+import optparse
+import os
+import pickle
+import random
+
+from khetGame import *
+from khetMatch import PlayGame, GameScore
+from engines.narmer import NarmerEngine, EvaluationWeights
+
+# The range each coefficient is allowed to take, as (low, high).
+COEFFICIENT_RANGES = {
+    'laserPyramid': (0, 10),
+    'guard': (0, 10),
+    'pharaohFriend': (0, 10),
+    'hitFactor': (0, 1),
+    'hitCap': (0, 5),
+    'stackedObelisk': (0, 10),
+    'obelisk': (0, 10),
+    'pyramid': (0, 10),
+    'pharaoh': (1000, 1000),  # Losing the Pharaoh loses the game; nothing to tune.
+    'diagonal': (0, 1),
+    }
+
+# Tuning games are abandoned as ties after this many plies.
+TUNING_MAX_PLIES = 120
+
+
+def ClampCoefficients(values):
+    """Returns the list of coefficients (in EvaluationWeights.NAMES order), with each limited to its range."""
+    result = []
+    for name, value in zip(EvaluationWeights.NAMES, values):
+        low, high = COEFFICIENT_RANGES[name]
+        result.append(min(max(value, low), high))
+    return result
+
+def RandomCoefficients(rng):
+    return [rng.uniform(*COEFFICIENT_RANGES[name]) for name in EvaluationWeights.NAMES]
+
+def Crossover(mother, father, rng):
+    """Returns a child taking each coefficient from one parent or the other, or a blend of both."""
+    result = []
+    for m, f in zip(mother, father):
+        choice = rng.random()
+        if choice < 0.4:
+            result.append(m)
+        elif choice < 0.8:
+            result.append(f)
+        else:
+            result.append((m + f) / 2.0)
+    return result
+
+def Mutate(values, rng, rate):
+    """Returns a copy of values with about rate of the coefficients nudged by up to 20% of their range."""
+    result = []
+    for name, value in zip(EvaluationWeights.NAMES, values):
+        if rng.random() < rate:
+            low, high = COEFFICIENT_RANGES[name]
+            value += rng.gauss(0, (high - low) * 0.2)
+        result.append(value)
+    return ClampCoefficients(result)
+
+
+def PlayTuningGame(args):
+    """Plays one game between two sets of coefficients; returns the score for the first.
+
+    args is a tuple of (first coefficients, second coefficients, first plays Silver, random seed).
+    Runs in a worker process, so it takes and returns only plain data."""
+    (first, second, firstIsSilver, seed) = args
+    random.seed(seed)
+
+    engines = [NarmerEngine(EvaluationWeights(first)), NarmerEngine(EvaluationWeights(second))]
+    for engine in engines:
+        engine.verbose = False
+        engine.book = None  # The weights being tuned should choose every move.
+        engine.moveStats = None
+    if not firstIsSilver:
+        engines.reverse()
+
+    game = PlayGame(engines, TUNING_MAX_PLIES)
+    if firstIsSilver:
+        return GameScore(game, PLAYER_SILVER)
+    else:
+        return GameScore(game, PLAYER_RED)
+
+
+class Tuner:
+    """Evolves a population of coefficient sets, checkpointing after each generation."""
+    def __init__(self, checkpointFile, populationSize = 16, gamesPerIndividual = 100,
+                 eliteFraction = 0.25, mutationRate = 0.2, seed = None):
+        self.checkpointFile = checkpointFile
+        self.populationSize = populationSize
+        self.gamesPerIndividual = gamesPerIndividual
+        self.eliteFraction = eliteFraction
+        self.mutationRate = mutationRate
+        self.rng = random.Random(seed)
+
+        self.generation = 0
+        # Start with the hand-tuned guesses, and fill out with random ones.
+        self.population = [EvaluationWeights().AsList()]
+        while len(self.population) < populationSize:
+            self.population.append(RandomCoefficients(self.rng))
+        self.fitness = None
+        self.history = []  # (generation, best fitness, best coefficients)
+
+    # Checkpoints
+
+    def SaveCheckpoint(self):
+        """Writes the whole tuning state to the checkpoint file, replacing it only once it's complete."""
+        state = {
+            'generation': self.generation,
+            'population': self.population,
+            'fitness': self.fitness,
+            'history': self.history,
+            'rngState': self.rng.getstate(),
+            'settings': (self.populationSize, self.gamesPerIndividual, self.eliteFraction, self.mutationRate),
+            }
+        tempName = self.checkpointFile + '.tmp'
+        f = open(tempName, 'wb')
+        try:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.path.exists(self.checkpointFile):
+            os.remove(self.checkpointFile)  # Windows won't rename over an existing file.
+        os.rename(tempName, self.checkpointFile)
+
+    def LoadCheckpoint(self):
+        """Restores the state saved by SaveCheckpoint.  Returns False if there's no checkpoint yet."""
+        if not os.path.exists(self.checkpointFile):
+            return False
+        f = open(self.checkpointFile, 'rb')
+        try:
+            state = pickle.load(f)
+        finally:
+            f.close()
+        self.generation = state['generation']
+        self.population = state['population']
+        self.fitness = state['fitness']
+        self.history = state['history']
+        self.rng.setstate(state['rngState'])
+        (self.populationSize, self.gamesPerIndividual, self.eliteFraction, self.mutationRate) = state['settings']
+        return True
+
+    # Evolution
+
+    def Run(self, generations, pool):
+        """Runs until the given generation number has been evaluated, using pool to play the games.
+
+        The checkpoint saved after each generation holds the evaluated population; it's bred from when the next
+        generation starts, so a run resumed with more generations goes on from there rather than repeating it."""
+        while self.generation < generations:
+            if self.fitness != None:
+                self.Breed()
+            self.EvaluateGeneration(pool)
+            best = self.BestIndex()
+            self.history.append((self.generation, self.fitness[best], self.population[best]))
+            print "Generation %d: best fitness %.3f, %s" % (self.generation, self.fitness[best],
+                                                            EvaluationWeights(self.population[best]))
+            self.generation += 1
+            self.SaveCheckpoint()
+
+    def EvaluateGeneration(self, pool):
+        """Plays each individual against randomly-chosen others, alternating colors; fitness is the mean score."""
+        jobs = []
+        owners = []
+        for i in range(len(self.population)):
+            for g in range(self.gamesPerIndividual):
+                opponent = self.rng.choice([j for j in range(len(self.population)) if j != i])
+                jobs.append((self.population[i], self.population[opponent], g % 2 == 0, self.rng.getrandbits(32)))
+                owners.append(i)
+
+        totals = [0.0] * len(self.population)
+        for owner, score in zip(owners, pool.map(PlayTuningGame, jobs, chunksize = 4)):
+            totals[owner] += score
+        self.fitness = [total / self.gamesPerIndividual for total in totals]
+
+    def BestIndex(self):
+        return max(range(len(self.population)), key = lambda i: self.fitness[i])
+
+    def Breed(self):
+        """Replaces the population with the elite and their offspring."""
+        ranked = sorted(range(len(self.population)), key = lambda i: self.fitness[i], reverse = True)
+        eliteCount = max(2, int(len(ranked) * self.eliteFraction))
+        elite = [self.population[i] for i in ranked[:eliteCount]]
+
+        newPopulation = elite[:]
+        while len(newPopulation) < self.populationSize:
+            mother, father = self.rng.sample(elite, 2)
+            newPopulation.append(Mutate(Crossover(mother, father, self.rng), self.rng, self.mutationRate))
+        self.population = newPopulation
+        self.fitness = None
+
+    def Best(self):
+        """Returns the best EvaluationWeights found so far, or None before the first generation is evaluated."""
+        if not self.history:
+            return None
+        best = max(self.history, key = lambda h: h[1])
+        return EvaluationWeights(best[2])
+
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-c", "--checkpoint", default = "khetTuner.ckpt", help = "checkpoint file (default %default)")
+    parser.add_option("-g", "--generations", type = "int", default = 20, help = "generations to run (default %default)")
+    parser.add_option("-p", "--population", type = "int", default = 16, help = "population size (default %default)")
+    parser.add_option("-n", "--games", type = "int", default = 100, help = "games per individual per generation (default %default)")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "worker processes (default: one per core)")
+    parser.add_option("--seed", type = "int", default = None, help = "random seed for a reproducible run")
+    parser.add_option("--restart", action = "store_true", default = False, help = "ignore any existing checkpoint")
+    (options, args) = parser.parse_args()
+
+    tuner = Tuner(options.checkpoint, options.population, options.games, seed = options.seed)
+    if not options.restart and tuner.LoadCheckpoint():
+        print "Resuming from generation %d." % tuner.generation
+
+    pool = multiprocessing.Pool(options.processes)
+    try:
+        tuner.Run(options.generations, pool)
+    finally:
+        pool.close()
+        pool.join()
+
+    print "Best coefficients:", tuner.Best()
+
+
+if __name__ == '__main__':
+    main()
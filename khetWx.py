@@ -7,12 +7,16 @@ Core game classes are in khetGame.py.
 
 --TJW 2008"""
 
+import optparse
 import wx
 
 from khetGame import *
-from engines.raneb import *
+import engines
 import simpleSound
 
+# Command line for an engine to run in its own process, or None to use the built-in engine.
+externalEngineCommand = None
+
 # Singleton variables used for drawing - all initialized later.
 heavyBlackPen = None
 stackedObeliskBrush = None
@@ -23,6 +27,12 @@ laserOutsidePen = None
 laserHitMiddleBrush = None
 laserHitOutsideBrush = None
 
+# Fills the parts of a piece or laser bitmap outside what's drawn, to be masked out; not used in drawing.
+MASK_COLOUR = (255, 0, 255)
+
+# Remember the laser paths for this many positions.
+MAX_CACHED_LASER_PATHS = 64
+
 # Turn phases.
 PIECE_PHASE = 0
 TARGET_PHASE = 1
@@ -53,9 +63,20 @@ class KhetWnd(wx.Window):
         self.SetFocus()
         
         self.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.Bind(wx.EVT_SIZE, self.OnSize)
         self.Bind(wx.EVT_MOUSE_EVENTS, self.OnMouse)
         self.Bind(wx.EVT_CHAR, self.OnChar)
 
+        # The board as last painted, so a repaint only has to draw the squares that changed.
+        self.buffer = None
+        # Pieces drawn ahead of time, by (letter code, color, rotation, stacked, width, height).
+        self.pieceBitmaps = {}
+        # Laser paths traced, by (position key, color), as (path, whether it hits a piece);
+        # and the laser drawn over the board for the most recent one, with its (key, color, width, height).
+        self.laserPaths = {}
+        self.laserOverlay = None
+        self.laserOverlayKey = None
+
         self.highlightedSquare = None
         self.selectedPiece = None
         self.phase = None
@@ -63,7 +84,11 @@ class KhetWnd(wx.Window):
         self.game = Game()
         self.ResetGame()
 
-        self.engine = RanebEngine()        
+        if externalEngineCommand:
+            from engines.external import ExternalEngine
+            self.engine = ExternalEngine(externalEngineCommand)
+        else:
+            self.engine = engines.CreateEngine('raneb')
 
     # Overall game state
 
@@ -112,6 +137,22 @@ class KhetWnd(wx.Window):
             self.Refresh()
         dlg.Destroy()
 
+    def OnClaimTie(self, event):
+        if self.phase != PIECE_PHASE:
+            message = "Finish the current move first."
+        elif not self.game.CanClaimTie():
+            message = "This position has occurred %d times; a tie can be claimed when it has occurred %d times." \
+                      % (self.game.RepetitionCount(), TIE_REPETITIONS)
+        else:
+            self.game.ClaimTie()
+            self.phase = GAME_OVER_PHASE
+            self.SetCursor(wx.STANDARD_CURSOR)
+            message = "The game is a tie."
+        dlg = wx.MessageDialog(self, message, "Claim Tie", wx.OK | wx.ICON_INFORMATION)
+        dlg.ShowModal()
+        dlg.Destroy()
+        self.Refresh()
+
     # Input handlers
 
     def OnChar(self, event):
@@ -147,11 +188,13 @@ class KhetWnd(wx.Window):
                 self.drawRotators = True
                 self.HighlightSquare(None)
                 self.overRotator = self.HitTestRotator(square, event.m_x, event.m_y)
-                self.Refresh()
+                self.RefreshSquares([square])
                 
             # Mousing over target squares to move the piece to, OR turn handles to turn the piece.
             # So, highlight the hit square if it's a legal destination for the selected piece.
             else:
+                if self.drawRotators:
+                    self.RefreshSquares([self.selectedPiece.square])
                 self.drawRotators = False
                 self.overRotator = False
                 if not self.selectedPiece.CanMoveTo(square):
@@ -224,7 +267,9 @@ class KhetWnd(wx.Window):
             if self.engine.ContinueAnalysis(self.phase == ENGINE_PHASE):
                 event.RequestMore()
                 if self.phase == ENGINE_PHASE:
-                    self.HighlightSquare(self.engine.GetMove().fromSquare)
+                    bestSoFar = self.engine.GetMove()
+                    if bestSoFar:
+                        self.HighlightSquare(bestSoFar.fromSquare)
             else:
                 # Done analyzing.
                 if self.phase == ENGINE_PHASE:
@@ -240,24 +285,26 @@ class KhetWnd(wx.Window):
         if square != self.highlightedSquare:
             if self.highlightedSquare:
                 self.highlightedSquare.highlighted = False
+            self.RefreshSquares([self.highlightedSquare, square])
             self.highlightedSquare = square
             if square:
                 square.highlighted = True
-            self.Refresh()
         
     def SelectPiece(self, piece):
         if piece != self.selectedPiece:
             if self.selectedPiece:
                 self.selectedPiece.selected = False
+                self.RefreshSquares([self.selectedPiece.square])
             self.selectedPiece = piece
             if piece:
                 piece.selected = True
-            self.Refresh()
+                self.RefreshSquares([piece.square])
 
     # Move states
 
     def MakeAndPreConfirmMove(self, move):
         self.game.MakeAndPushMove(move)
+        self.RefreshSquares(move.AffectedSquares())
         self.SelectPiece(move.piece)
         self.HighlightSquare(move.toSquare)
         self.phase = CONFIRM_PHASE
@@ -267,6 +314,7 @@ class KhetWnd(wx.Window):
         self.SelectPiece(move.piece)
         self.HighlightSquare(move.fromSquare)
         self.phase = LASER_PHASE
+        self.Refresh()  # For the laser.
 
     def StartNextMove(self):
         self.game.PassToNextPlayer()
@@ -295,6 +343,8 @@ class KhetWnd(wx.Window):
                         # The move has already been made, so we have to do the unstacking here.
                         move.piece.stacked = False
                         Obelisk(move.piece.color, False).MoveTo(move.fromSquare)
+                        move.fromSquare.piece.rotation = move.piece.rotation
+                        self.game.RefreshPositionKey()
                     elif choice == wx.ID_NO:
                         move.unstackObelisk = False
                     elif choice == wx.ID_CANCEL:
@@ -344,7 +394,8 @@ class KhetWnd(wx.Window):
     def Cancel(self):
         if self.phase == CONFIRM_PHASE:
             # Undo...
-            self.game.moveStack.pop().UndoMove()
+            self.RefreshSquares(self.game.moveStack[-1].AffectedSquares())
+            self.game.UndoAndPopLastMove()
             self.phase = TARGET_PHASE  # ...And drop further back in the next block.
             self.engine.SetHintMove(None)
             
@@ -358,12 +409,33 @@ class KhetWnd(wx.Window):
 
     # Drawing
 
+    def OnSize(self, event):
+        # The piece bitmaps are drawn to fit the squares, so start again at the new size.
+        self.pieceBitmaps = {}
+        self.buffer = None
+        self.Refresh()
+        event.Skip()
+
+    def RefreshSquares(self, squares):
+        """Marks just the given squares (ignoring any None) to be repainted."""
+        for square in squares:
+            if square:
+                self.RefreshRect(self.FindSquareRect(square.row, square.col))
+
     def OnPaint(self, event):
-        dc = wx.BufferedPaintDC(self)
+        if self.buffer == None:
+            (w, h) = self.GetSizeTuple()
+            self.buffer = wx.EmptyBitmap(max(w, 1), max(h, 1))
+            region = None  # Draw everything.
+        else:
+            region = self.GetUpdateRegion()
+        dc = wx.BufferedPaintDC(self, self.buffer)
         dc.SetFont(self.font)
 
+        # Only the squares needing a repaint; the rest of the buffer still has them from last time.
         for square in allSquares(self.game.board):
-            self.DrawSquare(dc, square)
+            if region == None or region.ContainsRect(self.FindSquareRect(square.row, square.col)) != wx.OutRegion:
+                self.DrawSquare(dc, square)
 
         if self.drawRotators and self.selectedPiece and self.selectedPiece.canRotate:
             self.DrawRotators(dc)
@@ -409,6 +481,23 @@ class KhetWnd(wx.Window):
         p1 = self.TransformPoint(rect, piece, p1)
         dc.DrawLine(p0.x, p0.y, p1.x, p1.y)
 
+    def GetPieceBitmap(self, piece, size):
+        """Returns a bitmap of the piece drawn in a square of the given wx.Size, with the rest of the square masked out.
+
+        Each one is drawn the first time it's needed, and kept until the window is resized."""
+        key = (piece.letterCode, piece.color, piece.rotation, getattr(piece, 'stacked', False), size.width, size.height)
+        bitmap = self.pieceBitmaps.get(key)
+        if bitmap == None:
+            bitmap = wx.EmptyBitmap(size.width, size.height)
+            dc = wx.MemoryDC(bitmap)
+            dc.SetBackground(wx.Brush(wx.Colour(*MASK_COLOUR)))
+            dc.Clear()
+            self.DrawPiece(dc, piece, wx.Rect(0, 0, size.width, size.height))
+            dc.SelectObject(wx.NullBitmap)
+            bitmap.SetMask(wx.Mask(bitmap, wx.Colour(*MASK_COLOUR)))
+            self.pieceBitmaps[key] = bitmap
+        return bitmap
+
     def DrawPiece(self, dc, piece, rect):
         """Draws the piece on the given DC, in a square that occupies the given rect."""
         rect = self.DrawSquareBase(dc, piece, rect)
@@ -460,7 +549,7 @@ class KhetWnd(wx.Window):
 
         # Draw piece, if any.
         if square.piece:
-            self.DrawPiece(dc, square.piece, rect)
+            dc.DrawBitmap(self.GetPieceBitmap(square.piece, rect.GetSize()), rect.x, rect.y, True)
 
         # Draw coordinates, for development and debugging.
         #dc.DrawText("(%d, %d)" % (square.row, square.col), rect.x, rect.y)
@@ -489,12 +578,48 @@ class KhetWnd(wx.Window):
                 dc.DrawLine(rect.x + 2, rect.y + rect.height * 0.8, rect.x + 2, rect.y + rect.height / 2)
                 dc.DrawLine(rect.x + 2, rect.y + rect.height / 2, rect.x + rect.width * 0.5, rect.y + rect.height / 2)
 
+    def FindLaserPath(self):
+        """Returns the active player's laser path in the current position, as from Game.FindLaserPath,
+        and whether it hits a piece.
+
+        Paths are remembered by position, so repainting doesn't trace the laser again."""
+        key = (self.game.positionKey, self.game.activePlayer)
+        result = self.laserPaths.get(key)
+        if result == None:
+            laserPath = self.game.FindLaserPath(self.game.activePlayer)
+            result = (laserPath, self.game.FindLaserPathEnd(laserPath) != None)
+            if len(self.laserPaths) >= MAX_CACHED_LASER_PATHS:
+                self.laserPaths.clear()
+            self.laserPaths[key] = result
+        return result
+
     def DrawLaser(self, dc):
         """Graphically draws the laser path for the active player."""
-        laserPath = self.game.FindLaserPath(self.game.activePlayer)
-        hitPiece = self.game.FindLaserPathEnd(laserPath)
-        (currX, currY) = self.FindSquareMiddle(laserPath.pop(0))
-        for s in laserPath:
+        (w, h) = self.GetSizeTuple()
+        key = (self.game.positionKey, self.game.activePlayer, w, h)
+        if key != self.laserOverlayKey:
+            # Draw the laser once, onto a masked bitmap the size of the board.
+            (laserPath, hit) = self.FindLaserPath()
+            bitmap = wx.EmptyBitmap(max(w, 1), max(h, 1))
+            overlayDC = wx.MemoryDC(bitmap)
+            overlayDC.SetBackground(wx.Brush(wx.Colour(*MASK_COLOUR)))
+            overlayDC.Clear()
+            self.DrawLaserPath(overlayDC, laserPath, hit)
+            overlayDC.SelectObject(wx.NullBitmap)
+            bitmap.SetMask(wx.Mask(bitmap, wx.Colour(*MASK_COLOUR)))
+            self.laserOverlay = bitmap
+            self.laserOverlayKey = key
+        dc.DrawBitmap(self.laserOverlay, 0, 0, True)
+
+    def DrawLaserPath(self, dc, laserPath, hit, steps = None):
+        """Draws a laser path (as from FindLaserPath) on dc, as far as the given number of squares along it (None for all).
+
+        Draws the hit if it gets that far.  Needs no game logic, so it's cheap enough to animate the beam frame by frame."""
+        if steps == None:
+            steps = len(laserPath) - 1
+        (currX, currY) = self.FindSquareMiddle(laserPath[0])
+        (nextX, nextY) = (currX, currY)
+        for s in laserPath[1:steps + 1]:
             (nextX, nextY) = self.FindSquareMiddle(s)
 
             # Draw the laser to the middle of that square.
@@ -506,7 +631,7 @@ class KhetWnd(wx.Window):
             (currX, currY) = (nextX, nextY)            
 
         # See if it hit a piece.
-        if hitPiece:
+        if hit and steps >= len(laserPath) - 1:
             # Draw a blob of fire on it.
             dc.SetPen(wx.TRANSPARENT_PEN)
             dc.SetBrush(laserHitOutsideBrush)
@@ -592,6 +717,8 @@ class MyFrame(wx.Frame):
         menu.Append(1002, "&Save\tCtrl+S")
         menu.Append(1003, "Save &As...")
         menu.AppendSeparator()
+        menu.Append(1006, "Claim &Tie")
+        menu.AppendSeparator()
         menu.Append(1005, "E&xit\tCtrl+X")
         menubar = wx.MenuBar()
         menubar.Append(menu, "&Game")
@@ -612,6 +739,7 @@ class MyFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.wnd.OnSaveAs, id=1003)
         self.Bind(wx.EVT_MENU, self.wnd.OnOpen, id=1004)
         self.Bind(wx.EVT_MENU, self.OnWindowClose, id=1005)
+        self.Bind(wx.EVT_MENU, self.wnd.OnClaimTie, id=1006)
         self.Bind(wx.EVT_MENU, self.OnHelpAbout, id=1090)
         self.Bind(wx.EVT_MENU, self.wnd.OnEngineSuggest, id=2000)
         self.Bind(wx.EVT_MENU, self.wnd.OnEngineTakeOver, id=2001)
@@ -625,6 +753,8 @@ class MyFrame(wx.Frame):
         about.ShowModal()
 
     def OnWindowClose(self, event):
+        if externalEngineCommand:
+            self.wnd.engine.Close()
         self.Destroy()
 
 
@@ -642,6 +772,8 @@ class MyApp(wx.App):
         laserOutsidePen = wx.Pen(wx.Color(173, 11, 4), 3, wx.SOLID)
         laserHitMiddleBrush = wx.Brush(wx.Color(133, 6, 0))
         laserHitOutsideBrush = wx.Brush(wx.Color(252, 99, 91))
+
+        simpleSound.Preload(['laser.wav'])
         
         frame = MyFrame(None)
         self.SetTopWindow(frame)
@@ -651,6 +783,15 @@ class MyApp(wx.App):
 
 
 if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-e", "--engine", dest = "engineCommand",
+                      help = "run the engine in its own process with this command, e.g. \"python khetProtocol.py raneb\"")
+    parser.add_option("-q", "--quiet", action = "store_true", default = False, help = "don't play sounds")
+    (options, args) = parser.parse_args()
+    externalEngineCommand = options.engineCommand
+    if options.quiet:
+        simpleSound.SetBackend(simpleSound.NullBackend())
+
     app = MyApp(0)
     app.MainLoop()
 
@@ -2,38 +2,182 @@
 # Plays audio files on Linux and Windows.
 # Written Jan-2008 by Timothy Weber.
 # Based on (reconstituted) code posted by Bill Dandreta at <http://www.velocityreviews.com/forums/t337346-how-to-play-sound-in-python.html>.
+#
+# Sounds are played by a SoundManager, which reads each file once and plays it on a background thread,
+# so the caller never waits for the sound card.  If sounds are asked for faster than they can be played,
+# a sound already waiting isn't queued again, and beyond that they're dropped.
+#
+# Nothing platform-specific is imported until the first sound is wanted, so importing this costs nothing.
 
-import platform
+import os
+import Queue
+import sys
+import threading
 
-if platform.system().startswith('Win'):
-    from winsound import PlaySound, SND_FILENAME, SND_ASYNC
-elif platform.system().startswith('Linux'):
-    from wave import open as waveOpen
-    from ossaudiodev import open as ossOpen
 
-    try:
-        from ossaudiodev import AFMT_S16_NE
-    except ImportError:
-        if byteorder == "little":
-            AFMT_S16_NE = ossaudiodev.AFMT_S16_LE
-        else:
-            AFMT_S16_NE = ossaudiodev.AFMT_S16_BE
+# Backends: each reads a file into a clip, once, and plays clips, synchronously.
 
+class NullBackend:
+    """Plays nothing; for running headless, or when sound isn't wanted."""
+    def Decode(self, filename):
+        return filename
 
-def Play(filename):
-    """Plays the sound in the given filename, asynchronously."""
-    if platform.system().startswith('Win'):
-        PlaySound(filename, SND_FILENAME|SND_ASYNC)
-    elif platform.system().startswith('Linux'):
+    def Play(self, clip):
+        pass
+
+
+class WindowsBackend:
+    def __init__(self):
+        import winsound
+        self.winsound = winsound
+
+    def Decode(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def Play(self, clip):
+        self.winsound.PlaySound(clip, self.winsound.SND_MEMORY)
+
+
+class OssBackend:
+    """Linux, through /dev/dsp."""
+    def __init__(self):
+        import ossaudiodev
+        self.ossaudiodev = ossaudiodev
         try:
-            s = waveOpen(filename,'rb')
-            (nc,sw,fr,nf,comptype, compname) = s.getparams( )
-            dsp = ossOpen('/dev/dsp','w')
+            self.format = ossaudiodev.AFMT_S16_NE
+        except AttributeError:
+            if sys.byteorder == "little":
+                self.format = ossaudiodev.AFMT_S16_LE
+            else:
+                self.format = ossaudiodev.AFMT_S16_BE
 
-            dsp.setparameters(AFMT_S16_NE, nc, fr)
-            data = s.readframes(nf)
+    def Decode(self, filename):
+        import wave
+        s = wave.open(filename, 'rb')
+        try:
+            (nc, sw, fr, nf, comptype, compname) = s.getparams()
+            return (nc, fr, s.readframes(nf))
+        finally:
             s.close()
+
+    def Play(self, clip):
+        (nc, fr, data) = clip
+        dsp = self.ossaudiodev.open('/dev/dsp', 'w')
+        try:
+            dsp.setparameters(self.format, nc, fr)
             dsp.write(data)
+        finally:
             dsp.close()
-        except:
-            pass
+
+
+def DefaultBackend():
+    """Returns the backend for this platform, or a NullBackend if there's no way to play sound here."""
+    if sys.platform.startswith('win'):
+        return WindowsBackend()
+    elif sys.platform.startswith('linux') and os.path.exists('/dev/dsp'):
+        return OssBackend()
+    else:
+        return NullBackend()
+
+
+class SoundManager:
+    """Plays sounds on a background thread, from clips read once and kept."""
+
+    # Sounds waiting to be played, at most.
+    QUEUE_SIZE = 4
+
+    def __init__(self, backend = None):
+        if backend == None:
+            backend = DefaultBackend()
+        self.backend = backend
+        self.clips = {}  # By filename; None for one that couldn't be read.
+        self.queue = Queue.Queue(SoundManager.QUEUE_SIZE)
+        self.waiting = set()  # Filenames in the queue.
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    def Preload(self, filenames):
+        """Reads the given sound files now, so playing them later costs nothing."""
+        for filename in filenames:
+            self.Clip(filename)
+
+    def Clip(self, filename):
+        """Returns the clip for the given file, reading it the first time; None if it can't be read."""
+        if filename not in self.clips:
+            try:
+                self.clips[filename] = self.backend.Decode(filename)
+            except Exception:
+                self.clips[filename] = None
+        return self.clips[filename]
+
+    def Play(self, filename):
+        """Queues the sound in the given file to be played, and returns immediately."""
+        if isinstance(self.backend, NullBackend) or self.Clip(filename) == None:
+            return
+        self.lock.acquire()
+        try:
+            if filename in self.waiting:
+                return  # Coalesce with the one already waiting.
+            try:
+                self.queue.put_nowait(filename)
+            except Queue.Full:
+                self.dropped += 1
+                return
+            self.waiting.add(filename)
+            if self.thread == None:
+                self.thread = threading.Thread(target = self.Run, name = 'sound')
+                self.thread.setDaemon(True)  # Don't keep the program running.
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def Run(self):
+        """The background thread: plays the queued sounds, one at a time, until it gets None."""
+        while True:
+            filename = self.queue.get()
+            if filename == None:
+                return
+            self.lock.acquire()
+            self.waiting.discard(filename)
+            self.lock.release()
+            try:
+                self.backend.Play(self.clips[filename])
+            except Exception:
+                pass  # No sound is better than a crash.
+
+    def Close(self):
+        """Stops the background thread, after the sounds already queued."""
+        if self.thread != None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+defaultManager = None
+
+def DefaultManager():
+    """Returns the SoundManager used by Play, creating it on first use."""
+    global defaultManager
+    if defaultManager == None:
+        defaultManager = SoundManager()
+    return defaultManager
+
+def SetBackend(backend):
+    """Replaces the default SoundManager with one using the given backend; e.g. NullBackend() to turn sound off."""
+    global defaultManager
+    if defaultManager != None:
+        defaultManager.Close()
+    defaultManager = SoundManager(backend)
+
+def Preload(filenames):
+    """Reads the given sound files ahead of time, for Play."""
+    DefaultManager().Preload(filenames)
+
+def Play(filename):
+    """Plays the sound in the given filename, asynchronously."""
+    DefaultManager().Play(filename)